@@ -30,44 +30,68 @@ __copyright__ = "Copyright 2017, Aldebaran Robotics / Softbank Robotics Europe"
 __author__ = 'ekroeger'
 __email__ = 'ekroeger@softbankrobotics.com'
 
+import collections
 import functools
+import os
 import time
 import threading
+import types
 
 import qi
 
+# Only protects the creation of the objects' own (lazy) locks.
+_state_lock = threading.Lock()
+
+# Number of GeneratorFutures [started, finished], see get_stats()
+_coroutine_counts = [0, 0]
+_counts_lock = threading.Lock()
+
 class _MultiFuture(object):
     """Internal helper for handling lists of futures.
 
     The callback will only be called once, with either an exception or a
     list of the right type and size.
     """
+    __slots__ = ("returntype", "callback", "expecting", "failed", "futures",
+                 "lock")
+
     def __init__(self, futures, callback, returntype):
+        self.lock = threading.Lock()
         self.returntype = returntype
         self.callback = callback
         self.expecting = len(futures)
-        self.values = [None] * self.expecting
         self.failed = False
         self.futures = futures
-        for i, future in enumerate(futures):
-            future.then(lambda fut: self.__handle_part_done(i, fut))
+        handle_part_done = self.__handle_part_done
+        for future in futures:
+            future.then(handle_part_done)
 
-    def __handle_part_done(self, index, future):
+    def __handle_part_done(self, future):
         "Internal callback for when a sub-function is done."
-        if self.failed:
-            # We already raised an exception, don't do anything else.
+        try:
+            future.value()
+        except Exception as exception:
+            with self.lock:
+                if self.failed:
+                    # We already raised an exception, don't do anything else.
+                    return
+                self.failed = True
+            self.callback(exception=exception)
             return
-        assert self.expecting, "Got more callbacks than expected!"
+        with self.lock:
+            if self.failed:
+                return
+            assert self.expecting, "Got more callbacks than expected!"
+            self.expecting -= 1
+            if self.expecting:
+                return
+        # We have all the values (all futures are finished, so no blocking)
         try:
-            self.values[index] = future.value()
+            values = [future.value() for future in self.futures]
         except Exception as exception:
-            self.failed = True
             self.callback(exception=exception)
             return
-        self.expecting -= 1
-        if not self.expecting:
-            # We have all the values
-            self.callback(self.returntype(self.values))
+        self.callback(self.returntype(values))
 
     def cancel(self):
         "Cancel all subfutures."
@@ -75,17 +99,94 @@ class _MultiFuture(object):
             future.cancel()
 
 class FutureWrapper(object):
-    "Abstract base class for objects that pretend to be a future."
+    """Abstract base class for objects that pretend to be a future.
+
+    To keep them cheap, the qi promise and the lock are only created when
+    first needed; until someone asks for the promise (with .future, .then(),
+    .wait() ...), finishing just records the result.
+
+    The lock protects the promise's creation and finishing (and subclasses'
+    own state), so don't use the promise while holding it."""
+    __slots__ = ("running", "_exception", "_result", "_promise", "_future",
+                 "_lock", "__weakref__")
+    _counts = None # [started, finished] list to update, if any
+
     def __init__(self):
         self.running = True
-        self.promise = qi.Promise(self._on_future_cancelled)
-        self.future = self.promise.future()
         self._exception = ""
-        self.lock = threading.Lock()
+        self._result = None # (promise method name, args) once finished
+        self._promise = None
+        self._future = None
+        self._lock = None
+
+    @property
+    def promise(self):
+        "The qi.Promise behind this object, created on first use."
+        if self._promise is None:
+            with self.lock:
+                created = self._promise is None
+                if created:
+                    self._promise = qi.Promise(self._on_future_cancelled)
+                    self._future = self._promise.future()
+                    result = self._result
+            if created:
+                self._on_promise_created()
+                if result:
+                    method, args = result
+                    getattr(self._promise, method)(*args)
+        return self._promise
+
+    @promise.setter
+    def promise(self, promise):
+        "For subclasses that make their own promise."
+        with self.lock:
+            self._promise = promise
+            self._future = promise.future()
+
+    @property
+    def future(self):
+        "The qi.Future behind this object, created on first use."
+        if self._future is None:
+            return self.promise.future()
+        return self._future
+
+    @future.setter
+    def future(self, future):
+        "For subclasses that set their own future."
+        self._future = future
+
+    @property
+    def lock(self):
+        "The object's lock, created on first use."
+        if self._lock is None:
+            with _state_lock:
+                if self._lock is None:
+                    self._lock = threading.Lock()
+        return self._lock
+
+    def _on_promise_created(self):
+        "Hook for subclasses that need callbacks on the promise."
+        pass
+
+    def _resolve(self, method, *args):
+        """Finishes the promise with promise.<method>(*args).
+
+        Only the first call does anything; returns whether it was this one."""
+        with self.lock:
+            if self._result is not None:
+                return False
+            self._result = (method, args)
+            promise = self._promise
+        if self._counts is not None:
+            with _counts_lock:
+                self._counts[1] += 1
+        if promise is not None:
+            getattr(promise, method)(*args)
+        return True
 
     def _on_future_cancelled(self, promise):
         """If someone from outside cancelled our future - propagate."""
-        promise.setCanceled()
+        self._resolve("setCanceled")
 
     def then(self, callback):
         """Add function to be called when the future is done; returns a future.
@@ -109,8 +210,12 @@ class FutureWrapper(object):
             callback(self.future.value()) #?
             # return something? (to see when we have a testcase for this...)
 
-    def hasError(self):
-        "Was there an error in one of the generator calls?"
+    def hasError(self, timeout=None):
+        """Was there an error in one of the generator calls?
+
+        Like qi.Future.hasError, waits at most timeout milliseconds."""
+        if timeout is not None and self.running:
+            self.future.wait(timeout)
         return bool(self._exception)
 
     def wait(self):
@@ -127,11 +232,22 @@ class FutureWrapper(object):
         For now, always returns None."""
         if self._exception:
             raise self._exception
-        else:
+        result = self._result
+        if self._promise is None and result and result[0] == "setValue":
+            # Already finished, no need to create a promise just for this.
+            return result[1][0]
+        try:
             return self.future.value()
+        except RuntimeError:
+            if self._exception:
+                # Finished with an error while we waited: raise the original
+                raise self._exception
+            raise
 
-    def hasValue(self):
+    def hasValue(self, timeout=None):
         "Tells us whether the generator 1) is finished and 2) has a value."
+        if timeout is not None and self.running:
+            self.future.wait(timeout)
         # For some reason this doesn't do what I expected
         # self.future.hasValue() returns True even if we're not finished (?)
         if self.running:
@@ -155,9 +271,8 @@ class FutureWrapper(object):
 
     def cancel(self):
         "Cancel the future, and stop executing the sequence of actions."
-        with self.lock:
-            self.running = False
-            self.promise.setCanceled()
+        self.running = False
+        self._resolve("setCanceled")
 
     def isCanceled(self):
         "Has this already been cancelled?"
@@ -171,23 +286,94 @@ class FutureWrapper(object):
     # use case.
 
 
+# Ring buffer of trace records, None when tracing is disabled.
+_trace_records = None
+
+class _TracedGenerator(object):
+    """Generator proxy that records the duration of each step.
+
+    Only used when tracing is enabled (see enable_tracing), so that the
+    normal case pays no per-step cost."""
+    def __init__(self, generator, records):
+        self.generator = generator
+        self.records = records
+        self.name = generator.__name__
+        self.wait_start = None
+        self.wait_location = None
+        self.wait_thread = None
+
+    def send(self, arg):
+        "Same as generator.send, but traced."
+        return self.__step(self.generator.send, arg)
+
+    def throw(self, exception):
+        "Same as generator.throw, but traced."
+        return self.__step(self.generator.throw, exception)
+
+    def __step(self, method, arg):
+        "Runs the generator until the next yield, recording timings."
+        start = time.time()
+        thread_id = threading.current_thread().ident
+        if self.wait_start is not None:
+            self.records.append((self.name, "wait", self.wait_location,
+                                 self.wait_start, start, self.wait_thread,
+                                 id(self)))
+        location = None
+        try:
+            return method(arg)
+        finally:
+            end = time.time()
+            frame = self.generator.gi_frame
+            if frame:
+                location = (frame.f_code.co_filename, frame.f_lineno)
+            self.records.append((self.name, "run", location, start, end,
+                                 thread_id, id(self)))
+            self.wait_start = end
+            self.wait_location = location
+            self.wait_thread = thread_id
+
 class GeneratorFuture(FutureWrapper):
     "Future-like object (same interface) made for wrapping a generator."
+    __slots__ = ("generator", "sub_future")
+    _counts = _coroutine_counts
+
     def __init__(self, generator):
         FutureWrapper.__init__(self)
+        with _counts_lock:
+            _coroutine_counts[0] += 1
+        if _trace_records is not None:
+            generator = _TracedGenerator(generator, _trace_records)
         self.generator = generator
-        self.future.addCallback(self.__handle_finished)
         self.sub_future = None
         self.__ask_for_next()
 
+    def _on_promise_created(self):
+        "Someone can now finish our promise directly; watch for that."
+        self._future.addCallback(self.__handle_finished)
+
     def __handle_finished(self, future):
         "Callback for when our future finished for any reason."
         if self.running:
             # promise was directly finished by someone else - cancel all!
             self.running = False
+            with self.lock:
+                finished = self._result is None
+                if finished:
+                    # Nothing to replay, the promise is already finished.
+                    self._result = ("", ())
+            if finished:
+                with _counts_lock:
+                    _coroutine_counts[1] += 1
             if self.sub_future:
                 self.sub_future.cancel()
 
+    def cancel(self):
+        "Cancel the sequence of actions, and the future it's waiting for."
+        FutureWrapper.cancel(self)
+        sub_future = self.sub_future
+        if sub_future:
+            sub_future.cancel()
+
     def __handle_done(self, future):
         "Internal callback for when the current sub-function is done."
         try:
@@ -197,9 +383,8 @@ class GeneratorFuture(FutureWrapper):
 
     def __finish(self, value):
         "Finish and return."
-        with self.lock:
-            self.running = False
-            self.promise.setValue(value)
+        self.running = False
+        self._resolve("setValue", value)
 
     def __ask_for_next(self, arg=None, exception=None):
         "Internal - get the next function in the generator."
@@ -226,10 +411,9 @@ class GeneratorFuture(FutureWrapper):
             except StopIteration:
                 self.__finish(None)
             except Exception as exc:
-                with self.lock:
-                    self._exception = exc
-                    self.running = False
-                    self.promise.setError(str(exc))
+                self._exception = exc
+                self.running = False
+                self._resolve("setError", str(exc))
 #                   self.__finish(None) # May not be best way of finishing?
 
 def async_generator(func):
@@ -257,6 +441,83 @@ def public_async_generator(func):
         return GeneratorFuture(func(*args, **kwargs)).future
     return function
 
+def get_stats():
+    """Returns a dictionary counting the async_generator coroutines.
+
+    "started" and "finished" count all coroutines since the process started,
+    "pending" the ones currently running (waiting for a future). Cheap enough
+    to be polled often."""
+    with _counts_lock:
+        started, finished = _coroutine_counts
+    return {"started": started, "finished": finished,
+            "pending": started - finished}
+
+def enable_tracing(capacity=10000):
+    """Starts recording the steps of all new async_generator coroutines.
+
+    For each step, the coroutine name, the location of the yield, the start
+    and end times and the thread are kept in a ring buffer of the given
+    capacity (older records are dropped). Coroutines created before this call
+    are not traced."""
+    global _trace_records
+    _trace_records = collections.deque(maxlen=capacity)
+
+def disable_tracing():
+    "Stops tracing new coroutines, and drops the recorded steps."
+    global _trace_records
+    _trace_records = None
+
+def get_trace_records():
+    """Returns a list of the recorded steps.
+
+    Each record is a (name, kind, location, start, end, thread_id, trace_id)
+    tuple, where kind is "run" (executing the coroutine's code) or "wait"
+    (waiting for the yielded future), and location is a (filename, line)
+    tuple for the yield, or None once the coroutine finished."""
+    if _trace_records is None:
+        return []
+    return list(_trace_records)
+
+def _format_location(location):
+    "Returns a readable description of the yield at location."
+    if not location:
+        return "(finished)"
+    import linecache
+    filename, lineno = location
+    source = linecache.getline(filename, lineno).strip()
+    return "%s:%d %s" % (os.path.basename(filename), lineno, source)
+
+def export_chrome_trace(filename=None):
+    """Returns the recorded steps as Chrome trace-event JSON.
+
+    The result can be loaded in chrome://tracing or Perfetto; if filename is
+    given, it is also written to that file. "run" steps are shown on the
+    thread that executed them, "wait" steps as async events."""
+    import json
+    pid = os.getpid()
+    events = []
+    for name, kind, location, start, end, thread_id, trace_id in \
+            get_trace_records():
+        args = {"yield": _format_location(location)}
+        timestamp = start * MICROSECONDS_PER_SECOND
+        if kind == "run":
+            events.append({
+                "name": name, "cat": kind, "ph": "X", "ts": timestamp,
+                "dur": (end - start) * MICROSECONDS_PER_SECOND,
+                "pid": pid, "tid": thread_id, "args": args})
+        else:
+            for phase, event_time in (("b", start), ("e", end)):
+                events.append({
+                    "name": name, "cat": kind, "ph": phase,
+                    "ts": event_time * MICROSECONDS_PER_SECOND,
+                    "id": trace_id, "pid": pid, "tid": thread_id,
+                    "args": args})
+    trace = json.dumps({"traceEvents": events})
+    if filename:
+        with open(filename, "w") as trace_file:
+            trace_file.write(trace)
+    return trace
+
 class Return(object):
     "Use to wrap a return function "
     def __init__(self, value):
@@ -266,6 +527,8 @@ MICROSECONDS_PER_SECOND = 1000000
 
 class _Sleep(FutureWrapper):
     "Helper class that behaves like an async 'sleep' function"
+    __slots__ = ("fut",)
+
     def __init__(self, time_in_secs):
         FutureWrapper.__init__(self)
         time_in_microseconds = int(MICROSECONDS_PER_SECOND * time_in_secs)
@@ -273,7 +536,415 @@ class _Sleep(FutureWrapper):
 
     def set_finished(self):
         "Inner callback, finishes the future."
-        with self.lock:
-            self.promise.setValue(None)
+        self._resolve("setValue", None)
 
 sleep = _Sleep
+
+# Overrun policies for periodic
+SKIP_MISSED = "skip_missed"
+CATCH_UP = "catch_up"
+
+class _Periodic(FutureWrapper):
+    """Helper class that calls a function at a fixed rate, until cancelled.
+
+    Ticks are scheduled on absolute deadlines (start + n * period), so the
+    rate doesn't drift. If the function returns a future (e.g. it's an
+    async_generator), the tick lasts until that future is finished; other
+    return values are ignored.
+
+    When a tick overruns past the next deadline, policy decides what happens:
+    SKIP_MISSED (the default) drops the missed ticks and waits for the next
+    deadline, CATCH_UP runs the missed ticks immediately one after the other.
+
+    If the function raises (or its future fails), the periodic task stops
+    with that error. stats() returns jitter and overrun statistics.
+    """
+    def __init__(self, func, frequency, policy=SKIP_MISSED):
+        if not frequency > 0:
+            raise ValueError("periodic needs a frequency > 0 (in Hz), not %r"
+                             % (frequency,))
+        FutureWrapper.__init__(self)
+        self.func = func
+        self.period = 1.0 / frequency
+        self.policy = policy
+        self.start_time = time.time()
+        self.tick_index = 0
+        self.timer = None
+        self.sub_future = None
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.total_jitter = 0.0
+        self.max_jitter = 0.0
+        self.future.addCallback(self.__handle_finished)
+        self.__schedule()
+
+    def stats(self):
+        "Returns a dictionary of statistics about the ticks so far."
+        mean_jitter = self.total_jitter / self.ticks if self.ticks else 0.0
+        return {
+            "ticks": self.ticks,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "mean_jitter": mean_jitter,
+            "max_jitter": self.max_jitter,
+        }
+
+    def __deadline(self):
+        "Absolute time at which the current tick should start."
+        return self.start_time + self.tick_index * self.period
+
+    def __schedule(self):
+        "Schedules the next tick at its deadline."
+        delay = max(0.0, self.__deadline() - time.time())
+        time_in_microseconds = int(MICROSECONDS_PER_SECOND * delay)
+        with self.lock:
+            if self.running:
+                self.timer = qi.async(self.__tick, delay=time_in_microseconds)
+
+    def __tick(self):
+        "Inner callback, runs the function once."
+        if not self.running:
+            return
+        jitter = time.time() - self.__deadline()
+        self.ticks += 1
+        self.total_jitter += jitter
+        self.max_jitter = max(self.max_jitter, jitter)
+        try:
+            result = self.func()
+        except Exception as exception:
+            self.__fail(exception)
+            return
+        if not hasattr(result, "then"):
+            # None, or a plain value: the tick is done
+            self.__tick_done()
+        else:
+            self.sub_future = result
+            result.then(self.__handle_tick_done)
+
+    def __handle_tick_done(self, future):
+        "Internal callback for when the future returned by a tick is done."
+        self.sub_future = None
+        if not self.running:
+            return
+        try:
+            future.value()
+        except Exception as exception:
+            self.__fail(exception)
+            return
+        self.__tick_done()
+
+    def __tick_done(self):
+        "Handles overruns, and schedules the next tick."
+        end_time = time.time()
+        self.tick_index += 1
+        if end_time > self.__deadline():
+            self.overruns += 1
+            if self.policy == SKIP_MISSED:
+                elapsed = end_time - self.start_time
+                next_index = int(elapsed / self.period) + 1
+                self.skipped += next_index - self.tick_index
+                self.tick_index = next_index
+        self.__schedule()
+
+    def __fail(self, exception):
+        "Stops with an error."
+        if self.running:
+            self._exception = exception
+            self.running = False
+            self._resolve("setError", str(exception))
+
+    def __handle_finished(self, future):
+        "Callback for when our future finished for any reason."
+        self.running = False
+        if self.timer:
+            self.timer.cancel()
+        if self.sub_future:
+            self.sub_future.cancel()
+
+periodic = _Periodic
+
+
+def _is_canceled(future):
+    "Was this future (qi future or FutureWrapper) cancelled?"
+    if isinstance(future, FutureWrapper):
+        # FutureWrapper.isCanceled() is also True once it's finished
+        if future._promise is None:
+            return bool(future._result) and future._result[0] == "setCanceled"
+        return future.future.isCanceled()
+    return future.isCanceled()
+
+class TaskGroup(FutureWrapper):
+    """Future-like object that owns a group of child futures.
+
+    Children are added with spawn() or add(); if one of them fails, or if the
+    group is cancelled (for example because the coroutine yielding it was
+    cancelled), all children that are still running get cancelled.
+
+    The group finishes once it has been closed (by leaving the "with" block,
+    or by calling close()) and all its children are done; its value is the
+    list of the children's values, in the order they were added (None for
+    children that were cancelled individually).
+
+    @stk.coroutines.async_generator
+    def run_behavior(self):
+        with stk.coroutines.TaskGroup() as group:
+            group.spawn(self.look_around)
+            group.spawn(self.say, "hello")
+        values = yield group
+    """
+    def __init__(self):
+        FutureWrapper.__init__(self)
+        self.children = []
+        self.pending = 0
+        self.closed = False
+        self.future.addCallback(self.__handle_finished)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type:
+            self.cancel()
+        else:
+            self.close()
+        return False
+
+    def spawn(self, func, *args, **kwargs):
+        """Calls func with the given arguments and adds the result as a child.
+
+        func can be an async_generator function, a plain generator function
+        (it will then be wrapped in a GeneratorFuture) or anything returning
+        a future."""
+        future = func(*args, **kwargs)
+        if isinstance(future, types.GeneratorType):
+            future = GeneratorFuture(future)
+        return self.add(future)
+
+    def add(self, future):
+        "Adds an already running future to the group, and returns it."
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Cannot add a task to a closed TaskGroup")
+            running = self.running
+            if running:
+                self.children.append(future)
+                self.pending += 1
+        if running:
+            future.then(functools.partial(self.__handle_child_done, future))
+        else:
+            # Group already failed or was cancelled - don't let it run.
+            future.cancel()
+        return future
+
+    def close(self):
+        "No more children will be added; finish once they are all done."
+        with self.lock:
+            self.closed = True
+            if not self.running or self.pending:
+                return
+            self.running = False
+        self.__finish()
+
+    def cancel(self):
+        "Cancel the group, and all its children that are still running."
+        FutureWrapper.cancel(self)
+        self.__cancel_children()
+
+    def __finish(self):
+        "Sets the group's value (called once, with running already False)."
+        values = []
+        for child in self.children:
+            if _is_canceled(child):
+                values.append(None)
+            else:
+                values.append(child.value())
+        self._resolve("setValue", values)
+
+    def __cancel_children(self):
+        "Cancels all children that aren't finished yet."
+        for child in self.children:
+            if not child.isFinished():
+                child.cancel()
+
+    def __handle_child_done(self, child, future):
+        "Internal callback for when one of the children is done."
+        error = None
+        if not _is_canceled(child):
+            try:
+                child.value()
+            except Exception as exception:
+                error = exception
+        with self.lock:
+            if not self.running:
+                return
+            if error is None:
+                self.pending -= 1
+                if self.pending or not self.closed:
+                    return
+                self.running = False
+            else:
+                self._exception = error
+                self.running = False
+        if error is None:
+            self.__finish()
+        else:
+            # Cancel first, so that whoever waits for us sees them stopped.
+            self.__cancel_children()
+            self._resolve("setError", str(error))
+
+    def __handle_finished(self, future):
+        "Callback for when our future finished for any reason."
+        if self.running:
+            # promise was directly finished by someone else - cancel all!
+            self.running = False
+        self.__cancel_children()
+
+
+CHANNEL_CLOSED = "Channel closed"
+
+class _ChannelFuture(FutureWrapper):
+    "Future for a pending Channel.put() or Channel.get()."
+    __slots__ = ()
+
+    def try_set(self, value):
+        "Finishes the future, unless it was cancelled; returns success."
+        if self._resolve("setValue", value):
+            self.running = False
+            return True
+        return False
+
+    def try_close(self):
+        "Fails the future because the channel was closed."
+        if self._resolve("setError", CHANNEL_CLOSED):
+            self._exception = RuntimeError(CHANNEL_CLOSED)
+            self.running = False
+
+class Channel(object):
+    """Bounded queue for passing values between coroutines.
+
+    put() and get() return futures that can be yielded in an async_generator,
+    so neither side ever blocks a thread: put() finishes when the value has
+    been accepted (immediately if there is room in the buffer), get() when a
+    value is available. Cancelling a pending put() or get() withdraws it.
+
+    After close(), put() fails, and get() fails once the buffer is empty,
+    with a RuntimeError(CHANNEL_CLOSED). Values go through qi promises, so
+    they must be types qi can convert.
+
+    @stk.coroutines.async_generator
+    def produce(channel):
+        for i in range(10):
+            yield channel.put(i)
+        channel.close()
+
+    @stk.coroutines.async_generator
+    def consume(channel):
+        yield channel.for_each(self.process)
+    """
+    def __init__(self, capacity=1):
+        self.capacity = capacity
+        self.buffer = collections.deque()
+        self.getters = collections.deque()
+        self.putters = collections.deque() # (future, value) pairs
+        self.closed = False
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        "Number of values waiting in the buffer."
+        return len(self.buffer)
+
+    def put(self, value):
+        "Returns a future that finishes once the value is in the channel."
+        future = _ChannelFuture()
+        with self.lock:
+            if self.closed:
+                future.try_close()
+                return future
+            while self.getters:
+                if self.getters.popleft().try_set(value):
+                    future.try_set(None)
+                    return future
+            if len(self.buffer) < self.capacity:
+                self.buffer.append(value)
+                future.try_set(None)
+            else:
+                self.putters.append((future, value))
+        return future
+
+    def get(self):
+        "Returns a future that finishes with the next value of the channel."
+        future = _ChannelFuture()
+        with self.lock:
+            if self.buffer:
+                future.try_set(self.buffer.popleft())
+                self.__accept_putters()
+            elif self.__take_from_putter(future):
+                pass
+            elif self.closed:
+                future.try_close()
+            else:
+                self.getters.append(future)
+        return future
+
+    def close(self):
+        """Closes the channel; values already in the buffer can still be read.
+
+        Pending get() and put() calls fail."""
+        with self.lock:
+            self.closed = True
+            while self.getters:
+                self.getters.popleft().try_close()
+            while self.putters:
+                self.putters.popleft()[0].try_close()
+
+    def is_closed(self):
+        "Was the channel closed?"
+        return self.closed
+
+    def is_drained(self):
+        "Was the channel closed, with no values left to read?"
+        with self.lock:
+            return self.closed and not self.buffer
+
+    @async_generator
+    def for_each(self, callback):
+        """Calls callback on each value, until the channel is closed and empty.
+
+        If the callback returns a future, it is waited for before getting the
+        next value (so a slow consumer slows down the producers); other return
+        values are ignored."""
+        while True:
+            try:
+                value = yield self.get()
+            except RuntimeError:
+                if self.is_drained():
+                    break
+                raise
+            result = callback(value)
+            if hasattr(result, "then"):
+                yield result
+
+    @async_generator
+    def put_all(self, values, close=False):
+        "Puts all the values in the channel, and optionally closes it."
+        for value in values:
+            yield self.put(value)
+        if close:
+            self.close()
+
+    def __accept_putters(self):
+        "Moves values of waiting putters into the buffer, if there is room."
+        while self.putters and len(self.buffer) < self.capacity:
+            future, value = self.putters.popleft()
+            if future.try_set(None):
+                self.buffer.append(value)
+
+    def __take_from_putter(self, future):
+        "Directly hands a waiting putter's value to future (no buffer room)."
+        while self.putters:
+            putter, value = self.putters.popleft()
+            if putter.try_set(None):
+                future.try_set(value)
+                return True
+        return False
@@ -11,6 +11,9 @@ __copyright__ = "Copyright 2015, Aldebaran Robotics"
 __author__ = 'ekroeger'
 __email__ = 'ekroeger@aldebaran.com'
 
+import itertools
+import threading
+
 import qi
 
 
@@ -46,9 +49,15 @@ class EventHelper(object):
         if session:
             self.init(session)
         self.handlers = {}  # a handler is (subscriber, connections)
+        self.links = {}  # (event, connection id): (signal link id, callback)
+        self.own_ids = itertools.count(-1, -1)  # see connect
+        self.lock = threading.Lock()  # for handlers and links
+        self.counting = False
+        self.event_counts = {}  # event: number of callbacks run
         self.subscriber_names = {}
         self.wait_value = None
         self.wait_promise = None
+        self.wait_lock = threading.Lock()
 
     def init(self, session):
         "Sets the NAOqi session, if it wasn't passed to the constructor"
@@ -69,21 +78,91 @@ class EventHelper(object):
         Note that some events trigger side effects in services when someone
         subscribes to them (such as WordRecognized). Those will *not* be
         triggered by this function, for those, use .subscribe().
+
+        Returns the signal's link id, that stays valid (for .disconnect)
+        after .reconnect(); if a reconnection gave that id to another
+        connection, a negative id is returned instead.
         """
-        if event not in self.handlers:
+        signal, connections = self._get_handler(event)
+        link_id = signal.connect(self._wrap(event, callback))
+        with self.lock:
+            connection_id = link_id
+            if (event, connection_id) in self.links:
+                connection_id = next(self.own_ids)
+            self.links[(event, connection_id)] = (link_id, callback)
+            connections.append(connection_id)
+        return connection_id
+
+    def enable_counting(self):
+        """Starts counting the callbacks run for each event (see .stats()).
+
+        Off by default, as it costs a little on each callback; stk.runner's
+        stats service enables it."""
+        with self.lock:
+            if self.counting:
+                return
+            self.counting = True
+            connected = [(event, signal, connection_id)
+                         for event, (signal, connections)
+                         in self.handlers.items()
+                         for connection_id in connections]
+        for event, signal, connection_id in connected:
+            with self.lock:
+                link = self.links.get((event, connection_id))
+            if link is None:
+                continue  # disconnected in the meantime
+            new_link_id = signal.connect(self._counted(event, link[1]))
+            with self.lock:
+                if (event, connection_id) in self.links:
+                    self.links[(event, connection_id)] = (new_link_id,
+                                                          link[1])
+                else:
+                    link = (new_link_id, None)
+            signal.disconnect(link[0])
+
+    def _wrap(self, event, callback):
+        "Returns what to connect to the signal for callback."
+        if self.counting:
+            return self._counted(event, callback)
+        return callback
+
+    def _counted(self, event, callback):
+        "Wraps callback so that it increments the event's count."
+        counts = self.event_counts
+        def counted_callback(*args):
+            "Counts the call (approximately: no lock), and calls callback."
+            counts[event] += 1
+            return callback(*args)
+        return counted_callback
+
+    def stats(self):
+        """Returns a dictionary about each connected event.
+
+        Each value is a dictionary with the number of connections and of
+        callbacks run so far ("calls", only counted after
+        .enable_counting())."""
+        with self.lock:
+            return dict((event, {"connections": len(connections),
+                                 "calls": self.event_counts.get(event, 0)})
+                        for event, (_, connections) in self.handlers.items())
+
+    def _get_handler(self, event):
+        "Returns the (signal, connections) handler for event, creating it."
+        with self.lock:
+            handler = self.handlers.get(event)
+        if handler is None:
             if "." in event:
                 # if we have more than one ".":
                 service_name, signal_name = event.split(".")
                 service = self.session.service(service_name)
-                self.handlers[event] = (getattr(service, signal_name), [])
+                signal = getattr(service, signal_name)
             else:
                 # It's a "normal" ALMemory event.
-                self.handlers[event] = (
-                    self.almemory.subscriber(event).signal, [])
-        signal, connections = self.handlers[event]
-        connection_id = signal.connect(callback)
-        connections.append(connection_id)
-        return connection_id
+                signal = self.almemory.subscriber(event).signal
+            with self.lock:
+                self.event_counts.setdefault(event, 0)
+                handler = self.handlers.setdefault(event, (signal, []))
+        return handler
 
     def subscribe(self, event, attachedname, callback):
         """Subscribes to an ALMemory event so as to notify providers.
@@ -97,27 +176,54 @@ class EventHelper(object):
 
     def disconnect(self, event, connection_id=None):
         "Disconnects a connection, or all if no connection is specified."
-        if event in self.handlers:
+        with self.lock:
+            if event not in self.handlers:
+                return
             signal, connections = self.handlers[event]
-            if connection_id:
-                if connection_id in connections:
-                    signal.disconnect(connection_id)
-                    connections.remove(connection_id)
-            else:
+            if connection_id is None:
                 # Didn't specify a connection ID: remove all
-                for connection_id in connections:
-                    signal.disconnect(connection_id)
-                del connections[:]
-            if event in self.subscriber_names:
-                name = self.subscriber_names[event]
-                self.almemory.unsubscribeToEvent(event, name)
-                del self.subscriber_names[event]
+                removed = list(connections)
+            elif connection_id in connections:
+                removed = [connection_id]
+            else:
+                removed = []
+            link_ids = []
+            for removed_id in removed:
+                connections.remove(removed_id)
+                link_ids.append(self.links.pop((event, removed_id))[0])
+        for link_id in link_ids:
+            signal.disconnect(link_id)
+        if event in self.subscriber_names:
+            name = self.subscriber_names[event]
+            self.almemory.unsubscribeToEvent(event, name)
+            del self.subscriber_names[event]
 
     def clear(self):
         "Disconnect all connections"
         for event in list(self.handlers):
             self.disconnect(event)
 
+    def reconnect(self):
+        """Re-establishes all connections and subscriptions.
+
+        To be called when the session was reconnected (e.g. after NAOqi
+        restarted); the old signals are dead. Connection ids stay the same."""
+        self.almemory = self.session.service("ALMemory")
+        with self.lock:
+            old_handlers = self.handlers
+            self.handlers = {}
+        for event, (_, connections) in old_handlers.items():
+            signal, new_connections = self._get_handler(event)
+            for connection_id in connections:
+                callback = self.links[(event, connection_id)][1]
+                link_id = signal.connect(self._wrap(event, callback))
+                with self.lock:
+                    self.links[(event, connection_id)] = (link_id, callback)
+                    new_connections.append(connection_id)
+        for event, name in self.subscriber_names.items():
+            self.almemory.subscribeToEvent(event, name,
+                                           "on_" + event.replace("/", ""))
+
     def get(self, key):
         "Gets ALMemory value."
         return self.almemory.getData(key)
@@ -144,23 +250,29 @@ class EventHelper(object):
         except RuntimeError:
             pass
 
+    def _take_wait_promise(self):
+        "Internal - returns the promise of the current wait, and forgets it."
+        with self.wait_lock:
+            promise, self.wait_promise = self.wait_promise, None
+        return promise
+
     def _on_wait_event(self, value):
         "Internal - callback for an event."
-        if self.wait_promise:
-            self.wait_promise.setValue(value)
-            self.wait_promise = None
+        promise = self._take_wait_promise()
+        if promise:
+            promise.setValue(value)
 
     def _on_wait_signal(self, *args):
         "Internal - callback for a signal."
-        if self.wait_promise:
-            self.wait_promise.setValue(args)
-            self.wait_promise = None
+        promise = self._take_wait_promise()
+        if promise:
+            promise.setValue(args)
 
     def cancel_wait(self):
         "Cancel the current wait (raises an exception in the waiting thread)"
-        if self.wait_promise:
-            self.wait_promise.setCanceled()
-            self.wait_promise = None
+        promise = self._take_wait_promise()
+        if promise:
+            promise.setCanceled()
 
     def wait_for(self, event, subscribe=False):
         """Block until a certain event is raised, and returns it's value.
@@ -170,10 +282,12 @@ class EventHelper(object):
 
         This will block a thread so you should avoid doing this too often!
         """
-        if self.wait_promise:
+        promise = qi.Promise()
+        with self.wait_lock:
+            old_promise, self.wait_promise = self.wait_promise, promise
+        if old_promise:
             # there was already a wait in progress, cancel it!
-            self.wait_promise.setCanceled()
-        self.wait_promise = qi.Promise()
+            old_promise.setCanceled()
         if subscribe:
             connection_id = self.subscribe(event, "EVENTHELPER",
                                            self._on_wait_event)
@@ -182,7 +296,7 @@ class EventHelper(object):
         else:
             connection_id = self.connect(event, self._on_wait_event)
         try:
-            result = self.wait_promise.future().value()
+            result = promise.future().value()
         finally:
             self.disconnect(event, connection_id)
         return result
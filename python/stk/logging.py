@@ -10,40 +10,532 @@ __copyright__ = "Copyright 2015, Aldebaran Robotics"
 __author__ = 'ekroeger'
 __email__ = 'ekroeger@aldebaran.com'
 
+import atexit
+import collections
 import functools
+import inspect
+import random
+import sys
+import thread
+import threading
+import time
 import traceback
+import weakref
+import Queue
 
 import qi
 
 
-def get_logger(session, app_id):
-    """Returns a qi logger object."""
+class LogPipeline(object):
+    """Background worker that formats log records and forwards them.
+
+    Callers only enqueue records (without formatting them); a worker thread
+    formats them and sends them to their logger in batches. The queue is
+    bounded: when it is full, records are dropped (and counted in .dropped)
+    rather than making the caller wait.
+    """
+    def __init__(self, max_queue_size=10000, batch_size=100):
+        self.queue = Queue.Queue(max_queue_size)
+        self.batch_size = batch_size
+        self.dropped = 0
+        self.forwarded = 0
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        "Starts the worker thread, if it isn't already running."
+        with self.lock:
+            if not self.thread:
+                self.thread = threading.Thread(target=self._run,
+                                               name="stk.logging")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def enqueue(self, logger, level, message, args=(), exc_info=None):
+        "Adds a record to the queue, or drops it if the queue is full."
+        try:
+            self.queue.put_nowait((logger, level, message, args, exc_info))
+        except Queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=1.0):
+        """Waits until the records enqueued so far have been forwarded.
+
+        Returns False if this didn't happen within timeout seconds."""
+        if not self.thread:
+            return self.queue.empty()
+        marker = threading.Event()
+        try:
+            self.queue.put(marker, timeout=timeout)
+        except Queue.Full:
+            return False
+        marker.wait(timeout)
+        return marker.is_set()
+
+    def stop(self, timeout=1.0):
+        "Flushes the queue, and stops the worker thread."
+        if self.thread:
+            self.flush(timeout)
+            self.queue.put(None)
+            self.thread.join(timeout)
+            self.thread = None
+
+    def _run(self):
+        "Worker thread: forward records in batches until stopped."
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            for record in batch:
+                if record is None:
+                    return
+                elif isinstance(record, tuple):
+                    self._forward(*record)
+                else:
+                    # flush() marker
+                    record.set()
+
+    def _forward(self, logger, level, message, args, exc_info):
+        "Formats a record, and sends it to its logger."
+        try:
+            if args:
+                message = message % args
+            if exc_info:
+                formatted = "".join(traceback.format_exception(*exc_info))
+                message = message + "\n" + formatted if message else formatted
+            getattr(logger, level)(message)
+            self.forwarded += 1
+        except Exception:
+            # Never let a bad record kill the worker.
+            self.dropped += 1
+
+
+_PIPELINE = None
+
+
+def get_pipeline():
+    "Returns the shared LogPipeline (started, and flushed at exit)."
+    global _PIPELINE
+    if _PIPELINE is None:
+        _PIPELINE = LogPipeline()
+        atexit.register(_PIPELINE.stop)
+    _PIPELINE.start()
+    return _PIPELINE
+
+
+class QueuedLogger(object):
+    """Logger that hands its records to a LogPipeline instead of logging.
+
+    Has the same methods as a qi logger, plus exception(), and accepts
+    %-style arguments that are only formatted by the pipeline's worker.
+    """
+    def __init__(self, logger, pipeline=None):
+        self.logger = logger
+        self.pipeline = pipeline or get_pipeline()
+
+    def fatal(self, message, *args):
+        "Logs a fatal message."
+        self.pipeline.enqueue(self.logger, "fatal", message, args)
+
+    def error(self, message, *args):
+        "Logs an error message."
+        self.pipeline.enqueue(self.logger, "error", message, args)
+
+    def warning(self, message, *args):
+        "Logs a warning message."
+        self.pipeline.enqueue(self.logger, "warning", message, args)
+
+    def info(self, message, *args):
+        "Logs an info message."
+        self.pipeline.enqueue(self.logger, "info", message, args)
+
+    def verbose(self, message, *args):
+        "Logs a verbose message."
+        self.pipeline.enqueue(self.logger, "verbose", message, args)
+
+    def exception(self, message="", *args):
+        """Logs message and the exception being handled, as an error.
+
+        The traceback is formatted by the worker, not the calling thread."""
+        self.pipeline.enqueue(self.logger, "error", message, args,
+                              sys.exc_info())
+
+
+def _format(message, args):
+    "Applies %-style args to message, if there are any."
+    return message % args if args else message
+
+
+class FlightRecorder(object):
+    """Fixed-size ring buffer of recent log records.
+
+    Recording only appends a tuple (messages are formatted when dumping), so
+    it's cheap enough to keep debug logs of the recent past without sending
+    them anywhere, and dump them when something goes wrong.
+    """
+    def __init__(self, capacity=1000):
+        self.records = collections.deque(maxlen=capacity)
+
+    def record(self, level, message, args=()):
+        "Adds a record (oldest records are dropped when full)."
+        self.records.append((time.time(), thread.get_ident(), level, message,
+                             args))
+
+    def take(self):
+        "Removes and returns all the records, oldest first."
+        records = []
+        try:
+            while True:
+                records.append(self.records.popleft())
+        except IndexError:
+            pass
+        return records
+
+    def format(self, records=None):
+        "Returns the (recorded) messages as text, oldest first."
+        lines = []
+        if records is None:
+            records = list(self.records)
+        for timestamp, thread_id, level, message, args in records:
+            try:
+                if args:
+                    message = message % args
+            except Exception:
+                message = "%s %% %r" % (message, args)
+            lines.append("%s.%03d [%s] %x %s" % (
+                time.strftime("%H:%M:%S", time.localtime(timestamp)),
+                int(timestamp * 1000) % 1000, level[0].upper(), thread_id,
+                message))
+        return "\n".join(lines)
+
+    def dump(self, logger=None, filename=None, clear=False):
+        """Writes the recorded messages to a logger and/or appends to a file.
+
+        If clear is True, they are removed from the recorder (so that the
+        next dump only has the newer ones). Returns the formatted text."""
+        records = self.take() if clear else list(self.records)
+        text = self.format(records)
+        if logger:
+            logger.info("Flight recorder (%d records):\n%s"
+                        % (len(records), text))
+        if filename:
+            with open(filename, "a") as dump_file:
+                dump_file.write(text + "\n")
+        return text
+
+    def clear(self):
+        "Forgets all the records."
+        self.records.clear()
+
+
+class RecordingLogger(object):
+    """Logger that keeps all messages in a FlightRecorder.
+
+    debug() and verbose() messages are only recorded (unless forward_debug is
+    True); other levels are also sent to the wrapped logger. When an
+    exception is logged through log_exceptions, if dump_on_error is True, the
+    messages recorded since the previous dump are dumped to the wrapped
+    logger (and to dump_filename, if set), at most once every dump_interval
+    seconds (the records are kept for the next dump meanwhile).
+    """
+    def __init__(self, logger, recorder=None, forward_debug=False,
+                 dump_on_error=True, dump_filename=None, dump_interval=10.0):
+        self.logger = logger
+        self.recorder = recorder or FlightRecorder()
+        self.forward_debug = forward_debug
+        self.dump_on_error = dump_on_error
+        self.dump_filename = dump_filename
+        self.dump_interval = dump_interval
+        self.last_dump = None
+
+    def _log(self, level, message, args, forward=True):
+        "Records a message, and sends it to the wrapped logger if forward."
+        self.recorder.record(level, message, args)
+        if forward:
+            if isinstance(self.logger, QueuedLogger):
+                # Let the pipeline format it
+                getattr(self.logger, level)(message, *args)
+            else:
+                getattr(self.logger, level)(_format(message, args))
+
+    def debug(self, message, *args):
+        "Records a debug message."
+        self._log("verbose", message, args, self.forward_debug)
+
+    def verbose(self, message, *args):
+        "Records a verbose message."
+        self._log("verbose", message, args, self.forward_debug)
+
+    def info(self, message, *args):
+        "Records and logs an info message."
+        self._log("info", message, args)
+
+    def warning(self, message, *args):
+        "Records and logs a warning message."
+        self._log("warning", message, args)
+
+    def error(self, message, *args):
+        "Records and logs an error message."
+        self._log("error", message, args)
+
+    def fatal(self, message, *args):
+        "Records and logs a fatal message."
+        self._log("fatal", message, args)
+
+    def exception(self, message=""):
+        "Logs the exception being handled, and dumps the flight recorder."
+        if self.dump_on_error:
+            now = time.time()
+            if self.last_dump is None or \
+                    now - self.last_dump >= self.dump_interval:
+                self.last_dump = now
+                self.dump()
+        exc_info = sys.exc_info()
+        self.recorder.record("error", "%s: %s", exc_info[:2])
+        if isinstance(self.logger, QueuedLogger):
+            self.logger.exception(message)
+        else:
+            formatted = traceback.format_exc()
+            self.logger.error(message + "\n" + formatted if message
+                              else formatted)
+
+    def dump(self):
+        """Dumps the messages recorded since the last dump to the wrapped
+        logger (and file, if set)."""
+        return self.recorder.dump(self.logger, self.dump_filename, clear=True)
+
+
+# LogProvider registered for each session (that is still alive)
+_PROVIDERS = weakref.WeakKeyDictionary()
+_PROVIDERS_LOCK = threading.Lock()
+
+
+def _register_provider(session):
+    """Registers a LogProvider on the session's LogManager, once per session.
+
+    Returns None if it couldn't be registered (it will be tried again next
+    time)."""
+    with _PROVIDERS_LOCK:
+        provider = _PROVIDERS.get(session)
+        if provider is not None:
+            return provider
+        try:
+            qicore = qi.module("qicore")
+            log_manager = session.service("LogManager")
+            provider = qicore.createObject("LogProvider", log_manager)
+            log_manager.addProvider(provider)
+        except RuntimeError:
+            # no qicore, we're not running on a robot, it doesn't matter
+            pass
+        except AttributeError:
+            # old version of NAOqi - logging will probably not work.
+            pass
+        if provider is not None:
+            _PROVIDERS[session] = provider
+        return provider
+
+
+def reregister_provider(session):
+    """Registers the LogProvider again, if one was registered for session.
+
+    To be called when the session was reconnected: the old provider belonged
+    to the LogManager of the previous connection. Returns the new provider,
+    or None."""
+    with _PROVIDERS_LOCK:
+        if _PROVIDERS.pop(session, None) is None:
+            return None
+    return _register_provider(session)
+
+
+def get_logger(session, app_id, queued=False, recorded=False):
+    """Returns a qi logger object.
+
+    The LogProvider forwarding logs to the robot is only registered the first
+    time this is called for a session, so it's cheap to call this for each
+    component (see also get_child_logger).
+
+    If queued is True, the logger only enqueues records, that are formatted
+    and sent by a background thread (see QueuedLogger).
+
+    If recorded is True, the logger also keeps recent messages (including
+    debug ones) in a flight recorder (see RecordingLogger)."""
+    _register_provider(session)
     logger = qi.logging.Logger(app_id)
-    try:
-        qicore = qi.module("qicore")
-        log_manager = session.service("LogManager")
-        provider = qicore.createObject("LogProvider", log_manager)
-        log_manager.addProvider(provider)
-    except RuntimeError:
-        # no qicore, we're not running on a robot, it doesn't matter
-        pass
-    except AttributeError:
-        # old version of NAOqi - logging will probably not work.
-        pass
+    if queued:
+        logger = QueuedLogger(logger)
+    if recorded:
+        logger = RecordingLogger(logger)
     return logger
 
 
+def get_child_logger(session, app_id, name, queued=False, recorded=False):
+    """Returns a logger for a component of an app, named "app_id.name".
+
+    It shares the session's LogProvider with the app's logger."""
+    return get_logger(session, "%s.%s" % (app_id, name), queued, recorded)
+
+
+class ExceptionThrottle(object):
+    """Rate limiter for logging exceptions.
+
+    Exceptions are grouped by key (type and raise site); for each group, at
+    most max_count are logged per period (in seconds), None meaning no
+    limit. At the end of a period in which some were suppressed, their
+    number is logged as a warning, on the logger of the last one.
+    """
+    def __init__(self, max_count=None, period=10.0):
+        self.max_count = max_count
+        self.period = period
+        # key: [period start, logged count, suppressed count, logger]
+        self.groups = {}
+        self.lock = threading.Lock()
+
+    def check(self, key, logger=None):
+        """Should an exception of this group be logged now?
+
+        Returns a (should_log, suppressed) tuple, suppressed being the number
+        of exceptions of this group suppressed and not yet reported."""
+        if self.max_count is None:
+            return True, 0
+        now = time.time()
+        with self.lock:
+            group = self.groups.get(key)
+            if group is None or now - group[0] >= self.period:
+                suppressed = group[2] if group else 0
+                self.groups[key] = [now, 1, 0, None]
+                return True, suppressed
+            elif group[1] < self.max_count:
+                group[1] += 1
+                return True, 0
+            group[2] += 1
+            group[3] = logger
+            if group[2] == 1:
+                # Report them at the end of the period
+                timer = threading.Timer(group[0] + self.period - now,
+                                        self.flush, (key,))
+                timer.daemon = True
+                timer.start()
+            return False, 0
+
+    def flush(self, key=None):
+        "Logs the number of suppressed exceptions of a group (or all)."
+        reports = []
+        with self.lock:
+            for group_key in [key] if key is not None else list(self.groups):
+                group = self.groups.get(group_key)
+                if group and group[2]:
+                    reports.append((group_key, group[2], group[3]))
+                    group[2] = 0
+        for group_key, suppressed, logger in reports:
+            if logger:
+                logger.warning("(%d more suppressed) %s" % (
+                    suppressed, _describe_group(group_key)))
+
+
+def _describe_group(key):
+    "Describes a group of exceptions (see _raise_site)."
+    try:
+        exc_type, filename, lineno = key
+        return "%s raised at %s:%d" % (exc_type.__name__, filename, lineno)
+    except (TypeError, ValueError, AttributeError):
+        return str(key)
+
+
+_THROTTLE = ExceptionThrottle()
+
+
+def set_exception_rate_limit(max_count, period=10.0):
+    """Configures how many exceptions log_exceptions decorators log.
+
+    At most max_count exceptions of the same type and raise site are logged
+    every period seconds; None (the default) disables the limit."""
+    _THROTTLE.max_count = max_count
+    _THROTTLE.period = period
+
+
+def _raise_site(exc_type, exc_traceback):
+    "Returns a key identifying where (and what) exception was raised."
+    while exc_traceback.tb_next:
+        exc_traceback = exc_traceback.tb_next
+    return (exc_type, exc_traceback.tb_frame.f_code.co_filename,
+            exc_traceback.tb_lineno)
+
+
+def _log_current_exception(logger):
+    """Logs the exception being handled (in the background if possible).
+
+    Repeated exceptions can be rate-limited (see set_exception_rate_limit),
+    and the traceback isn't even formatted for those that are suppressed."""
+    exc_type, _, exc_traceback = sys.exc_info()
+    should_log, suppressed = _THROTTLE.check(
+        _raise_site(exc_type, exc_traceback), logger)
+    if not should_log:
+        return
+    message = ""
+    if suppressed:
+        message = "(%d more suppressed)" % suppressed
+    if isinstance(logger, (QueuedLogger, RecordingLogger)):
+        logger.exception(message)
+    else:
+        logger.error(message + "\n" + traceback.format_exc() if message
+                     else traceback.format_exc())
+
+
+_RERAISE = object()
+
+
+def _log_generator_exceptions(obj, generator, default_value=_RERAISE):
+    """Runs generator (for async_generator), logging its exceptions.
+
+    If default_value is given, stop with it (as a stk.coroutines.Return)
+    instead of raising the exception."""
+    value, exception = None, None
+    while True:
+        try:
+            if exception is not None:
+                future = generator.throw(exception)
+            else:
+                future = generator.send(value)
+        except StopIteration:
+            return
+        except Exception:
+            _log_current_exception(obj.logger)
+            if default_value is _RERAISE:
+                raise
+            from stk.coroutines import Return
+            yield Return(default_value)
+            return
+        try:
+            value, exception = (yield future), None
+        except GeneratorExit:
+            generator.close()
+            raise
+        except Exception as exc:
+            value, exception = None, exc
+
+
 def log_exceptions(func):
     """Catches all exceptions in decorated method, and prints them.
 
-    Attached function must be on an object with a "logger" member.
+    Attached function must be on an object with a "logger" member. Also works
+    on generator functions decorated with stk.coroutines.async_generator
+    (put @log_exceptions under @async_generator).
     """
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def wrapped_generator(self, *args, **kwargs):
+            return _log_generator_exceptions(self, func(self, *args, **kwargs))
+        return wrapped_generator
+
     @functools.wraps(func)
-    def wrapped(self, *args):
+    def wrapped(self, *args, **kwargs):
         try:
-            return func(self, *args)
+            return func(self, *args, **kwargs)
         except Exception as exc:
-            self.logger.error(traceback.format_exc())
+            _log_current_exception(self.logger)
             raise exc
     return wrapped
 
@@ -51,15 +543,217 @@ def log_exceptions(func):
 def log_exceptions_and_return(default_value):
     """If an exception occurs, print it and return default_value.
 
-    Attached function must be on an object with a "logger" member.
+    Attached function must be on an object with a "logger" member. Also works
+    on generator functions decorated with stk.coroutines.async_generator.
     """
     def decorator(func):
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def wrapped_generator(self, *args, **kwargs):
+                return _log_generator_exceptions(
+                    self, func(self, *args, **kwargs), default_value)
+            return wrapped_generator
+
         @functools.wraps(func)
-        def wrapped(self, *args):
+        def wrapped(self, *args, **kwargs):
             try:
-                return func(self, *args)
+                return func(self, *args, **kwargs)
             except Exception:
-                self.logger.error(traceback.format_exc())
+                _log_current_exception(self.logger)
                 return default_value
         return wrapped
     return decorator
+
+
+class TimingStats(object):
+    """Latency statistics for a function, in fixed memory.
+
+    Keeps the count, total and max duration, and a uniform random sample of
+    at most sample_size durations (reservoir sampling), from which the
+    percentiles are estimated. seed seeds the sampling's own random
+    generator (for reproducible samples).
+    """
+    def __init__(self, name, sample_size=1024, seed=None):
+        self.name = name
+        self.sample_size = sample_size
+        self.random = random.Random(seed)
+        self.samples = []
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.slow_count = 0
+        self.lock = threading.Lock()
+
+    def add(self, duration, slow=False):
+        "Records the duration (in seconds) of a call, that was slow or not."
+        with self.lock:
+            self.count += 1
+            if slow:
+                self.slow_count += 1
+            self.total += duration
+            self.max = max(self.max, duration)
+            if len(self.samples) < self.sample_size:
+                self.samples.append(duration)
+            else:
+                index = self.random.randint(0, self.count - 1)
+                if index < self.sample_size:
+                    self.samples[index] = duration
+
+    def percentile(self, percent):
+        "Returns the estimated duration below which percent% of calls are."
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return 0.0
+        index = int(round(percent / 100.0 * (len(samples) - 1)))
+        return samples[index]
+
+    def summary(self):
+        "Returns the statistics as a dictionary (durations in seconds)."
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "slow_count": self.slow_count,
+        }
+
+
+_TIMINGS = {}  # unique name: TimingStats
+_TIMINGS_LOCK = threading.Lock()
+
+
+def get_timing_stats(name=None):
+    """Returns the TimingStats of a function decorated with log_timing.
+
+    name is "module.Class.method" ("module.function" for functions), with
+    "#2", "#3"... for the next functions with the same name in a module; if
+    it's not given, returns a dictionary of the summaries of all decorated
+    functions."""
+    if name:
+        return _TIMINGS.get(name)
+    with _TIMINGS_LOCK:
+        timings = list(_TIMINGS.values())
+    return dict((stats.name, stats.summary()) for stats in timings)
+
+
+def _get_qualified_name(func, frame):
+    """Returns "module.Class.method" for a method being decorated in a class
+    body (frame being the body's), and "module.function" otherwise."""
+    qualname = getattr(func, "__qualname__", None)
+    if qualname is None:
+        qualname = func.__name__
+        if frame is not None and "__module__" in frame.f_locals:
+            qualname = "%s.%s" % (frame.f_code.co_name, qualname)
+    return "%s.%s" % (func.__module__, qualname)
+
+
+def _get_stats(func, frame=None):
+    """Returns new TimingStats for a function being decorated.
+
+    Each function has its own, even if another one has the same name (e.g.
+    same-named classes in a module): those get a "#2", "#3"... suffix."""
+    base_name = name = _get_qualified_name(func, frame)
+    with _TIMINGS_LOCK:
+        index = 1
+        while name in _TIMINGS:
+            index += 1
+            name = "%s#%d" % (base_name, index)
+        _TIMINGS[name] = TimingStats(name)
+        return _TIMINGS[name]
+
+
+def _record_timing(stats, obj, start, slow_threshold):
+    "Records a call that started at start; logs it if it was slow."
+    duration = time.time() - start
+    slow = slow_threshold is not None and duration > slow_threshold
+    stats.add(duration, slow)
+    if slow:
+        logger = getattr(obj, "logger", None)
+        if logger:
+            logger.warning("Slow call: %s took %.3f s" % (stats.name,
+                                                          duration))
+
+
+def _time_generator(stats, obj, generator, slow_threshold):
+    """Runs generator (for async_generator), timing it from start to finish.
+
+    (If it's cancelled, it's only timed when the generator is collected.)"""
+    from stk.coroutines import Return
+    start = time.time()
+    value, exception = None, None
+    recorded = False
+    try:
+        while True:
+            try:
+                if exception is not None:
+                    future = generator.throw(exception)
+                else:
+                    future = generator.send(value)
+            except StopIteration:
+                return
+            if isinstance(future, Return):
+                # The coroutine finishes without resuming us: record now.
+                recorded = True
+                _record_timing(stats, obj, start, slow_threshold)
+                yield future
+                return
+            try:
+                value, exception = (yield future), None
+            except GeneratorExit:
+                generator.close()
+                raise
+            except Exception as exc:
+                value, exception = None, exc
+    finally:
+        if not recorded:
+            _record_timing(stats, obj, start, slow_threshold)
+
+
+def log_timing(func=None, slow_threshold=None):
+    """Records the duration of each call of the decorated method.
+
+    Usage: @log_timing, or @log_timing(slow_threshold=0.1) to also log a
+    warning (on the object's "logger" member, if any) when a call takes more
+    than that many seconds. Statistics (with p50, p95 and p99) can be read
+    with get_timing_stats().
+
+    Works on normal methods and @on event callbacks. If the method returns a
+    future (e.g. it's decorated with @stk.coroutines.async_generator, under
+    this), the call lasts until the future is finished (or cancelled). On
+    coroutines, it can also be put under @stk.coroutines.async_generator.
+
+    Statistics are named "module.Class.method" (see get_timing_stats).
+    """
+    if func is None:
+        return functools.partial(log_timing, slow_threshold=slow_threshold)
+    # In a class body, that's the class's frame (partial has none)
+    stats = _get_stats(func, sys._getframe(1))
+
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def wrapped_generator(*args, **kwargs):
+            obj = args[0] if args else None
+            return _time_generator(stats, obj, func(*args, **kwargs),
+                                   slow_threshold)
+        return wrapped_generator
+
+    @functools.wraps(func)
+    def wrapped(*args, **kwargs):
+        obj = args[0] if args else None
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            _record_timing(stats, obj, start, slow_threshold)
+            raise
+        if hasattr(result, "addCallback") and result.isRunning():
+            # A future: the call lasts until it's finished.
+            result.addCallback(lambda future: _record_timing(
+                stats, obj, start, slow_threshold))
+        else:
+            _record_timing(stats, obj, start, slow_threshold)
+        return result
+    return wrapped
@@ -14,29 +14,61 @@ __copyright__ = "Copyright 2015, Aldebaran Robotics"
 __author__ = 'ekroeger'
 __email__ = 'ekroeger@aldebaran.com'
 
+import functools
+import os
+import re
 import sys
+import threading
+import time
+import types
+
 import qi
-from distutils.version import LooseVersion
 
 #
 # Helpers for making sure we have a robot to connect to
 #
 
+# Command-line parsers, by description (building one is surprisingly slow)
+_PARSERS = {}
+
 
 def check_commandline_args(description):
     "Checks whether command-line parameters are enough"
-    import argparse
-    parser = argparse.ArgumentParser(description=description)
-    parser.add_argument('--qi-url', help='connect to specific NAOqi instance')
-
-    args = parser.parse_args()
+    if description not in _PARSERS:
+        import argparse
+        parser = argparse.ArgumentParser(description=description)
+        parser.add_argument('--qi-url',
+                            help='connect to specific NAOqi instance')
+        _PARSERS[description] = parser
+    args = _PARSERS[description].parse_args()
     return args
 
 
+_QI_VERSION = []
+
+
+def get_qi_version():
+    """Returns the version of the qi module as a tuple of ints, or None.
+
+    (computed once; we don't import distutils just for comparing versions)"""
+    if not _QI_VERSION:
+        version = None
+        if hasattr(qi, "__version__"):
+            version = tuple(int(number) for number in
+                            re.findall(r"\d+", qi.__version__)[:3])
+        _QI_VERSION.append(version)
+    return _QI_VERSION[0]
+
+
+_ON_ROBOT = []
+
+
 def is_on_robot():
     "Returns whether this is being executed on an Aldebaran robot."
-    import platform
-    return "aldebaran" in platform.platform()
+    if not _ON_ROBOT:
+        import platform
+        _ON_ROBOT.append("aldebaran" in platform.platform())
+    return _ON_ROBOT[0]
 
 
 def get_debug_robot():
@@ -59,8 +91,11 @@ def get_debug_robot():
     return raw_input("connect to which robot? ")
 
 
-def init(qi_url=None):
-    "Returns a QiApplication object, possibly with interactive input."
+def init(qi_url=None, auto_exit=True):
+    """Returns a QiApplication object, possibly with interactive input.
+
+    With auto_exit=False, the application doesn't stop when the session is
+    disconnected (see run_activity's reconnect option)."""
     if qi_url:
         sys.argv.extend(["--qi-url", qi_url])
     else:
@@ -80,12 +115,14 @@ def init(qi_url=None):
     sys.argv[0] = str(sys.argv[0])
 
     # In versions bellow 2.3, look for --qi-url in the arguemnts and call accordingly the Application
-    if qi_url and hasattr(qi, "__version__") and LooseVersion(qi.__version__) < LooseVersion("2.3"):
-        qiapp = qi.Application(url="tcp://"+qi_url+":9559")
+    qi_version = get_qi_version()
+    options = {} if auto_exit else {"autoExit": False}
+    if qi_url and qi_version and qi_version < (2, 3):
+        qiapp = qi.Application(url="tcp://"+qi_url+":9559", **options)
     # In versions greater than 2.3 the ip can simply be passed through argv[0]
     else:
         # In some environments sys.argv[0] has unicode, which qi rejects
-        qiapp = qi.Application()
+        qiapp = qi.Application(**options)
 
     qiapp.start()
     return qiapp
@@ -93,53 +130,927 @@ def init(qi_url=None):
 
 # Main runner
 
-def run_activity(activity_class, service_name=None):
+def _report_error(instance, msg):
+    "Logs an error with the instance's logger if it has one, or prints it."
+    if hasattr(instance, "logger"):
+        instance.logger.error(msg)
+    else:
+        print msg
+
+
+# Worker processes, for CPU-heavy methods
+
+def in_worker_process(func):
+    """Decorator for service methods that should run in a worker process.
+
+    When the service is run with worker_processes > 0, calls to this method
+    are sent to a pool of worker processes (so they don't all compete for
+    the GIL), and the method returns a future.
+
+    The method runs in another process, so it is called with self=None: it
+    must only depend on its (picklable) arguments.
+    """
+    func.__worker_process__ = True
+    return func
+
+
+def _init_worker(started_pids=None):
+    """Initializer of worker processes: let the main process handle Ctrl-C,
+    and report our pid in the started_pids queue."""
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if started_pids is not None:
+        started_pids.put(os.getpid())
+
+
+def _ping_worker(_):
+    "Used to check a worker is up; returns its pid."
+    return os.getpid()
+
+
+def _run_in_worker(module_name, class_name, method_name, pickled_args):
+    """Runs a method marked with in_worker_process, in a worker process.
+
+    Arguments and result are pickled by us, so that failing to (un)pickle
+    them is reported like any other error. Returns (pid, duration, success,
+    pickled value or formatted exception)."""
+    import cPickle
+    start = time.time()
+    try:
+        __import__(module_name)
+        service_class = getattr(sys.modules[module_name], class_name)
+        func = getattr(service_class, method_name).__func__
+        value = func(None, *cPickle.loads(pickled_args))
+        result = (True, cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+    except Exception:
+        import traceback
+        result = (False, traceback.format_exc())
+    return (os.getpid(), time.time() - start) + result
+
+
+class _WorkerCall(object):
+    "A call sent to a WorkerPool."
+    __slots__ = ("promise", "result", "done")
+
+    def __init__(self, promise):
+        self.promise = promise
+        self.result = None  # multiprocessing's AsyncResult
+        self.done = False
+
+
+class WorkerPool(object):
+    """Pool of worker processes running methods marked in_worker_process.
+
+    The processes are started (and checked) when the pool is created, which
+    must be before qi starts its threads (forking a process with running qi
+    threads is not safe); run_service does that for you.
+
+    Every call's future finishes: with an error if its arguments or result
+    can't be pickled, and if a worker process dies, all the calls running
+    at that time fail (the pool can't tell which one that worker had).
+    """
+    def __init__(self, processes, check_interval=0.2):
+        import multiprocessing
+        self.processes = processes
+        self.started_pids = multiprocessing.Queue()
+        self.pool = multiprocessing.Pool(processes, _init_worker,
+                                         (self.started_pids,))
+        self.start_time = time.time()
+        self.pending = 0
+        self.calls = set()  # _WorkerCalls not finished yet
+        self.lock = threading.Lock()
+        self.workers = {}
+        self.terminated = False
+        # Warm start: wait until the workers answer.
+        self.known_pids = set()  # workers that were started
+        for pid in self.pool.map(_ping_worker, range(processes), 1):
+            self._worker_stats(pid)
+            self.known_pids.add(pid)
+        self.worker_pids = self._get_worker_pids()
+        self.check_interval = check_interval
+        self.watcher = threading.Thread(target=self._watch,
+                                        name="stk.runner.workers")
+        self.watcher.daemon = True
+        self.watcher.start()
+
+    def _worker_stats(self, pid):
+        "Returns (creating them if needed) the statistics of a worker."
+        if pid not in self.workers:
+            self.workers[pid] = {"calls": 0, "errors": 0, "busy_time": 0.0}
+        return self.workers[pid]
+
+    def call(self, service_class, method_name, args):
+        "Runs the method in a worker; returns a qi future of its result."
+        import cPickle
+        call = _WorkerCall(qi.Promise())
+        try:
+            pickled_args = cPickle.dumps(args, cPickle.HIGHEST_PROTOCOL)
+        except Exception as exc:
+            call.promise.setError("Can't send the arguments of %s to a "
+                                  "worker process: %s" % (method_name, exc))
+            return call.promise.future()
+        with self.lock:
+            if self.terminated:
+                raise RuntimeError("The worker processes were stopped")
+            self.pending += 1
+            self.calls.add(call)
+            call.result = self.pool.apply_async(
+                _run_in_worker,
+                (service_class.__module__, service_class.__name__,
+                 method_name, pickled_args),
+                callback=functools.partial(self._handle_result, call))
+        return call.promise.future()
+
+    def _handle_result(self, call, result):
+        "Callback for when a worker is done (called in a pool thread)."
+        import cPickle
+        pid, duration, success, value = result
+        if success:
+            try:
+                value = cPickle.loads(value)
+            except Exception as exc:
+                success, value = False, ("Can't read the result of a worker "
+                                         "process: %s" % exc)
+        if not self._set_done(call):
+            return
+        with self.lock:
+            stats = self._worker_stats(pid)
+            stats["calls"] += 1
+            stats["busy_time"] += duration
+            if not success:
+                stats["errors"] += 1
+        if success:
+            call.promise.setValue(value)
+        else:
+            call.promise.setError(value)
+
+    def _set_done(self, call):
+        "Marks a call as finished; returns False if it already was."
+        with self.lock:
+            if call.done:
+                return False
+            call.done = True
+            self.pending -= 1
+            self.calls.discard(call)
+            return True
+
+    def _fail(self, call, message):
+        "Finishes a call with an error (unless it's already finished)."
+        if self._set_done(call):
+            call.promise.setError(message)
+
+    def _get_worker_pids(self):
+        """Returns the pids of the live worker processes.
+
+        Workers report their pid when they start (see _init_worker), and
+        multiprocessing replaces dead workers (but loses their tasks)."""
+        import multiprocessing
+        import Queue
+        while True:
+            try:
+                self.known_pids.add(self.started_pids.get_nowait())
+            except Queue.Empty:
+                break
+        alive = set(process.pid
+                    for process in multiprocessing.active_children())
+        self.known_pids &= alive
+        return set(self.known_pids)
+
+    def _watch(self):
+        """Watcher thread: fails the calls that will never get a result
+        (because of a dead worker, or an error outside of the method)."""
+        while not self.terminated:
+            time.sleep(self.check_interval)
+            pids = self._get_worker_pids()
+            with self.lock:
+                died = bool(self.worker_pids - pids)
+                self.worker_pids = pids
+                calls = list(self.calls)
+            for call in calls:
+                if died:
+                    self._fail(call, "A worker process died during the call")
+                elif call.result.ready() and not call.result.successful():
+                    try:
+                        call.result.get(0)
+                    except Exception as exc:
+                        self._fail(call, "Error in a worker process: %s"
+                                   % exc)
+
+    def stats(self):
+        """Returns load metrics: the number of calls waiting or running, and
+        for each worker pid, its number of calls and errors, the time spent
+        running them, and its load (fraction of the time it was busy)."""
+        uptime = time.time() - self.start_time
+        with self.lock:
+            workers = dict((pid, dict(stats, load=stats["busy_time"] / uptime))
+                           for pid, stats in self.workers.items())
+            return {"pending": self.pending, "workers": workers}
+
+    def terminate(self):
+        "Stops the worker processes (calls still running fail)."
+        with self.lock:
+            self.terminated = True
+            calls = list(self.calls)
+        for call in calls:
+            self._fail(call, "The worker processes were stopped")
+        self.pool.terminate()
+        self.pool.join()
+
+
+def _forward_to_workers(instance, pool):
+    "Replaces the instance's in_worker_process methods by calls to the pool."
+    service_class = type(instance)
+    for name in dir(service_class):
+        method = getattr(service_class, name, None)
+        if getattr(method, "__worker_process__", False):
+            setattr(instance, name, types.MethodType(
+                _make_forwarder(pool, service_class, name, method.__func__),
+                instance))
+
+
+def _make_forwarder(pool, service_class, name, func):
+    "Returns a method sending calls of func to the pool."
+    @functools.wraps(func)
+    def forward(self, *args):
+        "Sends the call to a worker process."
+        return pool.call(service_class, name, args)
+    return forward
+
+
+# Lifecycle of activities
+
+class Lifecycle(object):
+    """Starts and stops an activity and its sub-components, with deadlines.
+
+    Sub-components are the objects in the activity's "components" attribute
+    (if any); like the activity, they may have on_start and on_stop methods.
+    All the on_start methods are called in parallel, and so are the on_stop
+    methods.
+
+    .ready is a future that is finished when all on_start calls returned (or
+    has an error if one failed, or didn't return within start_timeout
+    seconds); on_stop calls taking more than stop_timeout seconds are
+    abandoned. .timings has the duration of each phase, in seconds (for
+    components, keyed by "on_start:<index>:<class name>", the activity
+    being component 0).
+    """
+    def __init__(self, activity, start_timeout=None, stop_timeout=None):
+        self.activity = activity
+        self.components = [activity] + list(getattr(activity, "components",
+                                                    []))
+        self.start_timeout = start_timeout
+        self.stop_timeout = stop_timeout
+        self.ready_promise = qi.Promise()
+        self.ready = self.ready_promise.future()
+        self.is_ready = False
+        self.failed = False
+        self.pending = 0
+        self.start_time = None
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def expose(self):
+        "Adds waitReady() and isReady() methods to the activity."
+        def wait_ready(activity):
+            "Returns a future, finished when the service is ready."
+            return self.ready
+        def is_ready(activity):
+            "Has the service finished starting?"
+            return self.is_ready
+        # (unless the activity already has its own)
+        if not hasattr(self.activity, "waitReady"):
+            self.activity.waitReady = types.MethodType(wait_ready,
+                                                       self.activity)
+        if not hasattr(self.activity, "isReady"):
+            self.activity.isReady = types.MethodType(is_ready, self.activity)
+
+    def start(self, on_error):
+        """Calls all on_start methods in parallel.
+
+        on_error will be called (once) with a message if one fails, or if
+        they don't all finish in time."""
+        self.start_time = time.time()
+        startable = [(index, component)
+                     for index, component in enumerate(self.components)
+                     if hasattr(component, "on_start")]
+        self.pending = len(startable)
+        if not startable:
+            self._set_ready()
+            return
+        for index, component in startable:
+            qi.async(component.on_start).addCallback(functools.partial(
+                self._handle_started, index, component, on_error))
+        if self.start_timeout:
+            qi.async(self._check_start_deadline, on_error,
+                     delay=int(1000000 * self.start_timeout))
+
+    def _set_ready(self):
+        "All components are started."
+        self.timings["start"] = time.time() - self.start_time
+        self.is_ready = True
+        self.ready_promise.setValue(True)
+
+    def _fail(self, on_error, msg):
+        "Reports a start error, unless one was already reported."
+        with self.lock:
+            if self.failed or self.is_ready:
+                return
+            self.failed = True
+        self.ready_promise.setError(msg)
+        on_error(msg)
+
+    def _handle_started(self, index, component, on_error, on_start_future):
+        "Callback for when an on_start call is finished."
+        name = type(component).__name__
+        self.timings["on_start:%d:%s" % (index, name)] = \
+            time.time() - self.start_time
+        if on_start_future.hasError():
+            self._fail(on_error, "Error in %s.on_start(): %s"
+                       % (name, on_start_future.error()))
+            return
+        with self.lock:
+            self.pending -= 1
+            ready = not self.pending and not self.failed
+        if ready:
+            self._set_ready()
+
+    def _check_start_deadline(self, on_error):
+        "Called start_timeout seconds after start."
+        if not self.is_ready:
+            self._fail(on_error, "on_start() didn't finish within %s seconds"
+                       % self.start_timeout)
+
+    def stop(self):
+        """Calls all on_stop methods in parallel, and waits for them.
+
+        (but not more than stop_timeout seconds)"""
+        start_time = time.time()
+        futures = []
+        for index, component in enumerate(self.components):
+            if hasattr(component, "on_stop"):
+                # We need a qi.async call so that if the class is single
+                # threaded, it will wait for callbacks to be finished.
+                future = qi.async(component.on_stop)
+                future.addCallback(functools.partial(
+                    self._handle_stopped, index, component, start_time))
+                futures.append((component, future))
+        for component, future in futures:
+            name = type(component).__name__
+            if self.stop_timeout is None:
+                future.wait()
+            else:
+                remaining = start_time + self.stop_timeout - time.time()
+                future.wait(max(0, int(1000 * remaining)))
+            if future.isRunning():
+                _report_error(self.activity,
+                              "%s.on_stop() didn't finish within %s seconds"
+                              % (name, self.stop_timeout))
+            elif future.hasError():
+                _report_error(self.activity, "Error in %s.on_stop(): %s"
+                              % (name, future.error()))
+        self.timings["stop"] = time.time() - start_time
+
+    def _handle_stopped(self, index, component, start_time, on_stop_future):
+        "Callback for when an on_stop call is finished."
+        self.timings["on_stop:%d:%s" % (index, type(component).__name__)] = \
+            time.time() - start_time
+
+
+# Runtime statistics and profiling
+
+class StatsService(object):
+    """Companion service reporting the runtime state of an activity.
+
+    Registered by run_activity (with stats_service=True) as <Name>_Stats, its
+    getStats() method returns thread count, memory use, GC counts, running
+    async_generator coroutines, and for each EventHelper and ServiceCache
+    attribute of the activity, its connections (with event rates) and cached
+    services. Everything is cheap to collect, so it can be polled every
+    second.
+
+    It can also start and stop the sampling profiler (see start_profiler),
+    and take and compare memory snapshots (see MemoryTracker)."""
+    def __init__(self, activity):
+        self.activity = activity
+        self.start_time = time.time()
+        self.last_counts = {}  # (attribute, event): (time, calls)
+        self._get_member_stats()  # starts counting events
+
+    def getStats(self):
+        "Returns a dictionary describing the process and the activity."
+        import gc
+        import stk.coroutines
+        stats = {
+            "pid": os.getpid(),
+            "uptime": time.time() - self.start_time,
+            "threads": _get_thread_count(),
+            "python_threads": threading.active_count(),
+            "rss": _get_rss(),
+            "gc_counts": list(gc.get_count()),
+            "coroutines": stk.coroutines.get_stats(),
+        }
+        stats["events"], stats["services"], stats["schedulers"] = \
+            self._get_member_stats()
+        return stats
+
+    def startProfiler(self, rate=100):
+        "Starts sampling all threads rate times per second."
+        start_profiler(rate)
+
+    def stopProfiler(self):
+        "Stops the profiler, returns collapsed stacks (for flamegraph.pl)."
+        return stop_profiler()
+
+    def takeMemorySnapshot(self, name):
+        "Takes a named memory snapshot (starting memory tracking if needed)."
+        get_memory_tracker().take_snapshot(name)
+
+    def compareMemorySnapshots(self, old_name, new_name, top):
+        """Returns the top differences between two memory snapshots.
+
+        If new_name is empty, compares old_name with the current state."""
+        return get_memory_tracker().compare(old_name, new_name or None, top)
+
+    def stopMemoryTracking(self):
+        "Stops memory tracking and forgets the snapshots."
+        get_memory_tracker().stop()
+
+    def _get_member_stats(self):
+        """Returns the stats of EventHelper and ServiceCache attributes (and
+        of the ServiceCaches' CallSchedulers)."""
+        import stk.events
+        import stk.services
+        events, services, schedulers = {}, {}, {}
+        now = time.time()
+        for name, member in vars(self.activity).items():
+            if isinstance(member, stk.services.ServiceCache):
+                services[name] = dict(
+                    (service_name, service is not None)
+                    for service_name, service in member.services.items())
+                if member.schedulers:
+                    schedulers[name] = dict(
+                        (service_name, scheduler.stats()) for
+                        service_name, scheduler in member.schedulers.items())
+            elif isinstance(member, stk.events.EventHelper):
+                member.enable_counting()
+                events[name] = member.stats()
+                for event, event_stats in events[name].items():
+                    calls = event_stats["calls"]
+                    last_time, last_calls = self.last_counts.get(
+                        (name, event), (self.start_time, 0))
+                    elapsed = now - last_time
+                    event_stats["rate"] = ((calls - last_calls) / elapsed
+                                           if elapsed > 0 else 0.0)
+                    self.last_counts[(name, event)] = (now, calls)
+        return events, services, schedulers
+
+
+def _get_thread_count():
+    "Number of threads of the process (including qi's), if known."
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("Threads:"):
+                    return int(line.split()[1])
+    except (IOError, ValueError):
+        pass
+    return threading.active_count()
+
+
+def _get_rss():
+    "Resident memory of the process, in bytes (peak, if not on Linux)."
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, ValueError, OSError):
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # In bytes on macOS, in kilobytes elsewhere
+        return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+class SamplingProfiler(object):
+    """Statistical profiler, sampling the stacks of all threads.
+
+    A background thread looks at sys._current_frames() rate times per second,
+    and counts identical stacks; nothing runs when it's not started. The
+    result is wall-clock time (threads waiting for something are counted as
+    well), in the "collapsed stacks" text format of flamegraph.pl:
+    one "outer;...;inner count" line per stack."""
+    def __init__(self, rate=100):
+        self.rate = rate
+        self.counts = {}  # tuple of code objects (outer first): samples
+        self.samples = 0
+        self.sampling_time = 0.0  # time spent in the sampling thread
+        self.start_time = None
+        self.stop_time = None
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        "Starts sampling, in a background thread."
+        if self.running:
+            return
+        self.running = True
+        self.start_time = time.time()
+        self.stop_time = None
+        self.thread = threading.Thread(target=self._run,
+                                       name="stk.runner.profiler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        "Stops sampling, and returns the collapsed stacks."
+        if self.running:
+            self.running = False
+            self.thread.join()
+            self.stop_time = time.time()
+        return self.collapsed()
+
+    def _run(self):
+        "Sampling loop."
+        interval = 1.0 / self.rate
+        own_id = threading.current_thread().ident
+        counts = self.counts
+        while self.running:
+            start = time.time()
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stack = tuple(reversed(stack))
+                counts[stack] = counts.get(stack, 0) + 1
+            self.samples += 1
+            end = time.time()
+            self.sampling_time += end - start
+            time.sleep(max(0, interval - (end - start)))
+
+    def collapsed(self):
+        "Returns the samples so far, as collapsed stacks (flamegraph.pl)."
+        labels = {}
+        lines = []
+        for stack, count in self.counts.items():
+            for code in stack:
+                if code not in labels:
+                    labels[code] = "%s (%s:%d)" % (
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno)
+            lines.append("%s %d" % (";".join(labels[code] for code in stack),
+                                    count))
+        lines.sort()
+        return "\n".join(lines)
+
+    def stats(self):
+        "Returns the number of samples and the share of time spent sampling."
+        duration = (self.stop_time or time.time()) - (self.start_time or 0)
+        return {"samples": self.samples,
+                "stacks": len(self.counts),
+                "duration": duration if self.start_time else 0.0,
+                "overhead": (self.sampling_time / duration
+                             if self.start_time and duration > 0 else 0.0)}
+
+
+_PROFILER = None
+
+
+def start_profiler(rate=100):
+    """Starts sampling all threads rate times per second (see
+    SamplingProfiler), and returns the profiler. Restarts from scratch if
+    it was already running."""
+    global _PROFILER
+    if _PROFILER:
+        _PROFILER.stop()
+    _PROFILER = SamplingProfiler(rate)
+    _PROFILER.start()
+    return _PROFILER
+
+
+def stop_profiler():
+    "Stops the profiler, and returns the collapsed stacks (or '')."
+    if not _PROFILER:
+        return ""
+    return _PROFILER.stop()
+
+
+class MemoryTracker(object):
+    """Takes named snapshots of memory use, and compares them.
+
+    Uses tracemalloc when available (Python 3, or the pytracemalloc
+    backport), which gives the file and line where memory was allocated.
+    Otherwise, counts the objects tracked by the garbage collector, grouped
+    by type - or by the code that created them, for generators, coroutines
+    (GeneratorFuture), functions and frames. Nothing is done (or slowed
+    down) until start() is called."""
+    def __init__(self):
+        self.snapshots = {}
+        self.running = False
+        try:
+            import tracemalloc
+            self.tracemalloc = tracemalloc
+        except ImportError:
+            self.tracemalloc = None
+
+    def start(self, frames=1):
+        "Starts tracing allocations (keeping that many frames per trace)."
+        if self.tracemalloc and not self.tracemalloc.is_tracing():
+            self.tracemalloc.start(frames)
+        self.running = True
+
+    def stop(self):
+        "Stops tracing allocations, and forgets all snapshots."
+        if self.tracemalloc and self.tracemalloc.is_tracing():
+            self.tracemalloc.stop()
+        self.running = False
+        self.snapshots = {}
+
+    def take_snapshot(self, name):
+        "Takes a snapshot, stored under the given name."
+        if not self.running:
+            self.start()
+        if self.tracemalloc:
+            self.snapshots[name] = self.tracemalloc.take_snapshot()
+        else:
+            self.snapshots[name] = _count_objects()
+
+    def compare(self, old_name, new_name=None, top=10):
+        """Returns the top differences between two snapshots.
+
+        If new_name is not given, a new snapshot is compared to the old one.
+        Returns a list of dictionaries (location, size, size_diff, count and
+        count_diff), biggest size differences first."""
+        old = self.snapshots[old_name]
+        if new_name:
+            new = self.snapshots[new_name]
+        elif self.tracemalloc:
+            new = self.tracemalloc.take_snapshot()
+        else:
+            new = _count_objects()
+        if self.tracemalloc:
+            return [{"location": "%s:%d" % (stat.traceback[0].filename,
+                                            stat.traceback[0].lineno),
+                     "size": stat.size, "size_diff": stat.size_diff,
+                     "count": stat.count, "count_diff": stat.count_diff}
+                    for stat in new.compare_to(old, "lineno")[:top]]
+        diffs = []
+        for location in set(old) | set(new):
+            count, size = new.get(location, (0, 0))
+            old_count, old_size = old.get(location, (0, 0))
+            if count != old_count or size != old_size:
+                diffs.append({"location": location,
+                              "size": size, "size_diff": size - old_size,
+                              "count": count, "count_diff": count - old_count})
+        diffs.sort(key=lambda diff: abs(diff["size_diff"]), reverse=True)
+        return diffs[:top]
+
+
+def _object_location(obj):
+    "Where an object comes from: its type, or for code, its source line."
+    import stk.coroutines
+    if isinstance(obj, stk.coroutines.GeneratorFuture):
+        code = getattr(obj.generator, "gi_code", None)
+    elif isinstance(obj, types.GeneratorType):
+        code = obj.gi_code
+    elif isinstance(obj, types.FunctionType):
+        code = obj.func_code
+    elif isinstance(obj, types.FrameType):
+        code = obj.f_code
+    else:
+        code = None
+    kind = type(obj).__name__
+    if code is None:
+        return "%s.%s" % (type(obj).__module__, kind)
+    return "%s:%d (%s %s)" % (code.co_filename, code.co_firstlineno, kind,
+                              code.co_name)
+
+
+def _count_objects():
+    "Returns {location: (count, total size)} of objects tracked by the GC."
+    import gc
+    counts = {}
+    gc.collect()
+    for obj in gc.get_objects():
+        location = _object_location(obj)
+        count, size = counts.get(location, (0, 0))
+        counts[location] = (count + 1, size + sys.getsizeof(obj, 0))
+    return counts
+
+
+_MEMORY_TRACKER = None
+
+
+def get_memory_tracker():
+    "Returns the process's MemoryTracker."
+    global _MEMORY_TRACKER
+    if _MEMORY_TRACKER is None:
+        _MEMORY_TRACKER = MemoryTracker()
+    return _MEMORY_TRACKER
+
+
+# Reconnection
+
+DEFAULT_URL = "tcp://127.0.0.1:9559"
+
+
+class Reconnector(object):
+    """Reconnects the session when it's disconnected (e.g. NAOqi restarted).
+
+    Retries with an exponential backoff (from initial_delay to max_delay
+    seconds); once connected again, registers the service again (under the
+    same name), and lets the activity re-establish its proxies and
+    subscriptions: the LogProvider of stk.logging is registered again,
+    ServiceCache and EventHelper objects in its attributes are reset, and
+    then its on_reconnect method is called, if it has one.
+    """
+    def __init__(self, qiapp, activity, service_name=None, service_id=None,
+                 initial_delay=0.5, max_delay=30.0):
+        self.qiapp = qiapp
+        self.activity = activity
+        self.service_name = service_name
+        self.service_id = service_id
+        self.companions = {}  # other services to register: name: object
+        self.companion_ids = {}
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.url = str(getattr(qiapp, "url", None) or DEFAULT_URL)
+        self.reconnecting = False
+        self.stopped = False
+        self.reconnections = 0
+        self.lock = threading.Lock()
+
+    def watch(self):
+        "Starts watching the session's disconnected signal."
+        self.qiapp.session.disconnected.connect(self._on_disconnected)
+
+    def stop(self):
+        "Stops reconnecting (we're exiting)."
+        self.stopped = True
+
+    def _on_disconnected(self, reason=None):
+        "Callback for when the session is disconnected."
+        with self.lock:
+            if self.reconnecting or self.stopped:
+                return
+            self.reconnecting = True
+        _report_error(self.activity, "Session disconnected (%s), reconnecting"
+                      % reason)
+        # Not a qi thread, as we'll be sleeping in it.
+        thread = threading.Thread(target=self._reconnect,
+                                  name="stk.runner.reconnect")
+        thread.daemon = True
+        thread.start()
+
+    def _reconnect(self):
+        "Tries to connect (and register the service) until it succeeds."
+        delay = self.initial_delay
+        try:
+            while not self.stopped:
+                try:
+                    if not self.qiapp.session.isConnected():
+                        self.qiapp.session.connect(self.url)
+                    if self.service_name:
+                        self.service_id = self.qiapp.session.registerService(
+                            self.service_name, self.activity)
+                    for name, companion in self.companions.items():
+                        self.companion_ids[name] = (
+                            self.qiapp.session.registerService(name,
+                                                               companion))
+                    break
+                except RuntimeError as exc:
+                    _report_error(self.activity,
+                                  "Reconnection failed (%s), next try in %s s"
+                                  % (exc, delay))
+                    time.sleep(delay)
+                    delay = min(delay * 2, self.max_delay)
+            if not self.stopped:
+                self.reconnections += 1
+                self._refresh_activity()
+        finally:
+            self.reconnecting = False
+
+    def _refresh_activity(self):
+        "Lets the activity re-establish its proxies and subscriptions."
+        import stk.events
+        import stk.logging
+        import stk.services
+        try:
+            stk.logging.reregister_provider(self.qiapp.session)
+        except Exception as exc:
+            _report_error(self.activity, "Could not register the log "
+                          "provider again: %s" % exc)
+        for member in vars(self.activity).values():
+            try:
+                if isinstance(member, stk.services.ServiceCache):
+                    member.reset()
+                elif isinstance(member, stk.events.EventHelper):
+                    member.reconnect()
+            except Exception as exc:
+                _report_error(self.activity, "Could not reconnect %s: %s"
+                              % (member, exc))
+        if hasattr(self.activity, "on_reconnect"):
+            try:
+                self.activity.on_reconnect()
+            except Exception as exc:
+                _report_error(self.activity, "Error in on_reconnect(): %s"
+                              % exc)
+
+
+def run_activity(activity_class, service_name=None, worker_processes=0,
+                 start_timeout=None, stop_timeout=None, reconnect=False,
+                 stats_service=False):
     """Instantiate the given class, and runs it.
 
     The given class must take a qiapplication object as parameter, and may also
     have on_start and on_stop methods, that will be called before and after
-    running it."""
-    qiapp = init()
-    activity = activity_class(qiapp)
+    running it.
+
+    If the instance has a "components" attribute, the on_start and on_stop
+    methods of those objects are also called, in parallel with the
+    instance's. If they don't all finish within start_timeout seconds, the
+    application is stopped; process exit doesn't wait for on_stop calls more
+    than stop_timeout seconds. When registered as a service, the instance
+    gets waitReady() and isReady() methods, telling when all on_start calls
+    returned (see Lifecycle; available as the instance's _lifecycle).
+
+    If worker_processes is more than 0, that many worker processes are
+    started, and methods marked with @in_worker_process are run in them (see
+    WorkerPool; the pool is available as the instance's _worker_pool).
+
+    With reconnect=True, the process doesn't exit when the session is
+    disconnected, but keeps trying to reconnect (see Reconnector).
+
+    With stats_service=True, a companion service named <service_name>_Stats
+    (or <class name>_Stats) is also registered, for monitoring the process
+    (see StatsService; available as the instance's _stats)."""
+    # The worker processes must be forked before qi starts its threads.
+    pool = WorkerPool(worker_processes) if worker_processes else None
+    try:
+        qiapp = init(auto_exit=not reconnect)
+        activity = activity_class(qiapp)
+    except BaseException:
+        if pool:
+            pool.terminate()
+        raise
     service_id = None
+    if pool:
+        activity._worker_pool = pool
+        _forward_to_workers(activity, pool)
+    lifecycle = Lifecycle(activity, start_timeout, stop_timeout)
+    activity._lifecycle = lifecycle
+    reconnector = None
+    stats_name, stats_id = None, None
 
     try:
         # if it's a service, register it
         if service_name:
+            lifecycle.expose()
             # Note: this will fail if there is already a service. Unregistering
             # it would not be a good practice, because it's process would still
             # be running.
             service_id = qiapp.session.registerService(service_name, activity)
 
-        if hasattr(activity, "on_start"):
-            def handle_on_start_done(on_start_future):
-                "Custom callback, for checking errors"
-                if on_start_future.hasError():
-                    try:
-                        msg = "Error in on_start(), stopping application: %s" \
-                            % on_start_future.error()
-                        if hasattr(activity, "logger"):
-                            activity.logger.error(msg)
-                        else:
-                            print msg
-                    finally:
-                        qiapp.stop()
-            qi.async(activity.on_start).addCallback(handle_on_start_done)
+        if stats_service:
+            activity._stats = StatsService(activity)
+            stats_name = (service_name or activity_class.__name__) + "_Stats"
+            stats_id = qiapp.session.registerService(stats_name,
+                                                     activity._stats)
+
+        if reconnect:
+            reconnector = Reconnector(qiapp, activity, service_name,
+                                      service_id)
+            if stats_id:
+                reconnector.companions[stats_name] = activity._stats
+            reconnector.watch()
+
+        def handle_start_error(msg):
+            "Custom callback, for errors in on_start"
+            try:
+                _report_error(activity, msg + ", stopping application.")
+            finally:
+                qiapp.stop()
+        lifecycle.start(handle_start_error)
 
         # Run the QiApplication, which runs until someone calls qiapp.stop()
         qiapp.run()
 
     finally:
         # Cleanup
-        if hasattr(activity, "on_stop"):
-            # We need a qi.async call so that if the class is single threaded,
-            # it will wait for callbacks to be finished.
-            qi.async(activity.on_stop).wait()
+        if reconnector:
+            reconnector.stop()
+            service_id = reconnector.service_id
+            stats_id = reconnector.companion_ids.get(stats_name, stats_id)
+        lifecycle.stop()
+        if stats_id:
+            qiapp.session.unregisterService(stats_id)
         if service_id:
             qiapp.session.unregisterService(service_id)
+        if pool:
+            pool.terminate()
 
 
-def run_service(service_class, service_name=None):
+def run_service(service_class, service_name=None, **kwargs):
     """Instantiate the given class, and registers it as a NAOqi service.
 
     The given class must take a qiapplication object as parameter, and may also
@@ -147,7 +1058,132 @@ def run_service(service_class, service_name=None):
     running it.
 
     If the service_name parameter is not given, the classes' name will be used.
+
+    Other keyword arguments (worker_processes, start_timeout, stop_timeout,
+    reconnect, stats_service) are passed to run_activity.
     """
     if not service_name:
         service_name = service_class.__name__
-    run_activity(service_class, service_name)
+    run_activity(service_class, service_name, **kwargs)
+
+
+class _HostedService(object):
+    "A service run by run_services, with its own error handling."
+    def __init__(self, qiapp, service_class, service_name, group):
+        self.qiapp = qiapp
+        self.group = group # all the services of the process
+        self.service_class = service_class
+        self.name = service_name or service_class.__name__
+        self.instance = None
+        self.service_id = None
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.stop_finished = threading.Event()
+
+    def register(self):
+        "Instantiates and registers the service; returns success."
+        try:
+            self.instance = self.service_class(self.qiapp)
+            self.service_id = self.qiapp.session.registerService(
+                self.name, self.instance)
+            return True
+        except Exception as exc:
+            _report_error(self.instance, "Could not start service %s: %s"
+                          % (self.name, exc))
+            # It was never registered (nor started): nothing to stop.
+            self.stopped = True
+            self.stop_finished.set()
+            return False
+
+    def start(self):
+        "Calls on_start asynchronously; if it fails, only this one stops."
+        if hasattr(self.instance, "on_start"):
+            qi.async(self.instance.on_start).addCallback(
+                self._handle_on_start_done)
+
+    def _handle_on_start_done(self, on_start_future):
+        "Callback for checking errors in on_start."
+        if on_start_future.hasError():
+            _report_error(self.instance,
+                          "Error in %s.on_start(), stopping service: %s"
+                          % (self.name, on_start_future.error()))
+            self.stop()
+            if all(service.stopped for service in self.group):
+                self.qiapp.stop()
+
+    def stop_async(self):
+        """Starts calling on_stop; returns (whether this call is stopping the
+        service, a future of on_stop or None).
+
+        The service is only stopped once, even if its on_start fails while
+        the process is exiting."""
+        with self.lock:
+            if self.stopped:
+                return False, None
+            self.stopped = True
+        if hasattr(self.instance, "on_stop"):
+            return True, qi.async(self.instance.on_stop)
+        return True, None
+
+    def finish_stop(self, stopping, on_stop_future):
+        """Waits for on_stop, reports errors, and unregisters the service;
+        if it's being stopped by another call, waits for that."""
+        if not stopping:
+            self.stop_finished.wait()
+            return
+        try:
+            if on_stop_future:
+                on_stop_future.wait()
+                if on_stop_future.hasError():
+                    _report_error(self.instance, "Error in %s.on_stop(): %s"
+                                  % (self.name, on_stop_future.error()))
+        finally:
+            if self.service_id:
+                try:
+                    self.qiapp.session.unregisterService(self.service_id)
+                except RuntimeError as exc:
+                    _report_error(self.instance,
+                                  "Could not unregister %s: %s"
+                                  % (self.name, exc))
+                self.service_id = None
+            self.stop_finished.set()
+
+    def stop(self):
+        "Calls on_stop and unregisters the service."
+        self.finish_stop(*self.stop_async())
+
+
+def run_services(services):
+    """Instantiate several classes, and registers them on a single session.
+
+    services is a list of (service_class, service_name) pairs; if a name is
+    None, the class's name will be used. As in run_service, the classes must
+    take a qiapplication object as parameter, and may have on_start and
+    on_stop methods.
+
+    All the services share one process and one session. Their on_start (and
+    on_stop) methods are called concurrently, and errors are handled for each
+    service separately: if one fails to start, it is stopped and
+    unregistered, but the others keep running. The application only stops
+    when all of them failed, or someone calls qiapp.stop().
+    """
+    qiapp = init()
+    hosted = []
+    for service_class, service_name in services:
+        hosted.append(_HostedService(qiapp, service_class, service_name,
+                                     hosted))
+    try:
+        running = [service for service in hosted if service.register()]
+        if not running:
+            raise RuntimeError("No service could be started.")
+        for service in running:
+            service.start()
+
+        # Run the QiApplication, which runs until someone calls qiapp.stop()
+        qiapp.run()
+
+    finally:
+        # Stop all services concurrently, then wait for all of them.
+        stops = [(service, service.stop_async()) for service in hosted]
+        for service, (stopping, on_stop_future) in stops:
+            service.finish_stop(stopping, on_stop_future)
@@ -0,0 +1,331 @@
+"""
+stk.sensors.py
+
+Shares high-rate ALMemory values between the processes of a robot, through
+shared memory, so that only one of them subscribes to the events.
+
+In one process:
+
+publisher = stk.sensors.SensorPublisher(
+    qiapp.session, "imu", ["Device/SubDeviceList/InertialSensor/..."])
+publisher.start()
+
+In as many other (local) processes as you want, without any NAOqi call:
+
+reader = stk.sensors.SensorReader("imu")
+timestamp, value = reader.latest("Device/SubDeviceList/InertialSensor/...")
+values = reader.window("Device/SubDeviceList/InertialSensor/...", 0.5)
+
+The publisher writes each new value in a ring buffer in a memory-mapped file;
+each slot is protected by a sequence lock, so that readers never block the
+publisher (nor each other), and just retry if a slot was being written.
+
+Values must be numbers, or lists of at most value_size numbers.
+"""
+
+__version__ = "0.1.0"
+
+__copyright__ = "Copyright 2017, Aldebaran Robotics / Softbank Robotics Europe"
+
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+_MAGIC = "STKS"
+_FORMAT_VERSION = 1
+
+# magic, format version, capacity, value size, max keys, key count, head
+_HEADER = struct.Struct("<4sIIIIIQ")
+_KEY_COUNT_OFFSET = 20
+_HEAD_OFFSET = 24
+_KEY_NAME_SIZE = 128
+_INDEX = struct.Struct("<Q")
+_SEQUENCE = struct.Struct("<I")
+# sequence, key number, value count (0 for a number), index, timestamp
+_SLOT_HEADER_FORMAT = "<IHHQd"
+_SCALAR = 0
+
+_READ_RETRIES = 100
+
+
+def get_path(name):
+    "Returns the path of the shared memory file for that name."
+    directory = "/dev/shm"
+    if not os.path.isdir(directory):
+        directory = tempfile.gettempdir()
+    return os.path.join(directory, "stk_sensors_" + name)
+
+
+class _Layout(object):
+    "Offsets of the parts of the shared memory file."
+    def __init__(self, capacity, value_size, max_keys):
+        self.capacity = capacity
+        self.value_size = value_size
+        self.max_keys = max_keys
+        self.keys_offset = _HEADER.size
+        self.latest_offset = self.keys_offset + max_keys * _KEY_NAME_SIZE
+        self.slots_offset = self.latest_offset + max_keys * _INDEX.size
+        self.slot = struct.Struct(_SLOT_HEADER_FORMAT + "%dd" % value_size)
+        self.slot_data = struct.Struct(
+            "<" + _SLOT_HEADER_FORMAT[2:] + "%dd" % value_size)
+        self.size = self.slots_offset + capacity * self.slot.size
+
+    def slot_offset(self, index):
+        "Offset of the slot for the index-th value."
+        return self.slots_offset + (index % self.capacity) * self.slot.size
+
+
+class SensorPublisher(object):
+    """Writes ALMemory values (or any values given to publish()) in shared
+    memory, for SensorReaders.
+
+    keys are ALMemory keys (or signals, as for EventHelper) to subscribe to
+    when started; values of other keys can be written with publish(). Keeps
+    the last capacity values (of all keys).
+
+    Can be used as one of the components of an activity run by stk.runner
+    (on_start and on_stop).
+    """
+    def __init__(self, session, name, keys=(), capacity=4096, value_size=1,
+                 max_keys=64):
+        self.session = session
+        self.name = name
+        self.keys = list(keys)
+        self.path = get_path(name)
+        self.layout = _Layout(capacity, value_size, max_keys)
+        self.key_numbers = {}
+        self.lock = threading.Lock()
+        self.head = 0
+        self.skipped = 0  # values that couldn't be written
+        self.events = None
+        self.memory = self._create()
+        for key in self.keys:
+            self._get_key_number(key)
+
+    def _create(self):
+        "Creates the shared memory file, and maps it."
+        # A new file (renamed over an old one, that readers may still map)
+        temp_path = "%s.%d" % (self.path, os.getpid())
+        with open(temp_path, "w+b") as memory_file:
+            memory_file.truncate(self.layout.size)
+            memory = mmap.mmap(memory_file.fileno(), self.layout.size)
+        _HEADER.pack_into(memory, 0, _MAGIC, _FORMAT_VERSION,
+                          self.layout.capacity, self.layout.value_size,
+                          self.layout.max_keys, 0, 0)
+        os.rename(temp_path, self.path)
+        return memory
+
+    def _get_key_number(self, key):
+        "Returns the number of a key, adding it to the table if needed."
+        number = self.key_numbers.get(key)
+        if number is None:
+            number = len(self.key_numbers)
+            encoded = key.encode("utf-8")
+            if number >= self.layout.max_keys:
+                raise ValueError("Too many keys (at most %d)"
+                                 % self.layout.max_keys)
+            if len(encoded) > _KEY_NAME_SIZE:
+                raise ValueError("Key name too long: %s" % key)
+            offset = self.layout.keys_offset + number * _KEY_NAME_SIZE
+            self.memory[offset:offset + len(encoded)] = encoded
+            _SEQUENCE.pack_into(self.memory, _KEY_COUNT_OFFSET, number + 1)
+            self.key_numbers[key] = number
+        return number
+
+    def start(self):
+        "Subscribes to the keys."
+        import stk.events
+        self.events = stk.events.EventHelper(self.session)
+        for key in self.keys:
+            self.events.connect(key, self._make_callback(key))
+
+    def stop(self):
+        "Unsubscribes, and removes the shared memory file."
+        if self.events:
+            self.events.clear()
+            self.events = None
+        if self.memory:
+            self.memory.close()
+            self.memory = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    on_start = start
+    on_stop = stop
+
+    def _make_callback(self, key):
+        "Returns a callback publishing the values of a key."
+        def on_value(value):
+            "Callback for the event."
+            self.publish(key, value)
+        return on_value
+
+    def publish(self, key, value, timestamp=None):
+        """Writes a value (a number, or a list of numbers) for a key.
+
+        Returns whether it could be written."""
+        if timestamp is None:
+            timestamp = time.time()
+        value_size = self.layout.value_size
+        if isinstance(value, (list, tuple)):
+            count = len(value)
+            values = list(value) + [0.0] * (value_size - count)
+        else:
+            count = _SCALAR
+            values = [value] + [0.0] * (value_size - 1)
+        with self.lock:
+            if not self.memory or count > value_size:
+                self.skipped += 1
+                return False
+            try:
+                key_number = self._get_key_number(key)
+                self._write(key_number, count, timestamp, values)
+            except (struct.error, ValueError, TypeError):
+                self.skipped += 1
+                return False
+        return True
+
+    def _write(self, key_number, count, timestamp, values):
+        "Writes a slot (with the lock), with the sequence lock protocol."
+        memory = self.memory
+        index = self.head
+        offset = self.layout.slot_offset(index)
+        data = self.layout.slot_data.pack(key_number, count, index, timestamp,
+                                          *values)
+        sequence = _SEQUENCE.unpack_from(memory, offset)[0]
+        # Odd sequence: being written
+        _SEQUENCE.pack_into(memory, offset, (sequence + 1) & 0xffffffff)
+        memory[offset + 4:offset + 4 + len(data)] = data
+        _SEQUENCE.pack_into(memory, offset, (sequence + 2) & 0xffffffff)
+        self.head = index + 1
+        _INDEX.pack_into(memory, self.layout.latest_offset + 8 * key_number,
+                         index + 1)
+        _INDEX.pack_into(memory, _HEAD_OFFSET, index + 1)
+
+
+class SensorReader(object):
+    """Reads the values written by a SensorPublisher (in another process).
+
+    Never blocks the publisher. If the publisher is restarted, call
+    reopen()."""
+    def __init__(self, name):
+        self.name = name
+        self.path = get_path(name)
+        self.memory = None
+        self.layout = None
+        self.key_numbers = {}
+        self.reopen()
+
+    def reopen(self):
+        "Maps the current shared memory file (raises IOError if none)."
+        self.close()
+        with open(self.path, "rb") as memory_file:
+            memory = mmap.mmap(memory_file.fileno(), 0,
+                               access=mmap.ACCESS_READ)
+        magic, version, capacity, value_size, max_keys, _, _ = \
+            _HEADER.unpack_from(memory, 0)
+        if magic != _MAGIC or version != _FORMAT_VERSION:
+            memory.close()
+            raise IOError("%s isn't a sensor file of this version"
+                          % self.path)
+        self.layout = _Layout(capacity, value_size, max_keys)
+        self.memory = memory
+        self.key_numbers = {}
+
+    def close(self):
+        "Unmaps the shared memory file."
+        if self.memory:
+            self.memory.close()
+            self.memory = None
+
+    def keys(self):
+        "Returns the keys published so far."
+        self._read_keys()
+        return sorted(self.key_numbers)
+
+    def _read_keys(self):
+        "Reads the table of keys."
+        count = _SEQUENCE.unpack_from(self.memory, _KEY_COUNT_OFFSET)[0]
+        for number in range(len(self.key_numbers), count):
+            offset = self.layout.keys_offset + number * _KEY_NAME_SIZE
+            name = self.memory[offset:offset + _KEY_NAME_SIZE].rstrip("\0")
+            self.key_numbers[name.decode("utf-8")] = number
+
+    def _get_key_number(self, key):
+        "Returns the number of a key, or None if it wasn't published."
+        if key not in self.key_numbers:
+            self._read_keys()
+        return self.key_numbers.get(key)
+
+    def head(self):
+        "Returns the number of values written so far."
+        return _INDEX.unpack_from(self.memory, _HEAD_OFFSET)[0]
+
+    def _read_slot(self, index):
+        """Returns (key number, timestamp, value) of the index-th value, or
+        None if it was overwritten."""
+        memory = self.memory
+        layout = self.layout
+        offset = layout.slot_offset(index)
+        for _ in range(_READ_RETRIES):
+            record = layout.slot.unpack_from(memory, offset)
+            if record[0] & 1:
+                continue  # being written
+            if _SEQUENCE.unpack_from(memory, offset)[0] != record[0]:
+                continue  # was written while we read it
+            if record[3] != index:
+                return None  # overwritten by a more recent value
+            count = record[2]
+            if count == _SCALAR:
+                value = record[5]
+            else:
+                value = list(record[5:5 + count])
+            return record[1], record[4], value
+        return None
+
+    def latest(self, key):
+        "Returns (timestamp, value) of the latest value of key, or None."
+        key_number = self._get_key_number(key)
+        if key_number is None:
+            return None
+        offset = self.layout.latest_offset + 8 * key_number
+        for _ in range(_READ_RETRIES):
+            index = _INDEX.unpack_from(self.memory, offset)[0] - 1
+            if index < 0:
+                return None
+            record = self._read_slot(index)
+            if record:
+                return record[1:]
+        return None
+
+    def window(self, key, duration=None, start=None, end=None):
+        """Returns the [(timestamp, value)] of key in a time window, oldest
+        first.
+
+        The window is the last duration seconds, or from start to end
+        (timestamps; None meaning no limit); it's limited to what the ring
+        buffer still holds."""
+        key_number = self._get_key_number(key)
+        if key_number is None:
+            return []
+        if duration is not None:
+            start = time.time() - duration
+        head = self.head()
+        oldest = max(0, head - self.layout.capacity)
+        values = []
+        for index in xrange(head - 1, oldest - 1, -1):
+            record = self._read_slot(index)
+            if record is None:
+                break  # overwritten: older values are gone too
+            record_key, timestamp, value = record
+            if start is not None and timestamp < start:
+                break
+            if record_key == key_number and (end is None or timestamp <= end):
+                values.append((timestamp, value))
+        values.reverse()
+        return values
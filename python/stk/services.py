@@ -10,6 +10,12 @@ __copyright__ = "Copyright 2015, Aldebaran Robotics"
 __author__ = 'ekroeger'
 __email__ = 'ekroeger@aldebaran.com'
 
+import collections
+import functools
+import heapq
+import threading
+import time
+
 
 class ServiceCache(object):
     "A helper for accessing NAOqi services."
@@ -17,6 +23,7 @@ class ServiceCache(object):
     def __init__(self, session=None):
         self.session = None
         self.services = {}
+        self.schedulers = {}
         if session:
             self.init(session)
 
@@ -24,6 +31,39 @@ class ServiceCache(object):
         "Sets the session object, if it wasn't passed to constructor."
         self.session = session
 
+    def reset(self):
+        """Forgets all cached services, they will be fetched again.
+
+        To be called when the session was reconnected (e.g. after NAOqi
+        restarted), as the old service objects are dead."""
+        self.services = {}
+
+    def batch(self, max_concurrent=None):
+        """Returns a Batch, for making many calls concurrently.
+
+        with services.batch() as batch:
+            batch.ALLeds.fadeRGB("FaceLeds", 0xff0000, 0.5)
+            volume = batch.ALAudioDevice.getOutputVolume()
+        print volume.value()
+
+        The calls are sent when the block exits (at most max_concurrent at a
+        time, if it's given), and it waits for all of them."""
+        return Batch(self, max_concurrent)
+
+    def scheduler(self, servicename, max_concurrent=1, rate=None, burst=1):
+        """Returns the CallScheduler of a service (creating it with these
+        options the first time), for queuing calls to it.
+
+        tts = services.scheduler("ALTextToSpeech", rate=0.5)
+        yield tts.say("Hello", _priority=1, _tag="greeting")
+        """
+        scheduler = self.schedulers.get(servicename)
+        if scheduler is None:
+            scheduler = self.schedulers.setdefault(
+                servicename, CallScheduler(self, servicename, max_concurrent,
+                                           rate, burst))
+        return scheduler
+
     def __getattr__(self, servicename):
         "We overload this so (instance).ALMotion returns the service, or None."
         if (not servicename in self.services) or (
@@ -37,3 +77,576 @@ class ServiceCache(object):
             except RuntimeError:  # Cannot find service
                 self.services[servicename] = None
         return self.services[servicename]
+
+
+class BatchCall(object):
+    "A call made in a Batch; its result is available when the batch is done."
+    def __init__(self, service_name, method_name, args):
+        self.service_name = service_name
+        self.method_name = method_name
+        self.args = args
+        self.future = None
+        self.error = None  # error message, once done
+
+    def value(self):
+        "Returns the result of the call, or raises a RuntimeError."
+        if self.error is not None:
+            raise RuntimeError(self.error)
+        if self.future is None:
+            raise RuntimeError("%s wasn't called yet" % self)
+        return self.future.value()
+
+    def __str__(self):
+        return "%s.%s" % (self.service_name, self.method_name)
+
+
+class _BatchService(object):
+    "Stand-in for a service in a Batch: records the calls."
+    def __init__(self, batch, service_name):
+        self.batch = batch
+        self.service_name = service_name
+
+    def __getattr__(self, method_name):
+        if method_name.startswith("__"):
+            raise AttributeError(method_name)
+        def record(*args):
+            "Records the call, returns a BatchCall."
+            call = BatchCall(self.service_name, method_name, args)
+            self.batch.calls.append(call)
+            return call
+        return record
+
+
+class Batch(object):
+    """Collects service calls, and makes them concurrently (see
+    ServiceCache.batch).
+
+    Once done, results are in .results (in the order of the calls; None for
+    failed calls), and errors in .errors, a list of (BatchCall, error
+    message) pairs; the batch doesn't raise exceptions for failed calls."""
+    def __init__(self, services, max_concurrent=None):
+        self.services = services
+        self.max_concurrent = max_concurrent
+        self.calls = []
+        self.results = []
+        self.errors = []
+        self.condition = threading.Condition()
+        self.running = 0
+
+    def __getattr__(self, service_name):
+        if service_name.startswith("__"):
+            raise AttributeError(service_name)
+        return _BatchService(self, service_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if not exc_type:
+            self.run()
+
+    def run(self):
+        "Makes all the calls, and waits for them."
+        for call in self.calls:
+            with self.condition:
+                while self.max_concurrent and \
+                        self.running >= self.max_concurrent:
+                    self.condition.wait()
+                self.running += 1
+            self._start(call)
+        with self.condition:
+            while self.running:
+                self.condition.wait()
+        self.results = []
+        self.errors = []
+        for call in self.calls:
+            if call.error is None and call.future.hasError():
+                call.error = call.future.error()
+            elif call.error is None and call.future.isCanceled():
+                call.error = "Call was cancelled"
+            if call.error is None:
+                self.results.append(call.future.value())
+            else:
+                self.results.append(None)
+                self.errors.append((call, call.error))
+        return self.results
+
+    def _start(self, call):
+        "Starts a call."
+        try:
+            service = getattr(self.services, call.service_name)
+            if service is None:
+                raise RuntimeError("Service %s not found" % call.service_name)
+            method = getattr(service, call.method_name)
+            call.future = method(*call.args, _async=True)
+        except Exception as exc:
+            call.error = str(exc) or type(exc).__name__
+            self._on_done(None)
+        else:
+            call.future.addCallback(self._on_done)
+
+    def _on_done(self, future):
+        "Callback for when a call is finished."
+        with self.condition:
+            self.running -= 1
+            self.condition.notify_all()
+
+
+#
+# Caching the results of service methods
+#
+
+class _Pending(object):
+    "A call in progress, that other callers with the same arguments wait for."
+    __slots__ = ("event", "value", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class MethodCache(object):
+    """The cached results of a method, for one object.
+
+    Results are kept per arguments, for at most ttl seconds (if ttl isn't
+    None), and only the max_size most recently used ones are kept. While a
+    result is being computed, other calls with the same arguments wait for it
+    instead of computing it again.
+
+    If the method returns a qi future (e.g. it's decorated with
+    public_async_generator), the future is cached, and each caller gets its
+    own copy (so cancelling it doesn't affect the others). Errors are never
+    cached."""
+    def __init__(self, func, ttl=None, max_size=128):
+        self.func = func
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()  # key: (expiry, value)
+        self.pending = {}  # key: _Pending
+        self.generation = 0  # incremented by each invalidation
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def call(self, instance, args, kwargs=None):
+        """Returns the (possibly cached) result of
+        func(instance, *args, **kwargs)."""
+        kwargs = kwargs or {}
+        key = _make_key(args, kwargs)
+        is_owner = False
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry and (entry[0] is None or entry[0] > time.time()):
+                self.entries[key] = entry  # now the most recently used
+                self.hits += 1
+                return _copy_if_future(entry[1])
+            pending = self.pending.get(key)
+            if pending:
+                self.coalesced += 1
+            else:
+                pending = self.pending[key] = _Pending()
+                self.misses += 1
+                generation = self.generation
+                is_owner = True
+        if not is_owner:
+            pending.event.wait()
+            if pending.error:
+                raise pending.error
+            return _copy_if_future(pending.value)
+        try:
+            value = self.func(instance, *args, **kwargs)
+            pending.value = value
+        except Exception as exc:
+            pending.error = exc
+            raise
+        else:
+            self._store(key, value, generation)
+            return _copy_if_future(value)
+        finally:
+            with self.lock:
+                del self.pending[key]
+            pending.event.set()
+
+    def _store(self, key, value, generation):
+        "Caches a value, unless it was invalidated in the meantime."
+        expiry = time.time() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = (expiry, value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        if _is_future(value):
+            value.addCallback(functools.partial(self._check_future, key,
+                                                value))
+
+    def _check_future(self, key, value, future):
+        """Callback: forget futures that failed or were cancelled.
+
+        value is the cached object: future may be another wrapper of it (qi
+        passes a new one to each callback)."""
+        if future.hasError() or future.isCanceled():
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry and entry[1] is value:
+                    del self.entries[key]
+
+    def invalidate(self, *args, **kwargs):
+        "Forgets the result for these arguments, or all results if none."
+        with self.lock:
+            self.generation += 1
+            if args or kwargs:
+                self.entries.pop(_make_key(args, kwargs), None)
+            else:
+                self.entries.clear()
+
+    def stats(self):
+        "Returns a dictionary with the number of hits, misses etc."
+        return {"hits": self.hits, "misses": self.misses,
+                "coalesced": self.coalesced, "size": len(self.entries)}
+
+
+# Separates positional and keyword arguments in cache keys
+_KWARGS_MARK = ("__kwargs__",)
+
+
+def _make_key(args, kwargs=None):
+    """Returns a hashable key for the arguments (qi gives lists, not tuples).
+
+    Keyword arguments are included as a sorted tuple of (name, value)."""
+    key = tuple(args)
+    if kwargs:
+        key += _KWARGS_MARK + tuple(sorted(kwargs.items()))
+    try:
+        hash(key)
+        return key
+    except TypeError:
+        return repr(key)
+
+
+def _is_future(value):
+    "Is value a qi future?"
+    return hasattr(value, "addCallback") and hasattr(value, "hasError")
+
+
+def _copy_if_future(value):
+    "Returns a new future with the same result, if value is a future."
+    if not _is_future(value):
+        return value
+    import qi
+    promise = qi.Promise()
+    def forward(future):
+        "Callback: sets the copy's result."
+        if future.hasError():
+            promise.setError(future.error())
+        elif future.isCanceled():
+            promise.setCanceled()
+        else:
+            promise.setValue(future.value())
+    value.addCallback(forward)
+    return promise.future()
+
+
+# Protects the creation of caches
+_CACHES_LOCK = threading.Lock()
+
+
+def cached(ttl=None, max_size=128, invalidate_on=()):
+    """Decorator caching the results of a method, per arguments.
+
+    For service methods that always return the same thing for the same
+    arguments (configuration, metadata...), and that many clients call.
+    Results are kept at most ttl seconds (forever if it's None), the least
+    recently used ones are forgotten when there are more than max_size, and
+    concurrent calls with the same arguments only compute the result once
+    (see MethodCache).
+
+    The cache can be cleared with invalidate(self.method), and also whenever
+    one of the ALMemory keys (or signals) in invalidate_on is raised; the
+    object must then have an EventHelper attribute, used to connect to them.
+
+    Works with methods decorated with public_async_generator (put @cached
+    above it). Keyword arguments are part of the key: f(1) and f(x=1) are
+    cached separately.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(self, *args, **kwargs):
+            return get_cache(self, wrapped).call(self, args, kwargs)
+        wrapped.__cache_options__ = (func, ttl, max_size, invalidate_on)
+        return wrapped
+    return decorator
+
+
+def get_cache(instance, method):
+    """Returns the MethodCache of a method decorated with @cached, for
+    instance (creating it)."""
+    method = getattr(method, "__func__", method)
+    caches = instance.__dict__.get("_method_caches")
+    if caches is None or method.__name__ not in caches:
+        with _CACHES_LOCK:
+            caches = instance.__dict__.setdefault("_method_caches", {})
+            if method.__name__ not in caches:
+                func, ttl, max_size, invalidate_on = method.__cache_options__
+                cache = MethodCache(func, ttl, max_size)
+                if invalidate_on:
+                    _connect_invalidation(instance, cache, invalidate_on)
+                caches[method.__name__] = cache
+    return caches[method.__name__]
+
+
+def _connect_invalidation(instance, cache, events):
+    "Clears cache whenever one of the events is raised."
+    import stk.events
+    for member in vars(instance).values():
+        if isinstance(member, stk.events.EventHelper):
+            for event in events:
+                member.connect(event, lambda *args: cache.invalidate())
+            return
+    raise RuntimeError("%s has no EventHelper for invalidating its cache"
+                       % type(instance).__name__)
+
+
+def invalidate(method, *args, **kwargs):
+    """Clears the cache of a bound method decorated with @cached.
+
+    With arguments, only the result for these arguments is forgotten."""
+    get_cache(method.__self__, method).invalidate(*args, **kwargs)
+
+
+#
+# Scheduling calls to slow services
+#
+
+# States of a ScheduledCall
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+CANCELED = "canceled"
+SUPERSEDED = "superseded"
+
+
+class ScheduledCall(object):
+    "A call waiting in (or sent by) a CallScheduler."
+    def __init__(self, method_name, args, priority, tag):
+        self.method_name = method_name
+        self.args = args
+        self.priority = priority
+        self.tag = tag
+        self.state = PENDING
+        self.queued_at = time.time()
+        self.promise = None
+        self.future = None  # of the service call, once started
+        self.cancel_requested = False
+
+    def __str__(self):
+        return "%s(priority=%s, tag=%s)" % (self.method_name, self.priority,
+                                            self.tag)
+
+
+class CallScheduler(object):
+    """Queues the calls to a slow service, and sends them one at a time (or
+    max_concurrent at a time), highest priority first.
+
+    Each call returns a qi future at once (so it can be yielded in an
+    async_generator); cancelling it removes the call from the queue, or
+    cancels it if it was already sent.
+
+    If rate is given, at most rate calls per second are sent (with bursts of
+    at most burst calls), with a token bucket.
+
+    A call with a tag supersedes a pending (not yet sent) call with the same
+    tag: the older one is cancelled.
+    """
+    def __init__(self, services, service_name, max_concurrent=1, rate=None,
+                 burst=1):
+        self.services = services
+        self.service_name = service_name
+        self.max_concurrent = max_concurrent
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.queue = []  # heap of (-priority, sequence, ScheduledCall)
+        self.sequence = 0
+        self.tags = {}  # tag: pending ScheduledCall
+        self.tokens = float(burst)
+        self.refill_time = time.time()
+        self.wakeup = None  # future of the next dispatch, when rate limited
+        self.pending = 0
+        self.running = 0
+        self.max_pending = 0
+        self.submitted = 0
+        self.started = 0
+        self.done = 0
+        self.errors = 0
+        self.canceled = 0
+        self.superseded = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def __getattr__(self, method_name):
+        if method_name.startswith("__"):
+            raise AttributeError(method_name)
+        def schedule(*args, **kwargs):
+            "Schedules the call, returns a future."
+            return self.call(method_name, *args, **kwargs)
+        return schedule
+
+    def call(self, method_name, *args, **kwargs):
+        """Schedules a call of the service's method; returns a future.
+
+        Keyword arguments are _priority (default 0, higher first) and _tag
+        (default None)."""
+        import qi
+        priority = kwargs.pop("_priority", 0)
+        tag = kwargs.pop("_tag", None)
+        if kwargs:
+            raise TypeError("Unexpected arguments: %s" % ", ".join(kwargs))
+        call = ScheduledCall(method_name, args, priority, tag)
+        call.promise = qi.Promise(functools.partial(self._on_cancel, call))
+        superseded = None
+        with self.lock:
+            if tag is not None:
+                superseded = self.tags.get(tag)
+                if superseded:
+                    superseded.state = SUPERSEDED
+                    self.pending -= 1
+                    self.superseded += 1
+                self.tags[tag] = call
+            self.sequence += 1
+            heapq.heappush(self.queue, (-priority, self.sequence, call))
+            self.pending += 1
+            self.submitted += 1
+            self.max_pending = max(self.max_pending, self.pending)
+        future = call.promise.future()
+        if superseded:
+            superseded.promise.setCanceled()
+        self._dispatch()
+        return future
+
+    def stats(self):
+        """Returns a dictionary with the number of pending calls (and the
+        most there ever were), of running calls, counts of calls, and the
+        average and maximum time calls waited in the queue."""
+        with self.lock:
+            return {"pending": self.pending, "max_pending": self.max_pending,
+                    "running": self.running, "submitted": self.submitted,
+                    "started": self.started, "done": self.done,
+                    "errors": self.errors, "canceled": self.canceled,
+                    "superseded": self.superseded,
+                    "average_wait": (self.total_wait / self.started
+                                     if self.started else 0.0),
+                    "max_wait": self.max_wait}
+
+    def _take_token(self, now):
+        """Takes a token from the bucket; returns 0 if there was one, or how
+        many seconds until there is one."""
+        if self.rate is None:
+            return 0
+        self.tokens = min(self.burst, self.tokens +
+                          (now - self.refill_time) * self.rate)
+        self.refill_time = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def _dispatch(self):
+        "Starts as many queued calls as allowed."
+        import qi
+        to_start = []
+        with self.lock:
+            while self.queue and (not self.max_concurrent or
+                                  self.running < self.max_concurrent):
+                call = self.queue[0][2]
+                if call.state != PENDING:
+                    heapq.heappop(self.queue)  # cancelled or superseded
+                    continue
+                now = time.time()
+                delay = self._take_token(now)
+                if delay:
+                    if self.wakeup is None:
+                        self.wakeup = qi.async(self._on_wakeup,
+                                               delay=int(delay * 1000000))
+                    break
+                heapq.heappop(self.queue)
+                call.state = RUNNING
+                if self.tags.get(call.tag) is call:
+                    del self.tags[call.tag]
+                self.pending -= 1
+                self.running += 1
+                self.started += 1
+                wait = now - call.queued_at
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                to_start.append(call)
+        for call in to_start:
+            self._start(call)
+
+    def _on_wakeup(self):
+        "Called when a token is available again."
+        with self.lock:
+            self.wakeup = None
+        self._dispatch()
+
+    def _start(self, call):
+        "Sends a call to the service."
+        try:
+            service = getattr(self.services, self.service_name)
+            if service is None:
+                raise RuntimeError("Service %s not found" % self.service_name)
+            method = getattr(service, call.method_name)
+            call.future = method(*call.args, _async=True)
+        except Exception as exc:
+            self._finish(call, error=str(exc) or type(exc).__name__)
+            return
+        if call.cancel_requested:
+            call.future.cancel()
+        call.future.addCallback(functools.partial(self._on_done, call))
+
+    def _on_done(self, call, future):
+        "Callback for when a call is finished."
+        if future.hasError():
+            self._finish(call, error=future.error())
+        elif future.isCanceled():
+            self._finish(call, canceled=True)
+        else:
+            self._finish(call, value=future.value())
+
+    def _finish(self, call, value=None, error=None, canceled=False):
+        "Sets the result of a call that was started, and starts the next."
+        with self.lock:
+            call.state = DONE
+            self.running -= 1
+            if error is not None:
+                self.errors += 1
+            elif canceled:
+                self.canceled += 1
+            else:
+                self.done += 1
+        if error is not None:
+            call.promise.setError(error)
+        elif canceled:
+            call.promise.setCanceled()
+        else:
+            call.promise.setValue(value)
+        self._dispatch()
+
+    def _on_cancel(self, call, promise):
+        "Someone cancelled the future of a call."
+        with self.lock:
+            state = call.state
+            if state == PENDING:
+                call.state = CANCELED
+                if self.tags.get(call.tag) is call:
+                    del self.tags[call.tag]
+                self.pending -= 1
+                self.canceled += 1
+            elif state == RUNNING:
+                call.cancel_requested = True
+        if state == PENDING:
+            promise.setCanceled()
+        elif state == RUNNING and call.future is not None:
+            call.future.cancel()
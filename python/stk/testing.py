@@ -0,0 +1,871 @@
+"""
+stk.testing.py
+
+A fake of the parts of the qi module that stk uses, in pure Python, for
+running tests and benchmarks without a robot (or without qi at all).
+
+Simply:
+
+import stk.testing
+stk.testing.install()   # before importing stk modules, or anything using qi
+
+... after that, "import qi" gives the fake module, with futures and promises,
+qi.async, signals, and an Application whose session has fake ALMemory and
+ServiceDirectory services (and can register your own). Calls to services can
+be given some latency (see Session.set_latency), to look more like the real
+thing.
+"""
+
+__version__ = "0.1.0"
+
+__copyright__ = "Copyright 2017, Aldebaran Robotics / Softbank Robotics Europe"
+
+import atexit
+import collections
+import itertools
+import os
+import Queue
+import sys
+import threading
+import time
+import traceback
+import types
+
+FAKE_URL = "tcp://127.0.0.1:9559"
+
+MICROSECONDS_PER_SECOND = 1000000.0
+
+
+class FutureState(object):
+    "Same values as qi.FutureState."
+    None_ = 0
+    Running = 1
+    Canceled = 2
+    FinishedWithError = 3
+    FinishedWithValue = 4
+
+
+class FutureTimeout(object):
+    "Same values as qi.FutureTimeout (in milliseconds)."
+    Infinite = 0x7fffffff
+    None_ = 0
+
+
+#
+# Executor: runs callbacks and async calls, like qi's thread pool
+#
+
+class _Executor(object):
+    """A pool of threads, started as needed.
+
+    As with qi, callbacks may block (e.g. waiting for another future), so a
+    new thread is started whenever all the others are busy (up to
+    max_threads; after that, tasks wait for a thread)."""
+    def __init__(self, max_threads=100):
+        self.max_threads = max_threads
+        self.tasks = Queue.Queue()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.idle = 0  # threads waiting for a task
+        self.queued = 0  # tasks waiting for a thread
+        self.stopped = False
+
+    def post(self, func, *args):
+        "Runs func(*args) in a thread of the pool (unless it was stopped)."
+        thread = None
+        with self.lock:
+            if self.stopped:
+                return
+            if self.idle:
+                self.idle -= 1
+            elif len(self.threads) < self.max_threads:
+                thread = threading.Thread(target=self._work,
+                                          name="stk.testing.executor")
+                thread.daemon = True
+                self.threads.append(thread)
+            else:
+                self.queued += 1
+        self.tasks.put((func, args))
+        if thread:
+            thread.start()
+
+    def stop(self, timeout=1.0):
+        """Stops the threads, waiting at most timeout seconds for the busy
+        ones; tasks posted after that are ignored.
+
+        Called at exit: daemon threads still running while the interpreter
+        shuts down fail with confusing errors."""
+        with self.lock:
+            self.stopped = True
+            threads = list(self.threads)
+        for _ in threads:
+            self.tasks.put(None)
+        deadline = time.time() + timeout
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+
+    def post_delayed(self, delay, func, *args):
+        """Runs func(*args) in a thread of the pool after delay seconds.
+
+        Returns a timer object, that can be cancelled."""
+        timer = threading.Timer(delay, self.post, (func,) + args)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def _work(self):
+        "Thread of the pool."
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            func, args = task
+            try:
+                func(*args)
+            except Exception:
+                # qi would log it
+                traceback.print_exc()
+            with self.lock:
+                if self.queued:
+                    # Take a task that is waiting for a thread.
+                    self.queued -= 1
+                else:
+                    self.idle += 1
+
+_EXECUTOR = _Executor()
+atexit.register(_EXECUTOR.stop)
+
+
+#
+# Futures and promises
+#
+
+class _SharedState(object):
+    "The state shared by a promise and its futures."
+    def __init__(self, promise, on_cancel):
+        self.promise = promise
+        self.on_cancel = on_cancel
+        self.condition = threading.Condition(threading.Lock())
+        self.state = FutureState.Running
+        self.value = None
+        self.error = ""
+        self.cancel_requested = False
+        self.callbacks = []
+
+    def finish(self, state, value=None, error=""):
+        "Sets the result, and schedules the callbacks."
+        with self.condition:
+            if self.state != FutureState.Running:
+                raise RuntimeError("Future is already finished")
+            self.state = state
+            self.value = value
+            self.error = error
+            callbacks = self.callbacks
+            self.callbacks = None
+            self.condition.notify_all()
+        for callback in callbacks:
+            _EXECUTOR.post(callback)
+
+    def add_callback(self, callback):
+        "Schedules callback() when finished (now if already finished)."
+        with self.condition:
+            if self.callbacks is not None:
+                self.callbacks.append(callback)
+                return
+        _EXECUTOR.post(callback)
+
+    def wait(self, timeout):
+        "Waits for the result at most timeout milliseconds; returns state."
+        with self.condition:
+            if self.state == FutureState.Running and timeout:
+                if timeout >= FutureTimeout.Infinite:
+                    while self.state == FutureState.Running:
+                        self.condition.wait()
+                else:
+                    deadline = time.time() + timeout / 1000.0
+                    while self.state == FutureState.Running:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self.condition.wait(remaining)
+            return self.state
+
+
+class Promise(object):
+    """Fake qi.Promise.
+
+    on_cancel, if given, is called with the promise when someone calls
+    .cancel() on one of its futures."""
+    def __init__(self, on_cancel=None):
+        self._shared = _SharedState(self, on_cancel)
+
+    def future(self):
+        "Returns a future for this promise."
+        return Future(self._shared)
+
+    def setValue(self, value):
+        "Finishes the future with a value."
+        self._shared.finish(FutureState.FinishedWithValue, value=value)
+
+    def setError(self, error):
+        "Finishes the future with an error (a string)."
+        self._shared.finish(FutureState.FinishedWithError, error=str(error))
+
+    def setCanceled(self):
+        "Finishes the future as cancelled."
+        self._shared.finish(FutureState.Canceled)
+
+    def isCancelRequested(self):
+        "Has someone called cancel() on one of the futures?"
+        return self._shared.cancel_requested
+
+
+class Future(object):
+    "Fake qi.Future (get one from a Promise)."
+    def __init__(self, shared):
+        self._shared = shared
+
+    def wait(self, timeout=FutureTimeout.Infinite):
+        "Waits at most timeout milliseconds; returns a FutureState."
+        return self._shared.wait(timeout)
+
+    def value(self, timeout=FutureTimeout.Infinite):
+        "Waits for the value, raises RuntimeError on error or cancellation."
+        state = self._shared.wait(timeout)
+        if state == FutureState.FinishedWithValue:
+            return self._shared.value
+        elif state == FutureState.FinishedWithError:
+            raise RuntimeError(self._shared.error)
+        elif state == FutureState.Canceled:
+            raise RuntimeError("Future canceled")
+        raise RuntimeError("Future timeout")
+
+    def error(self, timeout=FutureTimeout.Infinite):
+        "Waits, and returns the error ('' if there isn't any)."
+        self._shared.wait(timeout)
+        return self._shared.error
+
+    def hasValue(self, timeout=FutureTimeout.Infinite):
+        "Waits, and returns whether the future has a value."
+        return self._shared.wait(timeout) == FutureState.FinishedWithValue
+
+    def hasError(self, timeout=FutureTimeout.Infinite):
+        "Waits, and returns whether the future has an error."
+        return self._shared.wait(timeout) == FutureState.FinishedWithError
+
+    def isRunning(self):
+        "Is the future still running?"
+        return self._shared.state == FutureState.Running
+
+    def isFinished(self):
+        "Is the future finished (with a value, an error, or cancelled)?"
+        return self._shared.state != FutureState.Running
+
+    def isCanceled(self):
+        "Was the future cancelled?"
+        return self._shared.state == FutureState.Canceled
+
+    def isCancelable(self):
+        "Futures can always be cancelled (but it may do nothing)."
+        return True
+
+    def cancel(self):
+        "Asks the promise to cancel (calls its on_cancel callback)."
+        shared = self._shared
+        with shared.condition:
+            if (shared.state != FutureState.Running or
+                    shared.cancel_requested):
+                return
+            shared.cancel_requested = True
+        if shared.on_cancel:
+            shared.on_cancel(shared.promise)
+
+    def addCallback(self, callback):
+        """Calls callback(future) when it's finished, in another thread.
+
+        As with qi, the callback gets a new Future object."""
+        self._shared.add_callback(lambda: callback(Future(self._shared)))
+
+    def then(self, callback):
+        """Calls callback(future) when finished; returns a future of its
+        result (cancelling it cancels this one)."""
+        promise = Promise(lambda _: self.cancel())
+        def run_callback():
+            "Sets the promise with the callback's result."
+            _set_from_call(promise, callback, self)
+        self._shared.add_callback(run_callback)
+        return promise.future()
+
+    def andThen(self, callback):
+        """Calls callback(value) if the future gets a value; returns a future
+        of its result (errors and cancellation are propagated)."""
+        promise = Promise(lambda _: self.cancel())
+        def run_callback():
+            "Sets the promise with the callback's result, if needed."
+            state = self._shared.state
+            if state == FutureState.FinishedWithValue:
+                _set_from_call(promise, callback, self._shared.value)
+            elif state == FutureState.FinishedWithError:
+                promise.setError(self._shared.error)
+            else:
+                promise.setCanceled()
+        self._shared.add_callback(run_callback)
+        return promise.future()
+
+
+def _set_from_call(promise, func, *args):
+    "Sets the promise with the result of func(*args), or its exception."
+    try:
+        result = func(*args)
+    except Exception as exc:
+        promise.setError(str(exc))
+    else:
+        promise.setValue(result)
+
+
+def _async(func, *args, **kwargs):
+    """Fake qi.async: calls func(*args) in another thread, returns a future.
+
+    The only keyword argument is delay, in microseconds. Cancelling the
+    future before the call started prevents it."""
+    delay = kwargs.pop("delay", 0)
+    if kwargs:
+        raise TypeError("Unexpected arguments: %s" % ", ".join(kwargs))
+    timer = []
+    def on_cancel(promise):
+        "Cancel the call if it didn't start yet."
+        with lock:
+            if started:
+                return
+            started.append(False)
+        if timer:
+            timer[0].cancel()
+        promise.setCanceled()
+    promise = Promise(on_cancel)
+    lock = threading.Lock()
+    started = []
+    def run():
+        "Call func, unless it was cancelled."
+        with lock:
+            if started:
+                return
+            started.append(True)
+        _set_from_call(promise, func, *args)
+    if delay > 0:
+        timer.append(_EXECUTOR.post_delayed(delay / MICROSECONDS_PER_SECOND,
+                                            run))
+    else:
+        _EXECUTOR.post(run)
+    return promise.future()
+
+
+#
+# Signals, and services
+#
+
+class Signal(object):
+    """Fake qi.Signal: connected callbacks are called (in other threads)
+    when it's triggered.
+
+    Callbacks are called one at a time, in the order of the triggers."""
+    def __init__(self, *args, **kwargs):
+        self._callbacks = {}
+        self._link_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._pending = collections.deque()  # (callbacks, args) to call
+        self._delivering = False
+
+    def connect(self, callback):
+        "Connects a callback; returns a link id."
+        link_id = next(self._link_ids)
+        with self._lock:
+            self._callbacks[link_id] = callback
+        return link_id
+
+    def disconnect(self, link_id):
+        "Disconnects a callback; returns whether it was connected."
+        with self._lock:
+            return self._callbacks.pop(link_id, None) is not None
+
+    def disconnectAll(self):
+        "Disconnects all callbacks."
+        with self._lock:
+            self._callbacks.clear()
+
+    def __call__(self, *args):
+        "Triggers the signal."
+        with self._lock:
+            if not self._callbacks:
+                return
+            self._pending.append((list(self._callbacks.values()), args))
+            if self._delivering:
+                return
+            self._delivering = True
+        _EXECUTOR.post(self._deliver)
+
+    def _deliver(self):
+        "Calls the callbacks of the pending triggers, in order."
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._delivering = False
+                    return
+                callbacks, args = self._pending.popleft()
+            for callback in callbacks:
+                try:
+                    callback(*args)
+                except Exception:
+                    # qi would log it
+                    traceback.print_exc()
+
+
+class _Subscriber(object):
+    "What ALMemory.subscriber returns."
+    def __init__(self):
+        self.signal = Signal()
+
+
+class ALMemory(object):
+    "Fake ALMemory: data, events, and subscribers."
+    def __init__(self):
+        self._data = {}
+        self._subscribers = {}
+        self._subscribed = {}  # event: set of module names
+        self._lock = threading.Lock()
+
+    def getData(self, key):
+        "Returns the value of a key, raises RuntimeError if there is none."
+        try:
+            return self._data[key]
+        except KeyError:
+            raise RuntimeError("ALMemory::getData: Data %s does not exist"
+                               % key)
+
+    def getDataList(self, filter_string):
+        "Returns the keys containing the given string."
+        return [key for key in self._data if filter_string in key]
+
+    def insertData(self, key, value):
+        "Sets the value of a key, without raising an event."
+        self._data[key] = value
+
+    def raiseEvent(self, key, value):
+        "Sets the value of a key, and notifies its subscribers."
+        self._data[key] = value
+        subscriber = self._subscribers.get(key)
+        if subscriber:
+            subscriber.signal(value)
+
+    def removeData(self, key):
+        "Removes a key."
+        self._data.pop(key, None)
+
+    def subscriber(self, key):
+        "Returns an object whose .signal is triggered when key is raised."
+        with self._lock:
+            if key not in self._subscribers:
+                self._subscribers[key] = _Subscriber()
+            return self._subscribers[key]
+
+    def subscribeToEvent(self, event, module_name, method_name):
+        "Records a subscription (for extractors that have side effects)."
+        with self._lock:
+            self._subscribed.setdefault(event, set()).add(module_name)
+
+    def unsubscribeToEvent(self, event, module_name):
+        "Removes a subscription."
+        with self._lock:
+            self._subscribed.get(event, set()).discard(module_name)
+
+    def getSubscribers(self, event):
+        "Returns the names of modules subscribed to an event."
+        return sorted(self._subscribed.get(event, ()))
+
+
+class ServiceDirectory(object):
+    "Fake ServiceDirectory, listing the services of a session."
+    def __init__(self):
+        self.serviceAdded = Signal()
+        self.serviceRemoved = Signal()
+        self._infos = {}  # name: service info
+
+    def services(self):
+        """Returns the infos of all services, as lists (name, service id,
+        machine id, process id, endpoints, session id)."""
+        return sorted(self._infos.values(), key=lambda info: info[1])
+
+    def service(self, name):
+        "Returns the info of the given service."
+        try:
+            return self._infos[name]
+        except KeyError:
+            raise RuntimeError("Cannot find service '%s'" % name)
+
+    def _add(self, name, service_id):
+        "Internal - a service was registered."
+        self._infos[name] = [name, service_id, "fake-machine", os.getpid(),
+                             [FAKE_URL], "fake-session"]
+        self.serviceAdded(service_id, name)
+
+    def _remove(self, name, service_id):
+        "Internal - a service was unregistered."
+        del self._infos[name]
+        self.serviceRemoved(service_id, name)
+
+
+class _ServiceProxy(object):
+    """What Session.service returns: calls the object's methods after the
+    session's latency, with the _async=True keyword returning a future.
+
+    Calls to a service are started in the order they were made, whether they
+    are synchronous or not (see _Link).
+
+    As with qi, private members aren't visible, errors become RuntimeErrors
+    and methods returning futures are waited for."""
+    def __init__(self, session, name, obj):
+        self._session = session
+        self._name = name
+        self._obj = obj
+
+    def __getattr__(self, member_name):
+        if member_name.startswith("_"):
+            raise AttributeError(member_name)
+        member = getattr(self._obj, member_name)
+        if not callable(member) or isinstance(member, Signal):
+            return member
+        session, name = self._session, self._name
+        def call(*args, **kwargs):
+            "Calls the method, synchronously or not."
+            is_async = kwargs.pop("_async", False)
+            link = session._get_link(name)
+            latency = session.get_latency(name)
+            if is_async:
+                return link.send(latency, _call_method, member, args)
+            return link.call(latency, _call_method, member, args)
+        call.__name__ = member_name
+        call.__doc__ = member.__doc__
+        return call
+
+    def __repr__(self):
+        return "<fake service %s>" % self._name
+
+
+def _call_method(method, args):
+    "Calls a service method, like a remote call."
+    try:
+        result = method(*args)
+    except Exception as exc:
+        raise RuntimeError("%s: %s" % (type(exc).__name__, exc))
+    if isinstance(result, Future):
+        result = result.value()
+    return result
+
+
+class _Link(object):
+    """Delivers calls to a service after some latency, in order: a call is
+    only started once the calls made before it finished, or have been
+    running for overlap seconds (calls that block run concurrently, as with
+    qi)."""
+    overlap = 0.02
+
+    def __init__(self):
+        self.calls = collections.deque()  # deadline, start, started, finished
+        self.lock = threading.Lock()
+        self.delivering = False
+
+    def send(self, latency, func, *args):
+        """Calls func(*args) (in the executor) after latency seconds;
+        returns a future of its result.
+
+        Cancelling the future before the call started prevents it."""
+        started = threading.Event()
+        finished = threading.Event()
+        lock = threading.Lock()
+        def on_cancel(promise):
+            "Cancel the call if it didn't start yet."
+            with lock:
+                if started.is_set():
+                    return
+                started.set()
+                finished.set()
+            promise.setCanceled()
+        promise = Promise(on_cancel)
+        def run():
+            "Call func, unless it was cancelled."
+            with lock:
+                if started.is_set():
+                    return
+                started.set()
+            try:
+                _set_from_call(promise, func, *args)
+            finally:
+                finished.set()
+        self._put((time.time() + latency, lambda: _EXECUTOR.post(run),
+                   started, finished))
+        return promise.future()
+
+    def call(self, latency, func, *args):
+        "Calls func(*args) in this thread, after latency seconds."
+        turn = threading.Event()
+        started = threading.Event()
+        finished = threading.Event()
+        self._put((time.time() + latency, turn.set, started, finished))
+        turn.wait()
+        started.set()
+        try:
+            return func(*args)
+        finally:
+            finished.set()
+
+    def _put(self, call):
+        "Queues a call, and starts delivering if needed."
+        with self.lock:
+            self.calls.append(call)
+            if self.delivering:
+                return
+            self.delivering = True
+        _EXECUTOR.post(self._deliver)
+
+    def _deliver(self):
+        "Delivers the queued calls (in a thread of the executor)."
+        while True:
+            with self.lock:
+                if not self.calls:
+                    self.delivering = False
+                    return
+                deadline, start, started, finished = self.calls.popleft()
+            delay = deadline - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            start()
+            started.wait()
+            finished.wait(self.overlap)
+
+
+_DEFAULT_LATENCY = [0.0]
+
+
+class Session(object):
+    """Fake qi.Session, with ALMemory and ServiceDirectory services.
+
+    Objects registered as services are available to everyone using the
+    session (and no one else)."""
+    def __init__(self):
+        self.connected = Signal()
+        self.disconnected = Signal()
+        self.url = None
+        self._connected = False
+        self._services = {}  # name: (service id, object)
+        self._service_ids = itertools.count(1)
+        self._latency = _DEFAULT_LATENCY[0]
+        self._latencies = {}
+        self._links = {}  # service name: _Link delivering calls to it
+        self._lock = threading.Lock()
+        self._reset_services()
+
+    def _reset_services(self):
+        "Internal - starts with only new ServiceDirectory and ALMemory."
+        with self._lock:
+            self._services = {}
+        self.service_directory = ServiceDirectory()
+        self.memory = ALMemory()
+        self.registerService("ServiceDirectory", self.service_directory)
+        self.registerService("ALMemory", self.memory)
+
+    def connect(self, url=FAKE_URL):
+        "Connects (to nothing)."
+        self.url = url
+        self._connected = True
+        self.connected()
+
+    def close(self):
+        """Disconnects (triggers the disconnected signal).
+
+        As when NAOqi restarts, registered services, and ALMemory data and
+        subscribers, are lost: ALMemory and ServiceDirectory are new ones."""
+        if self._connected:
+            self._connected = False
+            self._reset_services()
+            self.disconnected("Session closed")
+
+    def isConnected(self):
+        "Is the session connected?"
+        return self._connected
+
+    def listen(self, url):
+        "Does nothing."
+        pass
+
+    def set_latency(self, latency, service_name=None):
+        """Sets the duration (in seconds) of each call to a service.
+
+        If service_name is None, for all services that don't have their own
+        latency."""
+        if service_name:
+            self._latencies[service_name] = latency
+        else:
+            self._latency = latency
+
+    def get_latency(self, service_name):
+        "Returns the duration of calls to a service, in seconds."
+        return self._latencies.get(service_name, self._latency)
+
+    def _get_link(self, service_name):
+        "Returns the _Link delivering calls to a service."
+        with self._lock:
+            if service_name not in self._links:
+                self._links[service_name] = _Link()
+            return self._links[service_name]
+
+    def service(self, name):
+        "Returns a proxy to a service, raises RuntimeError if there is none."
+        with self._lock:
+            if name not in self._services:
+                raise RuntimeError("Cannot find service '%s' in index"
+                                   % name)
+            return _ServiceProxy(self, name, self._services[name][1])
+
+    def services(self):
+        "Returns the infos of all services (see ServiceDirectory.services)."
+        return self.service_directory.services()
+
+    def registerService(self, name, obj):
+        "Registers an object as a service; returns its id."
+        with self._lock:
+            if name in self._services:
+                raise RuntimeError("Service already registered: %s" % name)
+            service_id = next(self._service_ids)
+            self._services[name] = (service_id, obj)
+        self.service_directory._add(name, service_id)
+        return service_id
+
+    def unregisterService(self, service_id):
+        "Unregisters a service, given its id."
+        with self._lock:
+            for name, (other_id, _) in self._services.items():
+                if other_id == service_id:
+                    del self._services[name]
+                    break
+            else:
+                raise RuntimeError("Can't find service #%s" % service_id)
+        self.service_directory._remove(name, service_id)
+
+
+class Application(object):
+    """Fake qi.Application, with a fake Session.
+
+    run() blocks until stop() is called."""
+    def __init__(self, args=None, autoExit=True, url=None):
+        self.url = url or FAKE_URL
+        self.session = Session()
+        self._stopped = threading.Event()
+
+    def start(self):
+        "Connects the session."
+        if not self.session.isConnected():
+            self.session.connect(self.url)
+
+    def run(self):
+        "Runs until stop() is called."
+        self.start()
+        self._stopped.wait()
+
+    def stop(self):
+        "Makes run() return."
+        self._stopped.set()
+
+
+#
+# The rest of qi that stk uses
+#
+
+class Logger(object):
+    "Fake qi.logging.Logger: doesn't log anything."
+    def __init__(self, category):
+        self.category = category
+
+    def _log(self, message):
+        "Does nothing"
+        pass
+
+    fatal = error = warning = info = verbose = _log
+
+
+def module(name):
+    "Fake qi.module: no module can be found."
+    raise RuntimeError("Can't find module %s" % name)
+
+
+def bind(returnType=None, paramsType=None, methodName=None):
+    "Fake qi.bind: doesn't change the method."
+    def decorator(func):
+        "Returns the function."
+        return func
+    return decorator
+
+
+def nobind(func):
+    "Fake qi.nobind: doesn't change the method."
+    return func
+
+
+def _make_module(name="qi"):
+    "Returns a new fake qi module."
+    fake = types.ModuleType(name, "Fake qi module, from stk.testing")
+    fake.__version__ = "2.5.0"
+    fake.Promise = Promise
+    fake.Future = Future
+    fake.FutureState = FutureState
+    fake.FutureTimeout = FutureTimeout
+    fake.Signal = Signal
+    fake.Session = Session
+    fake.Application = Application
+    fake.module = module
+    fake.bind = bind
+    fake.nobind = nobind
+    fake.runAsync = _async
+    setattr(fake, "async", _async)
+    fake.logging = types.ModuleType(name + ".logging")
+    fake.logging.Logger = Logger
+    for type_name in ("Void", "Bool", "Int8", "Int16", "Int32", "Int64",
+                      "UInt8", "UInt16", "UInt32", "UInt64", "Float",
+                      "Double", "String", "Dynamic", "Object", "Buffer"):
+        setattr(fake, type_name, type_name)
+    fake.List = fake.Map = lambda *args: args
+    fake.is_fake = True
+    return fake
+
+
+def install(latency=0.0):
+    """Makes "import qi" return the fake qi module, and returns it.
+
+    Modules that already imported qi (such as stk's) are updated. Services
+    of sessions created afterwards answer after latency seconds."""
+    fake = sys.modules.get("qi")
+    if not is_installed():
+        fake = _make_module()
+        real = sys.modules.get("qi")
+        sys.modules["qi"] = fake
+        sys.modules["qi.logging"] = fake.logging
+        if real is not None:
+            for module_object in list(sys.modules.values()):
+                if getattr(module_object, "qi", None) is real:
+                    module_object.qi = fake
+    _DEFAULT_LATENCY[0] = latency
+    return fake
+
+
+def is_installed():
+    "Is the fake qi module installed?"
+    return getattr(sys.modules.get("qi"), "is_fake", False)
+
+
+def has_real_qi():
+    "Can the real qi module be imported?"
+    if is_installed():
+        return False
+    try:
+        import qi
+        return True
+    except ImportError:
+        return False
@@ -0,0 +1,267 @@
+"""
+stk.video.py
+
+Helper for getting camera images from ALVideoDevice, as NumPy arrays.
+
+Simply:
+
+stream = stk.video.CameraStream(qiapp.session, fps=15)
+stream.start()
+with stream.get_frame() as frame:
+    process(frame.array)   # a NumPy array, height x width x layers
+stream.stop()
+
+Frames are copied into a small pool of preallocated arrays, that are reused
+(so release frames, or use "with", when you're done with them). With
+prefetch=True, a background thread keeps fetching images, and get_frame()
+returns the latest one.
+
+NumPy is only needed when a CameraStream is created.
+"""
+
+__version__ = "0.1.0"
+
+__copyright__ = "Copyright 2017, Aldebaran Robotics / Softbank Robotics Europe"
+
+import threading
+import time
+
+# Cameras
+TOP_CAMERA = 0
+BOTTOM_CAMERA = 1
+DEPTH_CAMERA = 2
+
+# Resolutions
+QQVGA = 0  # 160x120
+QVGA = 1  # 320x240
+VGA = 2  # 640x480
+K4VGA = 3  # 1280x960
+
+# Color spaces
+YUV422_COLOR_SPACE = 9
+YUV_COLOR_SPACE = 10
+RGB_COLOR_SPACE = 11
+HSY_COLOR_SPACE = 12
+BGR_COLOR_SPACE = 13
+DEPTH_COLOR_SPACE = 17
+DISTANCE_COLOR_SPACE = 21
+RAW_DEPTH_COLOR_SPACE = 23
+
+# Color spaces with 16 bits per pixel
+_DEPTH_COLOR_SPACES = (DEPTH_COLOR_SPACE, DISTANCE_COLOR_SPACE,
+                       RAW_DEPTH_COLOR_SPACE)
+
+# Fields of the images returned by ALVideoDevice.getImageRemote
+_WIDTH, _HEIGHT, _LAYERS, _COLOR_SPACE, _SECONDS, _MICROSECONDS, _DATA, \
+    _CAMERA = range(8)
+
+
+class Frame(object):
+    """An image, in an array of the pool; release it when done.
+
+    Can be used with "with", which releases it at the end of the block."""
+    __slots__ = ("array", "timestamp", "camera", "color_space", "_stream")
+
+    def __init__(self, stream, array, timestamp, camera, color_space):
+        self._stream = stream
+        self.array = array
+        self.timestamp = timestamp
+        self.camera = camera
+        self.color_space = color_space
+
+    def release(self):
+        "Gives the array back to the pool (don't use it afterwards)."
+        if self._stream:
+            self._stream._release(self.array)
+            self._stream = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.release()
+
+
+class CameraStream(object):
+    """Subscribes to a camera, and gets its images as NumPy arrays.
+
+    Each image is copied once, directly from the buffer qi returns into one
+    of pool_size preallocated arrays (with numpy.frombuffer, without any
+    intermediate copy or allocation).
+
+    With prefetch=True, a background thread fetches images continuously,
+    and get_frame() returns the latest one; images that were never returned,
+    or that couldn't be fetched because all the arrays were in use, are
+    counted as dropped (see stats()).
+
+    Can be used with "with" (which starts and stops it), or as one of the
+    components of an activity run by stk.runner (on_start and on_stop).
+    """
+    def __init__(self, session, name="stk_video", camera=TOP_CAMERA,
+                 resolution=QVGA, color_space=RGB_COLOR_SPACE, fps=15,
+                 pool_size=3, prefetch=False):
+        import numpy
+        self.numpy = numpy
+        self.session = session
+        self.name = name
+        self.camera = camera
+        self.resolution = resolution
+        self.color_space = color_space
+        self.fps = fps
+        self.prefetch = prefetch
+        self.video_device = None
+        self.handle = None
+        self.free_arrays = [None] * pool_size  # allocated on first image
+        self.condition = threading.Condition()
+        self.latest = None  # prefetched Frame, not returned yet
+        self.running = False
+        self.thread = None
+        self.start_time = None
+        self.fetched = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def start(self):
+        "Subscribes to the camera, and starts prefetching if needed."
+        if self.running:
+            return
+        self.video_device = self.session.service("ALVideoDevice")
+        self.handle = self.video_device.subscribeCamera(
+            self.name, self.camera, self.resolution, self.color_space,
+            self.fps)
+        self.running = True
+        self.start_time = time.time()
+        if self.prefetch:
+            self.thread = threading.Thread(target=self._prefetch,
+                                           name="stk.video.prefetch")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        "Stops prefetching, and unsubscribes from the camera."
+        if not self.running:
+            return
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        with self.condition:
+            if self.latest:
+                self.latest.release()
+                self.latest = None
+        self.video_device.unsubscribe(self.handle)
+        self.handle = None
+
+    on_start = start
+    on_stop = stop
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop()
+
+    def get_frame(self, timeout=None):
+        """Returns the next image, as a Frame (to be released).
+
+        With prefetching, waits at most timeout seconds (forever if None)
+        for an image, and returns None if there wasn't any."""
+        if not self.prefetch:
+            if not self.free_arrays:
+                self.dropped += 1
+                raise RuntimeError("All the arrays are in use, release some "
+                                   "frames (or use a bigger pool_size)")
+            frame = self._fetch()
+            if frame is None:
+                raise RuntimeError("Could not get an image from camera %s"
+                                   % self.camera)
+            self.delivered += 1
+            return frame
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.condition:
+            while self.latest is None and self.running:
+                if deadline is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+            frame, self.latest = self.latest, None
+            if frame:
+                self.delivered += 1
+            return frame
+
+    def stats(self):
+        """Returns a dictionary with the number of images fetched, delivered
+        and dropped, of errors, and the delivered frame rate."""
+        duration = time.time() - self.start_time if self.start_time else 0
+        return {"fetched": self.fetched, "delivered": self.delivered,
+                "dropped": self.dropped, "errors": self.errors,
+                "fps": self.delivered / duration if duration > 0 else 0.0}
+
+    def _prefetch(self):
+        "Prefetching thread."
+        interval = 1.0 / self.fps
+        while self.running:
+            start = time.time()
+            frame = self._fetch()
+            if frame:
+                with self.condition:
+                    if self.latest:
+                        # Never returned, there is a more recent one.
+                        self.latest.release()
+                        self.dropped += 1
+                    self.latest = frame
+                    self.condition.notify_all()
+            # (the camera won't have a new image before that)
+            time.sleep(max(0, interval - (time.time() - start)))
+
+    def _fetch(self):
+        "Gets an image, and copies it into an array of the pool."
+        try:
+            image = self.video_device.getImageRemote(self.handle)
+        except RuntimeError:
+            image = None
+        if not image:
+            self.errors += 1
+            return None
+        self.fetched += 1
+        dtype = self.numpy.uint8
+        layers = image[_LAYERS]
+        if image[_COLOR_SPACE] in _DEPTH_COLOR_SPACES:
+            dtype = self.numpy.uint16
+            layers = max(1, layers // 2)
+        shape = (image[_HEIGHT], image[_WIDTH], layers)
+        array = self._acquire(shape, dtype)
+        if array is None:
+            self.dropped += 1
+            return None
+        # No copy, just a view of qi's buffer...
+        data = self.numpy.frombuffer(image[_DATA], dtype, array.size)
+        # ... copied directly into our array.
+        array.reshape(-1)[:] = data
+        return Frame(self, array,
+                     image[_SECONDS] + image[_MICROSECONDS] / 1000000.0,
+                     image[_CAMERA] if len(image) > _CAMERA else self.camera,
+                     image[_COLOR_SPACE])
+
+    def _acquire(self, shape, dtype):
+        "Takes an array from the pool (or None if they are all used)."
+        with self.condition:
+            if not self.free_arrays:
+                return None
+            array = self.free_arrays.pop()
+        if array is None or array.shape != shape or array.dtype != dtype:
+            # First image, or the format changed
+            array = self.numpy.empty(shape, dtype)
+        return array
+
+    def _release(self, array):
+        "Gives an array back to the pool."
+        with self.condition:
+            self.free_arrays.append(array)
@@ -5,27 +5,119 @@ Created on Wed Jan  4 15:20:32 2017
 @author: ekroeger
 """
 
-import stk.runner
-import stk.services
+import json
+import platform
+import sys
+import time
+
+import stk.testing
 
 import pytest
 
 def pytest_addoption(parser):
     parser.addoption("--qiurl", action="store",
         help="URL of the robot to connect to")
+    parser.addoption("--fakeqi", action="store_true",
+        help="Use the fake qi of stk.testing instead of a robot (default "
+             "if qi isn't installed)")
+    parser.addoption("--fakeqi-latency", action="store", type=float,
+        default=0.0, help="Duration of calls to fake services, in seconds")
+    parser.addoption("--benchmark", action="store_true",
+        help="Run the benchmarks (tests marked benchmark)")
+    parser.addoption("--benchmark-save", action="store",
+        help="Save the benchmark results in this JSON file")
+    parser.addoption("--benchmark-compare", action="store",
+        help="Compare the benchmark results with this JSON file")
+    parser.addoption("--benchmark-tolerance", action="store", type=float,
+        default=2.0, help="Fail benchmarks that many times worse than the "
+                          "compared results")
+
+def pytest_configure(config):
+    # Must be done before stk modules import qi
+    if config.getoption("--fakeqi") or not stk.testing.has_real_qi():
+        stk.testing.install(config.getoption("--fakeqi-latency"))
+    config.addinivalue_line("markers",
+        "benchmark: a benchmark, only run with --benchmark")
+
+def pytest_collection_modifyitems(config, items):
+    # Benchmarks are slow, and their results depend on the machine's load
+    if (config.getoption("--benchmark") or
+            config.getoption("--benchmark-save") or
+            config.getoption("--benchmark-compare")):
+        return
+    skip = pytest.mark.skip(reason="benchmark (run with --benchmark)")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
 
 g_qiapp = None
 
 @pytest.fixture
 def qiapp(request):
+    import stk.runner
     global g_qiapp
     if not g_qiapp:
         qiurl = request.config.getoption("--qiurl")
+        if stk.testing.is_installed():
+            qiurl = qiurl or stk.testing.FAKE_URL
         g_qiapp =  stk.runner.init(qiurl)
     return g_qiapp
 
 @pytest.fixture
-def services(request):
-    _qiapp = qiapp(request)
-    return stk.services.ServiceCache(_qiapp.session)
+def services(qiapp):
+    import stk.services
+    return stk.services.ServiceCache(qiapp.session)
+
+g_benchmark_results = {}
+
+class Benchmark(object):
+    "Records the results of benchmarks (see test_benchmarks.py)."
+    def __init__(self, config):
+        self.baseline = {}
+        self.tolerance = config.getoption("--benchmark-tolerance")
+        path = config.getoption("--benchmark-compare")
+        if path:
+            with open(path) as baseline_file:
+                self.baseline = json.load(baseline_file)["results"]
+
+    def time_per_call(self, func, number=1000, repeat=5):
+        "Returns the duration of func() in seconds (best of repeat runs)."
+        durations = []
+        for _ in range(repeat):
+            start = time.time()
+            for _ in xrange(number):
+                func()
+            durations.append((time.time() - start) / number)
+        return min(durations)
+
+    def record(self, name, value, unit, higher_is_better=False):
+        "Records a result, failing if it's much worse than the baseline."
+        g_benchmark_results[name] = {"value": value, "unit": unit,
+                                     "higher_is_better": higher_is_better}
+        print "%s: %.3f %s" % (name, value, unit)
+        if name in self.baseline and value and self.baseline[name]["value"]:
+            old_value = self.baseline[name]["value"]
+            if higher_is_better:
+                ratio = old_value / value
+            else:
+                ratio = value / old_value
+            if ratio > self.tolerance:
+                pytest.fail("%s regressed: %.3f %s instead of %.3f"
+                            % (name, value, unit, old_value))
+
+@pytest.fixture
+def benchmark(request):
+    return Benchmark(request.config)
 
+def pytest_sessionfinish(session):
+    path = session.config.getoption("--benchmark-save")
+    if path and g_benchmark_results:
+        with open(path, "w") as results_file:
+            json.dump({"python": sys.version.split()[0],
+                       "platform": platform.platform(),
+                       "fakeqi": stk.testing.is_installed(),
+                       "fakeqi_latency":
+                           session.config.getoption("--fakeqi-latency"),
+                       "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                       "results": g_benchmark_results},
+                      results_file, indent=2, sort_keys=True)
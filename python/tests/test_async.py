@@ -399,6 +399,192 @@ def test_sleep_more(services):
 
 
 
+def test_task_group(services):
+    "A task group finishes with the values of all its children."
+    @stk.coroutines.async_generator
+    def run_child(value):
+        yield stk.coroutines.sleep(0.1)
+        yield stk.coroutines.Return(value)
+    @stk.coroutines.async_generator
+    def run_group():
+        with stk.coroutines.TaskGroup() as group:
+            group.spawn(run_child, "A")
+            group.spawn(run_child, "B")
+        values = yield group
+        yield stk.coroutines.Return(values)
+    assert run_group().value() == ["A", "B"]
+
+def test_task_group_error(services):
+    "When a child fails, the other children are cancelled."
+    services.ALMemory.raiseEvent(TEST_KEY, 40)
+    @stk.coroutines.async_generator
+    def run_fail():
+        yield stk.coroutines.sleep(0.1)
+        assert False, "Nope"
+    @stk.coroutines.async_generator
+    def run_slow():
+        yield stk.coroutines.sleep(0.3)
+        yield services.ALMemory.raiseEvent(TEST_KEY, 41, _async=True)
+    with stk.coroutines.TaskGroup() as group:
+        group.spawn(run_fail)
+        slow = group.spawn(run_slow)
+    with pytest.raises(AssertionError):
+        group.value()
+    assert not slow.isRunning()
+    time.sleep(0.4)
+    assert services.ALMemory.getData(TEST_KEY) == 40
+
+def test_task_group_cancel_parent(services):
+    "Cancelling the coroutine yielding a group cancels its children."
+    services.ALMemory.raiseEvent(TEST_KEY, 50)
+    @stk.coroutines.async_generator
+    def run_slow():
+        yield stk.coroutines.sleep(0.3)
+        yield services.ALMemory.raiseEvent(TEST_KEY, 51, _async=True)
+    @stk.coroutines.async_generator
+    def run_group():
+        with stk.coroutines.TaskGroup() as group:
+            group.spawn(run_slow)
+            group.spawn(run_slow)
+        yield group
+    future = run_group()
+    time.sleep(0.1)
+    future.cancel()
+    time.sleep(0.4)
+    assert services.ALMemory.getData(TEST_KEY) == 50
+
+
+def test_channel(services):
+    "Values put in a channel come out in order, with backpressure."
+    channel = stk.coroutines.Channel(capacity=2)
+    received = []
+    @stk.coroutines.async_generator
+    def run_producer():
+        for i in range(5):
+            yield channel.put(i)
+        channel.close()
+    @stk.coroutines.async_generator
+    def run_consumer():
+        yield stk.coroutines.sleep(0.1)
+        yield channel.for_each(received.append)
+    producer = run_producer()
+    consumer = run_consumer()
+    time.sleep(0.05)
+    # The buffer is full, the producer is waiting for the consumer
+    assert len(channel) == 2
+    assert producer.isRunning()
+    consumer.wait()
+    assert received == [0, 1, 2, 3, 4]
+
+def test_channel_plain_values(services):
+    "Values returned by the for_each callback that aren't futures are ignored."
+    channel = stk.coroutines.Channel()
+    received = []
+    def callback(value):
+        "Returns a number."
+        received.append(value)
+        return len(received)
+    consumer = channel.for_each(callback)
+    channel.put_all(range(5), close=True)
+    assert consumer.value() is None
+    assert received == [0, 1, 2, 3, 4]
+
+def test_channel_closed(services):
+    "Getting from a closed and empty channel fails."
+    channel = stk.coroutines.Channel()
+    future = channel.get()
+    channel.close()
+    with pytest.raises(RuntimeError):
+        future.value()
+    with pytest.raises(RuntimeError):
+        channel.put(1).value()
+
+
+def test_periodic(services):
+    "Periodic calls the function at the given rate, until cancelled."
+    calls = []
+    future = stk.coroutines.periodic(lambda: calls.append(time.time()), 50)
+    time.sleep(0.5)
+    future.cancel()
+    count = len(calls)
+    assert 20 <= count <= 27
+    stats = future.stats()
+    assert stats["ticks"] == count
+    assert stats["max_jitter"] < 0.1
+    time.sleep(0.1)
+    assert len(calls) == count
+
+def test_periodic_frequency():
+    "The frequency must be positive."
+    for frequency in (0, -10):
+        with pytest.raises(ValueError):
+            stk.coroutines.periodic(lambda: None, frequency)
+
+def test_periodic_skip_missed(services):
+    "Ticks that overrun skip the missed deadlines."
+    future = stk.coroutines.periodic(lambda: time.sleep(0.03), 100)
+    time.sleep(0.3)
+    future.cancel()
+    stats = future.stats()
+    assert stats["overruns"] > 0
+    assert stats["skipped"] > 0
+
+def test_periodic_catch_up(services):
+    "With CATCH_UP, ticks missed by an overrun are run right after it."
+    calls = []
+    def tick():
+        "The first tick takes 5 periods."
+        calls.append(time.time())
+        if len(calls) == 1:
+            time.sleep(0.1)
+    future = stk.coroutines.periodic(tick, 50,
+                                     policy=stk.coroutines.CATCH_UP)
+    time.sleep(0.15)
+    future.cancel()
+    stats = future.stats()
+    assert stats["overruns"] > 0
+    assert stats["skipped"] == 0
+    # The missed ticks were run one after the other
+    assert calls[2] - calls[1] < 0.01
+    assert len(calls) >= 7
+
+def test_periodic_plain_values(services):
+    "Values returned by the function that aren't futures are ignored."
+    calls = []
+    def tick():
+        "Returns a number."
+        calls.append(time.time())
+        return len(calls)
+    future = stk.coroutines.periodic(tick, 100)
+    time.sleep(0.1)
+    assert future.isRunning()
+    future.cancel()
+    assert len(calls) >= 5
+
+
+def test_tracing(services):
+    "Steps of traced coroutines can be exported as Chrome trace events."
+    import json
+    @stk.coroutines.async_generator
+    def run_traced():
+        yield stk.coroutines.sleep(0.1)
+        yield stk.coroutines.Return("OK")
+    stk.coroutines.enable_tracing()
+    try:
+        assert run_traced().value() == "OK"
+        records = stk.coroutines.get_trace_records()
+        waits = [record for record in records if record[1] == "wait"]
+        assert len(waits) == 1
+        name, _, _, start, end, _, _ = waits[0]
+        assert name == "run_traced"
+        assert end - start >= 0.09
+        trace = json.loads(stk.coroutines.export_chrome_trace())
+        assert "sleep(0.1)" in trace["traceEvents"][0]["args"]["yield"]
+    finally:
+        stk.coroutines.disable_tracing()
+    assert stk.coroutines.get_trace_records() == []
+
+
 if __name__ == "__main__":
    pytest.main(['--qiurl', '10.0.204.255'])
 
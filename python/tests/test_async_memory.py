@@ -0,0 +1,90 @@
+"""
+Memory and allocation benchmarks for stk.coroutines
+
+These don't need a robot: coroutines that finish without waiting never
+create a qi promise.
+"""
+
+import gc
+import sys
+import time
+
+import stk.coroutines
+
+COUNT = 1000
+
+@stk.coroutines.async_generator
+def run_return():
+    yield stk.coroutines.Return(42)
+
+def count_new_objects(create):
+    "Returns how many objects tracked by the GC were created per call."
+    gc.collect()
+    before = len(gc.get_objects())
+    kept = [create() for _ in range(COUNT)]
+    gc.collect()
+    after = len(gc.get_objects())
+    assert len(kept) == COUNT
+    return float(after - before) / COUNT
+
+def test_no_instance_dict():
+    "Future wrappers use __slots__, and don't carry an instance __dict__."
+    future = run_return()
+    assert not hasattr(future, "__dict__")
+
+def test_lazy_promise():
+    "A coroutine that finishes immediately doesn't need a promise."
+    future = run_return()
+    assert future._promise is None
+    assert future.value() == 42
+    assert future._promise is None
+    # ... but asking for the future still works.
+    assert future.future.value() == 42
+
+def test_coroutine_allocations():
+    "Creating and finishing a coroutine allocates a handful of objects."
+    per_future = count_new_objects(run_return)
+    size = sys.getsizeof(run_return())
+    print "%.1f GC objects and %d bytes per GeneratorFuture" % (per_future,
+                                                               size)
+    assert per_future < 5
+
+def test_multi_future_allocations():
+    "Yielding a list of futures doesn't allocate a closure per future."
+    @stk.coroutines.async_generator
+    def run_fan_out():
+        values = yield [run_return() for _ in range(COUNT)]
+        yield stk.coroutines.Return(values)
+    gc.collect()
+    before = len(gc.get_objects())
+    start = time.time()
+    assert run_fan_out().value() == [42] * COUNT
+    duration = time.time() - start
+    gc.collect()
+    print "fan-out of %d futures took %.1f ms" % (COUNT, 1000 * duration)
+    # Everything was released
+    assert len(gc.get_objects()) - before < 10
+
+def test_coroutine_stats():
+    "get_stats counts started and finished coroutines."
+    before = stk.coroutines.get_stats()
+    for _ in range(COUNT):
+        run_return()
+    after = stk.coroutines.get_stats()
+    assert after["started"] - before["started"] == COUNT
+    assert after["finished"] - before["finished"] == COUNT
+    assert after["pending"] == before["pending"]
+
+def test_subclass_promise():
+    "Subclasses can still set their own promise."
+    import qi
+    class Finished(stk.coroutines.FutureWrapper):
+        "A FutureWrapper with its own promise, finished at once."
+        def __init__(self, value):
+            stk.coroutines.FutureWrapper.__init__(self)
+            self.promise = qi.Promise()
+            self.promise.setValue(value)
+            self.running = False
+    future = Finished(3)
+    assert future.future.value() == 3
+    assert future.value() == 3
@@ -0,0 +1,174 @@
+"""
+Benchmarks for the hot paths of stk
+
+These run without a robot (using stk.testing's fake qi, see conftest.py), and
+print their results. To keep them as a baseline, and compare later runs with
+it (failing when something is more than --benchmark-tolerance times worse):
+
+py.test tests/test_benchmarks.py -s --benchmark-save=baseline.json
+py.test tests/test_benchmarks.py -s --benchmark-compare=baseline.json
+
+They are skipped unless --benchmark (or one of the options above) is given.
+"""
+
+import threading
+import time
+
+import pytest
+
+import qi
+
+import stk.coroutines
+import stk.events
+import stk.logging
+import stk.services
+
+MICROSECONDS = 1000000.0
+MILLISECONDS = 1000.0
+
+TEST_KEY = "TestBenchmarks/Key"
+
+pytestmark = pytest.mark.benchmark
+
+
+def test_service_cache_lookup(qiapp, benchmark):
+    "Getting a service from a ServiceCache."
+    services = stk.services.ServiceCache(qiapp.session)
+    def first_lookup():
+        "Lookup in a new cache."
+        services.services.clear()
+        return services.ALMemory
+    benchmark.record("services.first_lookup",
+                     MICROSECONDS * benchmark.time_per_call(first_lookup, 100),
+                     "us")
+    def cached_lookup():
+        "Lookup of an already cached service."
+        return services.ALMemory
+    benchmark.record("services.cached_lookup",
+                     MICROSECONDS * benchmark.time_per_call(cached_lookup,
+                                                            10000),
+                     "us")
+
+
+def test_event_connect(qiapp, benchmark):
+    "Connecting a callback with an EventHelper (and disconnecting it)."
+    events = stk.events.EventHelper(qiapp.session)
+    def connect_disconnect():
+        "Connect, then disconnect."
+        connection_id = events.connect(TEST_KEY, lambda value: None)
+        events.disconnect(TEST_KEY, connection_id)
+    benchmark.record(
+        "events.connect_disconnect",
+        MICROSECONDS * benchmark.time_per_call(connect_disconnect, 200), "us")
+
+
+def test_event_dispatch(qiapp, benchmark):
+    "Time between raising an event and the callback being called."
+    events = stk.events.EventHelper(qiapp.session)
+    received = threading.Event()
+    times = []
+    def on_event(value):
+        "Callback"
+        times.append(time.time())
+        received.set()
+    events.connect(TEST_KEY, on_event)
+    latencies = []
+    for _ in range(100):
+        received.clear()
+        start = time.time()
+        events.set(TEST_KEY, 1)
+        assert received.wait(1.0)
+        latencies.append(times[-1] - start)
+    events.clear()
+    latencies.sort()
+    benchmark.record("events.dispatch_median",
+                     MICROSECONDS * latencies[len(latencies) // 2], "us")
+
+
+def test_event_wait_for(qiapp, benchmark):
+    "Time between raising an event and wait_for returning."
+    events = stk.events.EventHelper(qiapp.session)
+    raise_times = []
+    def raise_later():
+        "Raises the event once wait_for had the time to connect."
+        time.sleep(0.01)
+        raise_times.append(time.time())
+        events.set(TEST_KEY, 2)
+    latencies = []
+    for _ in range(20):
+        thread = threading.Thread(target=raise_later)
+        thread.start()
+        events.wait_for(TEST_KEY)
+        latencies.append(time.time() - raise_times[-1])
+        thread.join()
+    latencies.sort()
+    benchmark.record("events.wait_for_median",
+                     MICROSECONDS * latencies[len(latencies) // 2], "us")
+
+
+def test_coroutine_steps(benchmark):
+    "Steps per second of a coroutine yielding futures."
+    count = 2000
+    @stk.coroutines.async_generator
+    def run_steps():
+        "Yields finished futures."
+        for _ in xrange(count):
+            promise = qi.Promise()
+            promise.setValue(None)
+            yield promise.future()
+    duration = benchmark.time_per_call(lambda: run_steps().value(), 1)
+    benchmark.record("coroutines.steps_per_second", count / duration,
+                     "steps/s", higher_is_better=True)
+
+
+def test_coroutine_fan_out(benchmark):
+    "Yielding a list of 1000 futures."
+    @stk.coroutines.async_generator
+    def run_fan_out():
+        "Waits for 1000 sleeps at once."
+        yield [stk.coroutines.sleep(0) for _ in range(1000)]
+    duration = benchmark.time_per_call(lambda: run_fan_out().value(), 1)
+    benchmark.record("coroutines.fan_out_1000", MILLISECONDS * duration,
+                     "ms")
+
+
+def test_sleep_scheduling(benchmark):
+    "How late sleep() wakes up."
+    lateness = []
+    for _ in range(20):
+        start = time.time()
+        stk.coroutines.sleep(0.01).wait()
+        lateness.append(time.time() - start - 0.01)
+    lateness.sort()
+    benchmark.record("coroutines.sleep_lateness_median",
+                     MICROSECONDS * lateness[len(lateness) // 2], "us")
+
+
+class Logged(object):
+    "Object with methods decorated by stk.logging."
+    logger = None
+
+    def plain(self, value):
+        "Not decorated"
+        return value
+
+    @stk.logging.log_exceptions
+    def logged(self, value):
+        "Decorated with log_exceptions"
+        return value
+
+    @stk.logging.log_exceptions_and_return(None)
+    def logged_and_return(self, value):
+        "Decorated with log_exceptions_and_return"
+        return value
+
+
+def test_logging_decorator_overhead(benchmark):
+    "Cost of calls with the logging decorators, when there is no exception."
+    obj = Logged()
+    for name in ("plain", "logged", "logged_and_return"):
+        method = getattr(obj, name)
+        benchmark.record(
+            "logging.call_" + name,
+            MICROSECONDS * benchmark.time_per_call(lambda: method(1), 10000),
+            "us")
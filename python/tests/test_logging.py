@@ -0,0 +1,422 @@
+"""
+Unit tests for stk.logging
+
+These use a fake logger, so they don't need a robot.
+"""
+
+import threading
+import time
+
+import qi
+
+import stk.coroutines
+import stk.events
+import stk.logging
+
+
+class FakeLogger(object):
+    "Records messages instead of logging them."
+    def __init__(self):
+        self.messages = []
+        self.threads = set()
+
+    def _log(self, level, message):
+        self.messages.append((level, message))
+        self.threads.add(threading.current_thread().name)
+
+    def fatal(self, message):
+        self._log("fatal", message)
+
+    def error(self, message):
+        self._log("error", message)
+
+    def warning(self, message):
+        self._log("warning", message)
+
+    def info(self, message):
+        self._log("info", message)
+
+    def verbose(self, message):
+        self._log("verbose", message)
+
+
+def test_queued_logger():
+    "Queued messages are formatted and forwarded by the worker thread."
+    pipeline = stk.logging.LogPipeline()
+    pipeline.start()
+    fake = FakeLogger()
+    logger = stk.logging.QueuedLogger(fake, pipeline)
+    logger.info("hello %s", "world")
+    logger.warning("careful")
+    assert pipeline.flush()
+    assert fake.messages == [("info", "hello world"), ("warning", "careful")]
+    assert fake.threads == set(["stk.logging"])
+    pipeline.stop()
+
+
+def test_queued_logger_drops():
+    "When the queue is full, records are dropped instead of blocking."
+    pipeline = stk.logging.LogPipeline(max_queue_size=10)
+    fake = FakeLogger()
+    logger = stk.logging.QueuedLogger(fake, pipeline)
+    for i in range(15):
+        logger.error("storm %d", i)
+    assert pipeline.dropped == 5
+    pipeline.start()
+    pipeline.stop()
+    assert len(fake.messages) == 10
+
+
+def test_queued_log_exceptions():
+    "log_exceptions hands the exception to the pipeline for formatting."
+    pipeline = stk.logging.LogPipeline()
+    pipeline.start()
+    class Divider(object):
+        def __init__(self):
+            self.logger = stk.logging.QueuedLogger(FakeLogger(), pipeline)
+        @stk.logging.log_exceptions_and_return(None)
+        def divide(self, num_a, num_b):
+            return num_a / num_b
+    divider = Divider()
+    assert divider.divide(1, 0) is None
+    assert pipeline.flush()
+    level, message = divider.logger.logger.messages[0]
+    assert level == "error"
+    assert "ZeroDivisionError" in message
+    pipeline.stop()
+
+
+class FakeLogManager(object):
+    "Counts the providers that are added."
+    def __init__(self):
+        self.providers = []
+
+    def addProvider(self, provider):
+        self.providers.append(provider)
+
+
+class FakeQiCore(object):
+    "Creates dummy LogProvider objects."
+    def createObject(self, name, log_manager):
+        assert name == "LogProvider"
+        return object()
+
+
+class FakeSession(object):
+    "Session that only has a LogManager."
+    def __init__(self):
+        self.log_manager = FakeLogManager()
+
+    def service(self, name):
+        assert name == "LogManager"
+        return self.log_manager
+
+
+def test_one_provider_per_session(monkeypatch):
+    "Loggers created on the same session share a single LogProvider."
+    monkeypatch.setattr(qi, "module", lambda name: FakeQiCore())
+    session = FakeSession()
+    stk.logging.get_logger(session, "com.example.app")
+    stk.logging.get_logger(session, "com.example.app")
+    stk.logging.get_child_logger(session, "com.example.app", "vision")
+    stk.logging.get_child_logger(session, "com.example.app", "dialog",
+                                 queued=True)
+    assert len(session.log_manager.providers) == 1
+    other_session = FakeSession()
+    stk.logging.get_logger(other_session, "com.example.app")
+    assert len(other_session.log_manager.providers) == 1
+
+
+def test_provider_failures_not_cached(monkeypatch):
+    "If the provider couldn't be registered, it's tried again next time."
+    def no_qicore(name):
+        "Not on a robot."
+        raise RuntimeError("no qicore")
+    monkeypatch.setattr(qi, "module", no_qicore)
+    session = FakeSession()
+    stk.logging.get_logger(session, "com.example.app")
+    assert not session.log_manager.providers
+    monkeypatch.setattr(qi, "module", lambda name: FakeQiCore())
+    stk.logging.get_logger(session, "com.example.app")
+    assert len(session.log_manager.providers) == 1
+
+
+def test_providers_dont_keep_sessions(monkeypatch):
+    "Registering a provider doesn't keep the session alive."
+    import gc
+    import weakref
+    monkeypatch.setattr(qi, "module", lambda name: FakeQiCore())
+    session = FakeSession()
+    stk.logging.get_logger(session, "com.example.app")
+    session_ref = weakref.ref(session)
+    del session
+    gc.collect()
+    assert session_ref() is None
+
+
+def test_logger_creation_cost(monkeypatch):
+    "Once the provider is registered, creating loggers is cheap."
+    monkeypatch.setattr(qi, "module", lambda name: FakeQiCore())
+    session = FakeSession()
+    stk.logging.get_logger(session, "com.example.app")
+    count = 1000
+    start = time.time()
+    for i in range(count):
+        stk.logging.get_child_logger(session, "com.example.app", str(i))
+    duration = (time.time() - start) / count
+    print "get_child_logger: %.1f us per logger" % (duration * 1000000)
+    assert len(session.log_manager.providers) == 1
+
+
+class Flaky(object):
+    "Object with decorated methods that fail."
+    def __init__(self):
+        self.logger = FakeLogger()
+
+    @stk.logging.log_exceptions_and_return(-1)
+    def divide(self, num_a, num_b=0):
+        return num_a / num_b
+
+    @stk.coroutines.async_generator
+    @stk.logging.log_exceptions_and_return("default")
+    def run_divide(self, num_a, num_b=0):
+        yield stk.coroutines.Return(num_a / num_b)
+
+
+def test_log_exceptions_no_rate_limit():
+    "By default, all exceptions are logged."
+    flaky = Flaky()
+    for _ in range(50):
+        assert flaky.divide(1) == -1
+    assert len(flaky.logger.messages) == 50
+
+
+def test_log_exceptions_rate_limit():
+    "Repeated exceptions from the same place are only logged a few times."
+    stk.logging.set_exception_rate_limit(3, period=0.2)
+    try:
+        flaky = Flaky()
+        for _ in range(50):
+            assert flaky.divide(1) == -1
+        assert len(flaky.logger.messages) == 3
+        # The suppressed ones are reported at the end of the period...
+        time.sleep(0.3)
+        assert len(flaky.logger.messages) == 4
+        level, message = flaky.logger.messages[-1]
+        assert level == "warning"
+        assert "(47 more suppressed) ZeroDivisionError" in message
+        # ... and only once.
+        assert flaky.divide(1, num_b=0) == -1
+        assert len(flaky.logger.messages) == 5
+        assert "suppressed" not in flaky.logger.messages[-1][1]
+    finally:
+        stk.logging.set_exception_rate_limit(None)
+
+
+def test_log_exceptions_generator():
+    "The decorators work on coroutines."
+    flaky = Flaky()
+    assert flaky.run_divide(4, num_b=2).value() == 2
+    assert flaky.run_divide(1).value() == "default"
+    assert "ZeroDivisionError" in flaky.logger.messages[-1][1]
+
+
+def test_flight_recorder():
+    "Debug messages are only recorded, and dumped when an error is logged."
+    fake = FakeLogger()
+    logger = stk.logging.RecordingLogger(fake)
+    logger.debug("step %d", 1)
+    logger.debug("step %d", 2)
+    logger.info("started")
+    assert fake.messages == [("info", "started")]
+    class Failing(object):
+        def __init__(self):
+            self.logger = logger
+        @stk.logging.log_exceptions_and_return(None)
+        def fail(self):
+            raise KeyError("boom")
+    Failing().fail()
+    dump = fake.messages[1][1]
+    assert "step 1" in dump and "step 2" in dump and "started" in dump
+    assert "KeyError" in fake.messages[2][1]
+    # Dumps are rate-limited...
+    logger.debug("step %d", 3)
+    Failing().fail()
+    assert len(fake.messages) == 4
+    assert "KeyError" in fake.messages[3][1]
+    # ... and only have the messages recorded since the previous one.
+    logger.last_dump = None
+    Failing().fail()
+    dump = fake.messages[4][1]
+    assert "step 3" in dump and "step 1" not in dump
+
+
+def test_flight_recorder_capacity(tmpdir):
+    "The recorder keeps the last messages, and can be dumped to a file."
+    recorder = stk.logging.FlightRecorder(capacity=3)
+    for i in range(10):
+        recorder.record("debug", "message %d", (i,))
+    filename = str(tmpdir.join("dump.txt"))
+    recorder.dump(filename=filename)
+    lines = open(filename).read().splitlines()
+    assert len(lines) == 3
+    assert lines[0].endswith("message 7")
+
+
+class Timed(object):
+    "Object with timed methods."
+    def __init__(self):
+        self.logger = FakeLogger()
+
+    @stk.logging.log_timing
+    def fast(self):
+        pass
+
+    @stk.logging.log_timing(slow_threshold=0.05)
+    def slow(self, duration=0.1):
+        time.sleep(duration)
+
+    @stk.coroutines.async_generator
+    @stk.logging.log_timing
+    def run_sleep(self):
+        yield stk.coroutines.sleep(0.1)
+
+    @stk.coroutines.async_generator
+    @stk.logging.log_timing
+    def run_return(self):
+        yield stk.coroutines.sleep(0.05)
+        yield stk.coroutines.Return(42)
+
+    @stk.logging.log_timing
+    @stk.coroutines.async_generator
+    def run_cancelled(self):
+        yield stk.coroutines.sleep(10)
+
+
+class OtherTimed(object):
+    "Object with a timed method with the same name as Timed's."
+    @stk.logging.log_timing
+    def fast(self):
+        pass
+
+
+def test_log_timing():
+    "Durations are recorded, and slow calls are logged."
+    timed = Timed()
+    for _ in range(100):
+        timed.fast()
+    timed.slow()
+    timed.slow(duration=0)
+    stats = stk.logging.get_timing_stats()
+    assert stats["test_logging.Timed.fast"]["count"] == 100
+    assert stats["test_logging.Timed.fast"]["p99"] < 0.01
+    assert stats["test_logging.Timed.slow"]["count"] == 2
+    assert stats["test_logging.Timed.slow"]["slow_count"] == 1
+    assert stats["test_logging.Timed.slow"]["max"] >= 0.1
+    assert len(timed.logger.messages) == 1
+    assert "test_logging.Timed.slow" in timed.logger.messages[0][1]
+    # Methods of other classes are counted separately
+    OtherTimed().fast()
+    other_stats = stk.logging.get_timing_stats("test_logging.OtherTimed.fast")
+    assert other_stats.count == 1
+
+
+def make_twin():
+    "Returns a class, always with the same name and method."
+    class Twin(object):
+        "A class defined several times."
+        @stk.logging.log_timing
+        def run(self):
+            pass
+    return Twin
+
+
+def test_log_timing_same_names():
+    "Functions with the same name have their own statistics."
+    first, second = make_twin()(), make_twin()()
+    first.run()
+    first.run()
+    second.run()
+    assert stk.logging.get_timing_stats("test_logging.Twin.run").count == 2
+    assert stk.logging.get_timing_stats("test_logging.Twin.run#2").count == 1
+
+
+TIMED_EVENT = "TestLogging/TimedEvent"
+
+
+class TimedHandlers(object):
+    "Object with timed event callbacks."
+    def __init__(self, session):
+        self.events = stk.events.EventHelper(session)
+        self.values = []
+
+    @stk.logging.log_timing
+    @stk.events.on(TIMED_EVENT)
+    def on_event_outer(self, value):
+        self.values.append(("outer", value))
+
+    @stk.events.on(TIMED_EVENT)
+    @stk.logging.log_timing
+    def on_event_inner(self, value):
+        self.values.append(("inner", value))
+
+
+def test_log_timing_on_events(qiapp):
+    "@on event callbacks can be timed (log_timing above or below @on)."
+    handlers = TimedHandlers(qiapp.session)
+    handlers.events.connect_decorators(handlers)
+    try:
+        for value in range(3):
+            handlers.events.set(TIMED_EVENT, value)
+        for _ in range(100):
+            if len(handlers.values) == 6:
+                break
+            time.sleep(0.01)
+    finally:
+        handlers.events.clear()
+    assert sorted(handlers.values) == sorted(
+        [(name, value) for name in ("inner", "outer") for value in range(3)])
+    for method in ("on_event_outer", "on_event_inner"):
+        stats = stk.logging.get_timing_stats("test_logging.TimedHandlers."
+                                             + method)
+        assert stats.count == 3
+
+
+def test_log_timing_coroutine():
+    "A coroutine is timed until it's finished."
+    Timed().run_sleep().wait()
+    stats = stk.logging.get_timing_stats("test_logging.Timed.run_sleep")
+    assert stats.count == 1
+    assert stats.percentile(50) >= 0.1
+
+
+def test_log_timing_coroutine_return():
+    "A coroutine finishing with Return is timed as soon as it's finished."
+    assert Timed().run_return().value() == 42
+    stats = stk.logging.get_timing_stats("test_logging.Timed.run_return")
+    assert stats.count == 1
+    assert stats.max >= 0.05
+
+
+def test_log_timing_cancelled_coroutine():
+    "Above async_generator, cancelled coroutines are timed too."
+    future = Timed().run_cancelled()
+    time.sleep(0.05)
+    future.cancel()
+    stats = stk.logging.get_timing_stats("test_logging.Timed.run_cancelled")
+    for _ in range(100):
+        if stats.count:
+            break
+        time.sleep(0.01)
+    assert stats.count == 1
+    assert 0.05 <= stats.max < 1
+
+
+def test_timing_stats_percentiles():
+    "Percentiles are estimated from a fixed-size sample."
+    stats = stk.logging.TimingStats("test", sample_size=100, seed=0)
+    for i in range(10000):
+        stats.add(i / 10000.0)
+    assert len(stats.samples) == 100
+    assert 0.4 < stats.percentile(50) < 0.6
+    assert stats.percentile(99) > 0.9
@@ -0,0 +1,435 @@
+"""
+Tests for stk.runner
+
+These run the activities on the fake qi of stk.testing (see conftest.py).
+"""
+
+import os
+import threading
+import time
+
+import pytest
+
+import stk.events
+import stk.logging
+import stk.runner
+import stk.services
+import stk.testing
+
+pytestmark = pytest.mark.skipif(not stk.testing.is_installed(),
+                                reason="needs the fake qi of stk.testing")
+
+
+@pytest.fixture
+def app(monkeypatch):
+    "A new fake application, that stk.runner.init returns."
+    import qi
+    application = qi.Application()
+    application.start()
+    monkeypatch.setattr(stk.runner, "init", lambda *args, **kwargs:
+                        application)
+    return application
+
+
+def run_in_thread(func, *args, **kwargs):
+    "Runs func in a thread, returns the thread."
+    thread = threading.Thread(target=func, args=args, kwargs=kwargs)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def wait_until(condition, timeout=2.0):
+    "Waits until condition() is true; returns whether it is."
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+#
+# run_services
+#
+
+class Hosted(object):
+    "A service for run_services, recording what happens to it."
+    events = []
+
+    def __init__(self, qiapp):
+        self.qiapp = qiapp
+
+    def on_start(self):
+        self.events.append(("start", id(self)))
+
+    def on_stop(self):
+        self.events.append(("stop", id(self)))
+
+
+class SlowStop(object):
+    "A service with a slow on_stop."
+    events = []
+
+    def __init__(self, qiapp):
+        self.qiapp = qiapp
+
+    def on_stop(self):
+        self.events.append(("stopping", id(self)))
+        time.sleep(0.1)
+        self.events.append(("stopped", id(self)))
+
+
+class FailingStart(object):
+    "A service whose on_start fails (after start_duration seconds)."
+    events = []
+    start_duration = 0.0
+
+    def __init__(self, qiapp):
+        self.qiapp = qiapp
+
+    def on_start(self):
+        time.sleep(self.start_duration)
+        raise RuntimeError("Can't start")
+
+    def on_stop(self):
+        self.events.append(("stopping", id(self)))
+        time.sleep(0.1)
+        self.events.append(("stopped", id(self)))
+
+
+class SlowFailingStart(FailingStart):
+    "A service whose on_start fails while the process is exiting."
+    start_duration = 0.1
+
+
+def service_names(session):
+    "Returns the names of the registered services."
+    return [info[0] for info in session.services()]
+
+
+def test_run_services_start_failure(app):
+    "A service whose on_start fails stops alone, the others keep running."
+    del Hosted.events[:]
+    del FailingStart.events[:]
+    thread = run_in_thread(stk.runner.run_services,
+                           [(FailingStart, "TestFailing"),
+                            (Hosted, "TestHosted")])
+    assert wait_until(lambda: len(FailingStart.events) == 2)
+    assert wait_until(lambda: "TestFailing" not in
+                      service_names(app.session))
+    assert "TestHosted" in service_names(app.session)
+    assert thread.is_alive()
+    app.stop()
+    thread.join(2.0)
+    assert not thread.is_alive()
+    assert [event for event, _ in Hosted.events] == ["start", "stop"]
+    # The failing one wasn't stopped again
+    assert len(FailingStart.events) == 2
+    assert "TestHosted" not in service_names(app.session)
+
+
+def test_run_services_start_failure_at_exit(app):
+    "A service whose on_start fails during shutdown is only stopped once."
+    del SlowFailingStart.events[:]
+    thread = run_in_thread(stk.runner.run_services,
+                           [(SlowFailingStart, "TestSlowFailing"),
+                            (Hosted, "TestHosted")])
+    assert wait_until(lambda: "TestSlowFailing" in
+                      service_names(app.session))
+    app.stop()
+    thread.join(2.0)
+    assert not thread.is_alive()
+    time.sleep(0.2)  # on_start failed during the shutdown
+    events = [event for event, _ in SlowFailingStart.events]
+    assert events == ["stopping", "stopped"]
+    assert "TestSlowFailing" not in service_names(app.session)
+
+
+def test_run_services_registration_failure(app):
+    "A service that couldn't be registered isn't stopped."
+    del Hosted.events[:]
+    thread = run_in_thread(stk.runner.run_services,
+                           [(Hosted, "TestHosted"), (Hosted, "TestHosted")])
+    assert wait_until(lambda: Hosted.events)
+    app.stop()
+    thread.join(2.0)
+    assert not thread.is_alive()
+    # Only the first one was started and stopped
+    started = [obj_id for event, obj_id in Hosted.events if event == "start"]
+    stopped = [obj_id for event, obj_id in Hosted.events if event == "stop"]
+    assert len(started) == 1
+    assert stopped == started
+    assert "TestHosted" not in [info[0] for info in app.session.services()]
+
+
+def test_run_services_shutdown_order(app):
+    """At exit, all on_stop are called concurrently, and each service is
+    unregistered once its on_stop is done."""
+    del SlowStop.events[:]
+    session = app.session
+    unregister = session.unregisterService
+    def record_unregister(service_id):
+        "Records the unregistration."
+        SlowStop.events.append(("unregistered", service_id))
+        unregister(service_id)
+    session.unregisterService = record_unregister
+    thread = run_in_thread(stk.runner.run_services,
+                           [(SlowStop, "TestSlowStop1"),
+                            (SlowStop, "TestSlowStop2")])
+    assert wait_until(lambda: "TestSlowStop2" in
+                      [info[0] for info in session.services()])
+    start = time.time()
+    app.stop()
+    thread.join(2.0)
+    assert time.time() - start < 0.19
+    events = [event for event, _ in SlowStop.events]
+    assert events[:2] == ["stopping", "stopping"]
+    assert events.index("unregistered") > events.index("stopped")
+    assert events.count("unregistered") == 2
+    names = [info[0] for info in session.services()]
+    assert "TestSlowStop1" not in names and "TestSlowStop2" not in names
+
+
+#
+# Worker processes
+#
+
+class Vision(object):
+    "A service with methods marked to run in worker processes."
+    @stk.runner.in_worker_process
+    def process(self, value):
+        "Returns whether self is None, the pid, and the square of value."
+        return [self is None, os.getpid(), value * value]
+
+    @stk.runner.in_worker_process
+    def fail(self):
+        "Raises an exception."
+        return 1 / 0
+
+    @stk.runner.in_worker_process
+    def unpicklable(self):
+        "Returns something that can't be pickled."
+        return threading.Lock()
+
+    @stk.runner.in_worker_process
+    def wait(self, duration):
+        "Sleeps for a while."
+        time.sleep(duration)
+        return duration
+
+    @stk.runner.in_worker_process
+    def die(self):
+        "Kills the worker process."
+        os._exit(1)
+
+
+@pytest.fixture
+def vision():
+    "A Vision service whose marked methods run in 2 worker processes."
+    pool = stk.runner.WorkerPool(2, check_interval=0.05)
+    service = Vision()
+    service._worker_pool = pool
+    stk.runner._forward_to_workers(service, pool)
+    yield service
+    pool.terminate()
+
+
+def test_in_worker_process(vision):
+    "Marked methods run in a worker process, with self=None."
+    is_none, pid, square = vision.process(3).value()
+    assert is_none
+    assert pid != os.getpid()
+    assert square == 9
+    stats = vision._worker_pool.stats()
+    assert stats["pending"] == 0
+    assert stats["workers"][pid]["calls"] == 1
+
+
+def test_worker_errors(vision):
+    "Errors in worker processes are in the futures."
+    future = vision.fail()
+    assert future.hasError()
+    assert "ZeroDivisionError" in future.error()
+
+
+def test_worker_pickling_errors(vision):
+    "Arguments and results that can't be pickled make the call fail."
+    future = vision.process(lambda: 0)
+    assert future.hasError()
+    assert "arguments" in future.error()
+    future = vision.unpicklable()
+    assert future.hasError()
+    assert vision._worker_pool.stats()["pending"] == 0
+    # The pool still works
+    assert vision.process(2).value()[2] == 4
+
+
+def test_worker_death(vision):
+    "If a worker process dies, its call fails, and it's replaced."
+    future = vision.die()
+    assert future.wait(5000) != stk.testing.FutureState.Running
+    assert future.hasError()
+    assert "died" in future.error()
+    assert vision._worker_pool.stats()["pending"] == 0
+    assert vision.process(5).value()[2] == 25
+
+
+def test_worker_death_fails_running_calls(vision):
+    """If a worker process dies, the calls running in the other workers fail
+    too (the pool can't tell which one the dead worker had)."""
+    running = vision.wait(1.0)
+    time.sleep(0.1)
+    future = vision.die()
+    assert running.wait(5000) != stk.testing.FutureState.Running
+    assert running.hasError()
+    assert "died" in running.error()
+    assert future.hasError()
+    assert vision.process(6).value()[2] == 36
+
+
+#
+# Lifecycle
+#
+
+class Component(object):
+    "A component with slow on_start and on_stop."
+    def __init__(self, start_duration=0.1, stop_duration=0.1):
+        self.start_duration = start_duration
+        self.stop_duration = stop_duration
+        self.stopped = False
+
+    def on_start(self):
+        time.sleep(self.start_duration)
+
+    def on_stop(self):
+        time.sleep(self.stop_duration)
+        self.stopped = True
+
+
+class Composite(object):
+    "An activity with components."
+    def __init__(self, *components):
+        self.components = components
+        self.errors = []
+        self.logger = self
+
+    def error(self, message):
+        "Logger method: records the error."
+        self.errors.append(message)
+
+
+def test_lifecycle():
+    "on_start and on_stop are called in parallel, and timed."
+    activity = Composite(Component(), Component(0.05, 0.05))
+    lifecycle = stk.runner.Lifecycle(activity)
+    errors = []
+    start = time.time()
+    lifecycle.start(errors.append)
+    assert lifecycle.ready.value() is True
+    assert time.time() - start < 0.19
+    assert lifecycle.is_ready and not errors
+    lifecycle.stop()
+    assert all(component.stopped for component in activity.components)
+    timings = lifecycle.timings
+    # Components of the same class are timed separately
+    assert timings["on_start:1:Component"] >= 0.1
+    assert 0.05 <= timings["on_start:2:Component"] < 0.1
+    assert 0.05 <= timings["on_stop:2:Component"] < 0.1
+    assert timings["stop"] < 0.19
+
+
+def test_lifecycle_start_timeout():
+    "If on_start takes too long, the lifecycle fails."
+    activity = Composite(Component(start_duration=0.3))
+    lifecycle = stk.runner.Lifecycle(activity, start_timeout=0.1)
+    errors = []
+    lifecycle.start(errors.append)
+    assert lifecycle.ready.hasError()
+    assert len(errors) == 1 and "0.1 seconds" in errors[0]
+    assert not lifecycle.is_ready
+
+
+def test_lifecycle_stop_timeout():
+    "on_stop calls taking more than stop_timeout are abandoned."
+    activity = Composite(Component(stop_duration=1.0))
+    lifecycle = stk.runner.Lifecycle(activity, stop_timeout=0.1)
+    start = time.time()
+    lifecycle.stop()
+    assert time.time() - start < 0.5
+    assert len(activity.errors) == 1
+    assert "didn't finish" in activity.errors[0]
+
+
+#
+# Reconnection
+#
+
+class Reconnecting(object):
+    "An activity with a ServiceCache and an EventHelper."
+    def __init__(self, qiapp):
+        self.qiapp = qiapp
+        self.services = stk.services.ServiceCache(qiapp.session)
+        self.events = stk.events.EventHelper(qiapp.session)
+        self.logger = self
+        self.errors = []
+        self.reconnected = threading.Event()
+
+    def error(self, message):
+        "Logger method: records the error."
+        self.errors.append(message)
+
+    def on_reconnect(self):
+        self.reconnected.set()
+
+    def ping(self):
+        return "pong"
+
+
+def test_reconnect(app):
+    "After a disconnection, the service and the connections are restored."
+    activity = Reconnecting(app)
+    service_id = app.session.registerService("Reconnecting", activity)
+    values = []
+    connection_ids = [activity.events.connect("SomeKey", values.append),
+                      activity.events.connect("OtherKey", values.append)]
+    activity.events.subscribe("WordRecognized", "Reconnecting",
+                              values.append)
+    # The signals' link ids (each signal numbers its links from 1)
+    assert connection_ids == [1, 1]
+    assert activity.services.ALMemory._obj is app.session.memory
+    stk.logging._PROVIDERS[app.session] = "old provider"
+    reconnector = stk.runner.Reconnector(app, activity, "Reconnecting",
+                                         service_id, initial_delay=0.01)
+    reconnector.watch()
+    try:
+        app.session.close()
+        assert activity.reconnected.wait(2.0)
+        assert reconnector.reconnections == 1
+        assert app.session.isConnected()
+        assert app.session.service("Reconnecting").ping() == "pong"
+        # The log provider of the dead LogManager was forgotten
+        assert stk.logging._PROVIDERS.get(app.session) != "old provider"
+        # ServiceCache was reset
+        assert activity.services.ALMemory._obj is app.session.memory
+        # EventHelper was reconnected, and the connection ids still work
+        memory = app.session.memory
+        assert memory.getSubscribers("WordRecognized") == ["Reconnecting"]
+        memory.raiseEvent("SomeKey", 1)
+        assert wait_until(lambda: values == [1])
+        activity.events.disconnect("SomeKey", connection_ids[0])
+        memory.raiseEvent("SomeKey", 2)
+        memory.raiseEvent("OtherKey", 3)
+        assert wait_until(lambda: values == [1, 3])
+        time.sleep(0.05)
+        assert values == [1, 3]
+    finally:
+        reconnector.stop()
+        stk.logging._PROVIDERS.pop(app.session, None)
+
+
+def test_service_cache_reset(app):
+    "ServiceCache.reset() makes it fetch services again."
+    services = stk.services.ServiceCache(app.session)
+    memory = services.ALMemory
+    assert services.ALMemory is memory
+    services.reset()
+    assert services.ALMemory is not memory
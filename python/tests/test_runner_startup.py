@@ -0,0 +1,82 @@
+"""
+Startup benchmark for stk.runner
+
+Measures the time from "import stk.runner" to qiapp.start(), in a separate
+process using a stub qi module (so no robot is needed, and the cost of the
+real qi import is left out).
+
+The timings themselves are a benchmark (run with --benchmark, see
+test_benchmarks.py); by default, only relative checks are made.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+STK_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STUB_QI = '''
+__version__ = "2.5.0.0"
+
+class Application(object):
+    def __init__(self, *args, **kwargs):
+        self.session = None
+    def start(self):
+        pass
+'''
+
+MEASURE = '''
+import json, sys, time
+start = time.time()
+import stk.runner
+imported = time.time()
+sys.argv = ["app", "--qi-url", "127.0.0.1"]
+stk.runner.init()
+started = time.time()
+stk.runner.init()
+restarted = time.time()
+print json.dumps({
+    "import": imported - start,
+    "start": started - start,
+    "first_init": started - imported,
+    "second_init": restarted - started,
+    "distutils": "distutils.version" in sys.modules,
+})
+'''
+
+MILLISECONDS = 1000.0
+
+
+def measure_startup(tmpdir):
+    "Runs the measuring script in a fresh interpreter, returns the timings."
+    tmpdir.join("qi.py").write(STUB_QI)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([str(tmpdir), STK_PATH])
+    output = subprocess.check_output([sys.executable, "-c", MEASURE],
+                                     env=env)
+    return json.loads(output.splitlines()[-1])
+
+
+@pytest.mark.benchmark
+def test_startup_time(tmpdir, benchmark):
+    "Going from import to a started application is fast."
+    timings = measure_startup(tmpdir)
+    benchmark.record("runner.import", MILLISECONDS * timings["import"], "ms")
+    benchmark.record("runner.import_to_start",
+                     MILLISECONDS * timings["start"], "ms")
+    benchmark.record("runner.second_init",
+                     MILLISECONDS * timings["second_init"], "ms")
+
+
+def test_second_init_is_cached(tmpdir):
+    "Calling init again reuses the argument parser and qi version: faster."
+    timings = measure_startup(tmpdir)
+    assert timings["second_init"] < timings["first_init"] / 2
+
+
+def test_no_distutils(tmpdir):
+    "stk.runner doesn't import distutils to compare qi versions."
+    assert not measure_startup(tmpdir)["distutils"]
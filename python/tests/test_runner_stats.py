@@ -0,0 +1,165 @@
+"""
+Tests for the stats companion service of stk.runner
+
+These don't need a robot: the activity uses a fake session.
+"""
+
+import time
+
+import stk.events
+import stk.runner
+import stk.services
+
+
+class FakeSignal(object):
+    "Minimal qi.Signal."
+    def __init__(self):
+        self.callbacks = {}
+
+    def connect(self, callback):
+        link_id = len(self.callbacks) + 1
+        self.callbacks[link_id] = callback
+        return link_id
+
+    def disconnect(self, link_id):
+        del self.callbacks[link_id]
+
+    def __call__(self, *args):
+        for callback in self.callbacks.values():
+            callback(*args)
+
+
+class FakeService(object):
+    "A service with one signal."
+    def __init__(self):
+        self.signalTriggered = FakeSignal()
+
+
+class FakeSession(object):
+    "Session that only knows FakeService."
+    def __init__(self):
+        self.fake_service = FakeService()
+
+    def service(self, name):
+        if name == "FakeService":
+            return self.fake_service
+        raise RuntimeError("Cannot find service: %s" % name)
+
+
+class StatsActivity(object):
+    "Activity with an EventHelper and a ServiceCache."
+    def __init__(self):
+        self.session = FakeSession()
+        self.events = stk.events.EventHelper()
+        self.events.session = self.session
+        self.s = stk.services.ServiceCache(self.session)
+
+
+def test_stats_service():
+    "getStats describes the process and the activity's helpers."
+    activity = StatsActivity()
+    stats_service = stk.runner.StatsService(activity)
+    activity.events.connect("FakeService.signalTriggered", lambda *args: 0)
+    assert activity.s.FakeService
+    assert activity.s.ALMissingService is None
+    activity.s.scheduler("FakeService", rate=1.0)
+    for _ in range(10):
+        activity.session.fake_service.signalTriggered(1)
+    stats = stats_service.getStats()
+    assert stats["threads"] >= 1
+    assert stats["rss"] > 0
+    assert len(stats["gc_counts"]) == 3
+    assert stats["coroutines"]["pending"] >= 0
+    event_stats = stats["events"]["events"]["FakeService.signalTriggered"]
+    assert event_stats["connections"] == 1
+    assert event_stats["calls"] == 10
+    assert event_stats["rate"] > 0
+    assert stats["services"]["s"] == {"FakeService": True,
+                                      "ALMissingService": False}
+    assert stats["schedulers"]["s"]["FakeService"]["pending"] == 0
+
+
+def test_event_counting():
+    "Events are only counted once counting is enabled."
+    activity = StatsActivity()
+    signal = activity.session.fake_service.signalTriggered
+    calls = []
+    connection_id = activity.events.connect("FakeService.signalTriggered",
+                                            calls.append)
+    assert connection_id == 1  # the signal's link id
+    signal(1)
+    assert signal.callbacks[1] == calls.append  # not wrapped
+    stats_service = stk.runner.StatsService(activity)
+    signal(2)
+    signal(3)
+    assert calls == [1, 2, 3]
+    assert len(signal.callbacks) == 1
+    stats = stats_service.getStats()["events"]["events"]
+    assert stats["FakeService.signalTriggered"]["calls"] == 2
+    activity.events.disconnect("FakeService.signalTriggered", connection_id)
+    assert not signal.callbacks
+
+
+def test_stats_service_cost():
+    "Collecting stats is cheap enough to be done every second."
+    stats_service = stk.runner.StatsService(StatsActivity())
+    start = time.time()
+    for _ in range(100):
+        stats_service.getStats()
+    duration = (time.time() - start) / 100
+    print "getStats took %.2f ms" % (1000 * duration)
+    assert duration < 0.01
+
+
+def busy_loop(duration):
+    "Keeps the CPU busy for a while."
+    end = time.time() + duration
+    total = 0
+    while time.time() < end:
+        total += 1
+    return total
+
+
+def test_profiler():
+    "The profiler finds where the time is spent, at a low cost."
+    profiler = stk.runner.start_profiler(100)
+    busy_loop(0.5)
+    collapsed = stk.runner.stop_profiler()
+    stats = profiler.stats()
+    print "%d samples, %.2f%% overhead" % (stats["samples"],
+                                          100 * stats["overhead"])
+    assert stats["samples"] > 20
+    assert stats["overhead"] < 0.05
+    busy_lines = [line for line in collapsed.splitlines()
+                  if "busy_loop (test_runner_stats.py:" in line]
+    assert busy_lines
+    stack, count = busy_lines[0].rsplit(" ", 1)
+    assert stack.split(";")[-1].startswith("busy_loop")
+    assert int(count) > 0
+    # Stopped: nothing more is sampled.
+    samples = profiler.samples
+    time.sleep(0.1)
+    assert profiler.samples == samples
+
+
+def leaky_generator():
+    "A generator that never finishes."
+    yield
+
+
+def test_memory_snapshots():
+    "Comparing snapshots shows where leaked objects come from."
+    tracker = stk.runner.MemoryTracker()
+    tracker.take_snapshot("before")
+    leaked = [leaky_generator() for _ in range(1000)]
+    tracker.take_snapshot("after")
+    diffs = tracker.compare("before", "after", 5)
+    assert len(diffs) <= 5
+    assert "test_runner_stats.py" in diffs[0]["location"]
+    assert diffs[0]["count_diff"] >= 1000
+    assert diffs[0]["size_diff"] > 0
+    del leaked[:]
+    # Without a second name, compares with now.
+    assert tracker.compare("after", top=3)[0]["count_diff"] <= -1000
+    tracker.stop()
+    assert not tracker.snapshots
@@ -0,0 +1,111 @@
+"""
+Unit tests for stk.sensors
+"""
+
+import subprocess
+import sys
+import time
+
+import pytest
+
+import stk.sensors
+
+KEY = "TestSensors/Value"
+
+@pytest.fixture
+def publisher(request):
+    publisher = stk.sensors.SensorPublisher(None, "test_%s" % request.node.name,
+                                            capacity=16, value_size=3)
+    yield publisher
+    publisher.stop()
+
+def test_latest(publisher):
+    "Readers get the latest value of each key."
+    reader = stk.sensors.SensorReader(publisher.name)
+    assert reader.latest(KEY) is None
+    assert publisher.publish(KEY, 1.5, 100.0)
+    assert publisher.publish("Other", [1, 2, 3], 101.0)
+    assert publisher.publish(KEY, 2.5, 102.0)
+    assert reader.latest(KEY) == (102.0, 2.5)
+    assert reader.latest("Other") == (101.0, [1.0, 2.0, 3.0])
+    assert reader.keys() == ["Other", KEY]
+    # Values that don't fit are skipped
+    assert not publisher.publish(KEY, [1, 2, 3, 4])
+    assert not publisher.publish(KEY, "text")
+    assert publisher.skipped == 2
+    assert reader.latest(KEY) == (102.0, 2.5)
+
+def test_window(publisher):
+    "Readers get the values in a time window, as long as they are kept."
+    reader = stk.sensors.SensorReader(publisher.name)
+    for index in range(10):
+        publisher.publish(KEY, index, 100.0 + index)
+        publisher.publish("Other", -index, 100.0 + index)
+    assert reader.window(KEY, start=105.0, end=107.0) == [
+        (105.0, 5), (106.0, 6), (107.0, 7)]
+    # The capacity is 16 values: the 4 oldest are gone.
+    assert [value for _, value in reader.window(KEY)] == range(2, 10)
+    now = time.time()
+    publisher.publish(KEY, 42, now)
+    assert reader.window(KEY, 1.0) == [(now, 42)]
+
+def test_other_process(publisher):
+    "Values can be read from another process."
+    publisher.publish(KEY, [1, 2], 100.0)
+    code = ("import stk.sensors; "
+            "print stk.sensors.SensorReader(%r).latest(%r)"
+            % (publisher.name, KEY))
+    output = subprocess.check_output([sys.executable, "-c", code])
+    assert output.strip() == "(100.0, [1.0, 2.0])"
+
+def test_from_memory(qiapp):
+    "The publisher can subscribe to ALMemory keys."
+    publisher = stk.sensors.SensorPublisher(qiapp.session, "test_memory",
+                                            [KEY])
+    publisher.start()
+    try:
+        reader = stk.sensors.SensorReader("test_memory")
+        qiapp.session.service("ALMemory").raiseEvent(KEY, 12.0)
+        time.sleep(0.1)
+        assert reader.latest(KEY)[1] == 12.0
+    finally:
+        publisher.stop()
+
+def test_read_cost(publisher):
+    "Reading is cheap."
+    reader = stk.sensors.SensorReader(publisher.name)
+    publisher.publish(KEY, 1.0)
+    start = time.time()
+    for _ in range(10000):
+        reader.latest(KEY)
+    duration = (time.time() - start) / 10000
+    print "latest() took %.1f us" % (1000000 * duration)
+    assert duration < 0.0001
+
+def test_no_torn_reads(publisher):
+    "Values being written are never returned half-written."
+    import threading
+    running = [True]
+    def write():
+        "Writes [i, i, i] as fast as possible."
+        index = 0
+        while running[0]:
+            index += 1
+            publisher.publish(KEY, [index] * 3)
+    thread = threading.Thread(target=write)
+    thread.start()
+    reader = stk.sensors.SensorReader(publisher.name)
+    try:
+        end = time.time() + 0.3
+        reads = 0
+        while time.time() < end:
+            latest = reader.latest(KEY)
+            if latest:
+                reads += 1
+                assert len(set(latest[1])) == 1
+            for _, value in reader.window(KEY):
+                assert len(set(value)) == 1
+    finally:
+        running[0] = False
+        thread.join()
+    assert reads
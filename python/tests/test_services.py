@@ -0,0 +1,316 @@
+"""
+Unit tests for stk.services
+"""
+
+import threading
+import time
+
+import pytest
+
+import stk.coroutines
+import stk.events
+import stk.services
+
+TEST_KEY = "TestServices/Invalidate"
+
+class Config(object):
+    "A service with cached methods."
+    def __init__(self, session=None):
+        self.calls = []
+        if session:
+            self.events = stk.events.EventHelper(session)
+
+    @stk.services.cached(max_size=2)
+    def get(self, name):
+        "Returns a value, slowly."
+        self.calls.append(name)
+        time.sleep(0.05)
+        return name.upper()
+
+    @stk.services.cached(ttl=0.1)
+    def get_short_lived(self, name):
+        "Returns a value that is only cached for a while."
+        self.calls.append(name)
+        return str(name).lower()
+
+    @stk.services.cached()
+    def fail(self, name):
+        "Always fails."
+        self.calls.append(name)
+        raise ValueError(name)
+
+    @stk.services.cached()
+    def get_formatted(self, name, upper=False):
+        "Returns a value, depending on a keyword argument."
+        self.calls.append((name, upper))
+        return name.upper() if upper else name
+
+    @stk.services.cached(invalidate_on=[TEST_KEY])
+    def get_memory(self, name):
+        "Cached until TEST_KEY is raised."
+        self.calls.append(name)
+        return len(self.calls)
+
+    @stk.services.cached()
+    @stk.coroutines.public_async_generator
+    def get_async(self, name):
+        "Returns a future."
+        self.calls.append(name)
+        yield stk.coroutines.sleep(0.05)
+        yield stk.coroutines.Return(name * 2)
+
+    @stk.services.cached()
+    @stk.coroutines.async_generator
+    def fail_async(self, name):
+        "Returns a future that fails."
+        self.calls.append(name)
+        yield stk.coroutines.sleep(0.01)
+        raise ValueError(name)
+
+def test_cached():
+    "Results are cached per arguments."
+    config = Config()
+    assert config.get("a") == "A"
+    assert config.get("a") == "A"
+    assert config.get("b") == "B"
+    assert config.calls == ["a", "b"]
+    # Lists are fine too (that's what qi gives)
+    assert config.get_short_lived(["X"]) == "['x']"
+    assert config.get_short_lived(["X"]) == "['x']"
+    assert config.calls == ["a", "b", ["X"]]
+    assert stk.services.get_cache(config, config.get).stats() == {
+        "hits": 1, "misses": 2, "coalesced": 0, "size": 2}
+
+def test_cached_kwargs():
+    "Keyword arguments are part of the key."
+    config = Config()
+    assert config.get_formatted("a") == "a"
+    assert config.get_formatted("a", upper=True) == "A"
+    assert config.get_formatted("a", upper=True) == "A"
+    assert config.get_formatted("a", upper=False) == "a"
+    assert config.calls == [("a", False), ("a", True), ("a", False)]
+    stk.services.invalidate(config.get_formatted, "a", upper=True)
+    assert config.get_formatted("a", upper=True) == "A"
+    assert config.get_formatted("a") == "a"
+    assert len(config.calls) == 4
+
+def test_lru_and_ttl():
+    "Least recently used and expired results are forgotten."
+    config = Config()
+    config.get("a")
+    config.get("b")
+    config.get("a")
+    config.get("c") # forgets b
+    assert config.calls == ["a", "b", "c"]
+    config.get("a")
+    config.get("b")
+    assert config.calls == ["a", "b", "c", "b"]
+    del config.calls[:]
+    config.get_short_lived("x")
+    config.get_short_lived("x")
+    time.sleep(0.15)
+    config.get_short_lived("x")
+    assert config.calls == ["x", "x"]
+
+def test_coalescing():
+    "Concurrent calls with the same arguments are only computed once."
+    config = Config()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(config.get("a")))
+               for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ["A"] * 10
+    assert config.calls == ["a"]
+    assert stk.services.get_cache(config, config.get).stats()["misses"] == 1
+
+def test_errors_not_cached():
+    "Errors are raised, and not cached."
+    config = Config()
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            config.fail("x")
+    assert config.calls == ["x", "x"]
+
+def test_invalidate():
+    "Results can be forgotten explicitly."
+    config = Config()
+    config.get("a")
+    config.get("b")
+    stk.services.invalidate(config.get, "a")
+    config.get("a")
+    config.get("b")
+    assert config.calls == ["a", "b", "a"]
+    stk.services.invalidate(config.get)
+    config.get("b")
+    assert config.calls == ["a", "b", "a", "b"]
+
+def test_invalidate_on_event(qiapp):
+    "Results are forgotten when an ALMemory key is raised."
+    config = Config(qiapp.session)
+    assert config.get_memory("a") == 1
+    assert config.get_memory("a") == 1
+    config.events.set(TEST_KEY, 1)
+    time.sleep(0.1)
+    assert config.get_memory("a") == 2
+    config.events.clear()
+
+def test_cached_future(qiapp):
+    "Futures are cached; each caller gets its own."
+    config = Config()
+    first = config.get_async("a")
+    second = config.get_async("a")
+    assert first is not second
+    second.cancel() # doesn't cancel the first
+    assert first.value() == "aa"
+    assert config.get_async("a").value() == "aa"
+    assert config.calls == ["a"]
+
+def test_async_errors_not_cached(qiapp):
+    "Futures that fail are forgotten, the next call computes it again."
+    config = Config()
+    for _ in range(2):
+        future = config.fail_async("x")
+        future.wait()
+        assert future.hasError()
+        time.sleep(0.05) # the cache's callback runs in another thread
+    assert config.calls == ["x", "x"]
+
+def test_batch(services):
+    "Calls are made concurrently, and the results are in order."
+    services.ALMemory.insertData("TestServices/Batch", 0)
+    with services.batch() as batch:
+        for index in range(10):
+            batch.ALMemory.insertData("TestServices/Batch%d" % index, index)
+        calls = [batch.ALMemory.getData("TestServices/Batch")]
+        calls.append(batch.ALMemory.getData("TestServices/Missing"))
+        calls.append(batch.ALMemoryMissing.getData("TestServices/Batch"))
+        calls.append(batch.ALMemory.missingMethod())
+    assert batch.results[:11] == [None] * 10 + [0]
+    assert calls[0].value() == 0
+    assert len(batch.errors) == 3
+    assert [call for call, error in batch.errors] == calls[1:]
+    for call in calls[1:]:
+        with pytest.raises(RuntimeError):
+            call.value()
+    assert services.ALMemory.getData("TestServices/Batch9") == 9
+
+def test_batch_concurrency_limit(services):
+    "No more than max_concurrent calls are made at once."
+    class Slow(object):
+        "Service with a slow method."
+        running = [0, 0] # current, max
+        def wait(self):
+            "Waits a bit."
+            self.running[0] += 1
+            self.running[1] = max(self.running)
+            time.sleep(0.05)
+            self.running[0] -= 1
+    service_id = services.session.registerService("TestSlow", Slow())
+    try:
+        start = time.time()
+        with services.batch(max_concurrent=2) as batch:
+            for _ in range(6):
+                batch.TestSlow.wait()
+        assert time.time() - start >= 0.15
+        assert Slow.running[1] == 2
+        assert not batch.errors
+    finally:
+        services.session.unregisterService(service_id)
+
+class Speech(object):
+    "A slow service, that can only do one thing at a time."
+    def __init__(self):
+        self.said = []
+        self.running = [0, 0] # current, max
+
+    def say(self, text):
+        "Says something, slowly."
+        self.running[0] += 1
+        self.running[1] = max(self.running)
+        time.sleep(0.05)
+        self.said.append(text)
+        self.running[0] -= 1
+        return len(text)
+
+@pytest.fixture
+def speech(services):
+    "Registers a Speech service, as TestSpeech."
+    service = Speech()
+    service_id = services.session.registerService("TestSpeech", service)
+    yield service
+    services.session.unregisterService(service_id)
+
+def test_scheduler_priorities(services, speech):
+    "Calls are sent one at a time, highest priority first."
+    scheduler = services.scheduler("TestSpeech")
+    assert services.scheduler("TestSpeech") is scheduler
+    first = scheduler.say("first")
+    low = scheduler.say("low")
+    high = scheduler.say("high", _priority=5)
+    assert scheduler.stats()["pending"] == 2
+    assert low.value() == 3
+    assert first.value() == 5 and high.value() == 4
+    assert speech.said == ["first", "high", "low"]
+    assert speech.running[1] == 1
+    stats = scheduler.stats()
+    assert stats["done"] == 3
+    assert stats["pending"] == 0 and stats["max_pending"] == 2
+    assert stats["max_wait"] >= 0.05
+
+def test_scheduler_supersede(services, speech):
+    "A call supersedes a pending call with the same tag."
+    scheduler = stk.services.CallScheduler(services, "TestSpeech")
+    first = scheduler.say("first", _tag="status")
+    older = scheduler.say("older", _tag="status")
+    newer = scheduler.say("newer", _tag="status")
+    assert older.isCanceled()
+    newer.wait()
+    assert first.hasValue()
+    assert speech.said == ["first", "newer"]
+    assert scheduler.stats()["superseded"] == 1
+
+def test_scheduler_cancel(services, speech):
+    "Cancelling the future of a pending call removes it from the queue."
+    scheduler = stk.services.CallScheduler(services, "TestSpeech")
+    scheduler.say("first")
+    cancelled = scheduler.say("cancelled")
+    last = scheduler.say("last")
+    cancelled.cancel()
+    assert cancelled.isCanceled()
+    last.wait()
+    assert speech.said == ["first", "last"]
+    assert scheduler.stats()["canceled"] == 1
+
+def test_scheduler_rate(services, speech):
+    "No more than rate calls per second are sent."
+    scheduler = stk.services.CallScheduler(services, "TestSpeech",
+                                           max_concurrent=None, rate=20)
+    start = time.time()
+    futures = [scheduler.say(str(index)) for index in range(5)]
+    for future in futures:
+        future.wait()
+    # The first call is sent at once, the others every 50 ms.
+    assert time.time() - start >= 0.2
+    assert scheduler.stats()["done"] == 5
+
+def test_scheduler_coroutine(services, speech):
+    "Scheduled calls can be yielded in an async_generator."
+    scheduler = stk.services.CallScheduler(services, "TestSpeech")
+    @stk.coroutines.async_generator
+    def talk():
+        "Says two things, concurrently."
+        lengths = yield [scheduler.say("hello"), scheduler.say("world!")]
+        yield stk.coroutines.Return(sum(lengths))
+    assert talk().value() == 11
+    assert speech.running[1] == 1
+
+def test_scheduler_errors(services):
+    "Errors of calls are in their futures."
+    scheduler = stk.services.CallScheduler(services, "TestSpeechMissing")
+    future = scheduler.say("hello")
+    assert future.hasError()
+    assert "TestSpeechMissing" in future.error()
+    assert scheduler.stats()["errors"] == 1
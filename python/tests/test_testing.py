@@ -0,0 +1,151 @@
+"""
+Tests for stk.testing's fake qi
+
+Only run when the fake is installed (with --fakeqi, or if qi is missing).
+"""
+
+import time
+
+import pytest
+
+import qi
+
+import stk.testing
+
+pytestmark = pytest.mark.skipif(not stk.testing.is_installed(),
+                                reason="the fake qi isn't installed")
+
+def test_then_and_then():
+    "then gets the future, andThen the value; errors are propagated."
+    promise = qi.Promise()
+    future = promise.future()
+    then_future = future.then(lambda fut: fut.value() + 1)
+    and_then_future = future.andThen(lambda value: value * 2)
+    assert future.isRunning()
+    promise.setValue(20)
+    assert then_future.value() == 21
+    assert and_then_future.value() == 40
+    promise = qi.Promise()
+    and_then_future = promise.future().andThen(lambda value: value * 2)
+    promise.setError("Nope")
+    assert and_then_future.hasError()
+    assert and_then_future.error() == "Nope"
+    with pytest.raises(RuntimeError):
+        and_then_future.value()
+
+def test_cancel():
+    "Cancelling a future calls the promise's callback."
+    promise = qi.Promise(lambda prom: prom.setCanceled())
+    then_future = promise.future().then(lambda fut: fut.isCanceled())
+    then_future.cancel() # ... is propagated to the original future
+    assert promise.isCancelRequested()
+    assert promise.future().isCanceled()
+    assert then_future.value()
+
+def test_async_delay():
+    "qi.async calls the function after the delay, unless cancelled."
+    calls = []
+    start = time.time()
+    future = qi.async(calls.append, 1, delay=100000)
+    assert future.wait(10) == qi.FutureState.Running
+    future.wait()
+    assert time.time() - start >= 0.1
+    assert calls == [1]
+    future = qi.async(calls.append, 2, delay=100000)
+    future.cancel()
+    assert future.isCanceled()
+    time.sleep(0.15)
+    assert calls == [1]
+
+def test_session_services():
+    "Registered objects are available as services, and listed."
+    session = qi.Session()
+    added = []
+    session.service("ServiceDirectory").serviceAdded.connect(
+        lambda service_id, name: added.append(name))
+    class Adder(object):
+        "Test service."
+        def add(self, a, b):
+            "Adds two numbers"
+            return a + b
+        def _private(self):
+            "Not exposed"
+            pass
+    service_id = session.registerService("Adder", Adder())
+    adder = session.service("Adder")
+    assert adder.add(1, 2) == 3
+    assert adder.add(2, 3, _async=True).value() == 5
+    with pytest.raises(AttributeError):
+        adder._private()
+    with pytest.raises(RuntimeError):
+        adder.add(1, "a")
+    names = [info[0] for info in session.services()]
+    assert names == ["ServiceDirectory", "ALMemory", "Adder"]
+    time.sleep(0.05)
+    assert added == ["Adder"]
+    session.unregisterService(service_id)
+    with pytest.raises(RuntimeError):
+        session.service("Adder")
+
+def test_memory_subscriber():
+    "Raising an ALMemory event triggers the subscribers' signal."
+    memory = qi.Session().service("ALMemory")
+    values = []
+    memory.subscriber("Test/Key").signal.connect(values.append)
+    memory.raiseEvent("Test/Key", 42)
+    time.sleep(0.05)
+    assert values == [42]
+    assert memory.getData("Test/Key") == 42
+    with pytest.raises(RuntimeError):
+        memory.getData("Test/Missing")
+
+def test_latency():
+    "Calls take the session's latency, but stay in order."
+    session = qi.Session()
+    session.set_latency(0.05, "ALMemory")
+    memory = session.service("ALMemory")
+    start = time.time()
+    memory.raiseEvent("Test/Latency", 1, _async=True)
+    assert memory.getData("Test/Latency") == 1
+    assert time.time() - start >= 0.05
+
+def test_call_order():
+    "Without latency too, calls are made in order."
+    session = qi.Session()
+    memory = session.service("ALMemory")
+    for value in range(100):
+        memory.raiseEvent("Test/Order", value, _async=True)
+        assert memory.getData("Test/Order") == value
+
+def test_signal_order():
+    "A signal's callbacks are called one at a time, in order."
+    signal = qi.Signal()
+    values = []
+    running = [0, 0] # current, max
+    def callback(value):
+        "Records the value, slowly."
+        running[0] += 1
+        running[1] = max(running)
+        time.sleep(0.001)
+        values.append(value)
+        running[0] -= 1
+    signal.connect(callback)
+    for value in range(20):
+        signal(value)
+    time.sleep(0.2)
+    assert values == range(20)
+    assert running[1] == 1
+
+def test_executor_limit():
+    "When all threads are busy, tasks wait for one."
+    executor = stk.testing._Executor(max_threads=2)
+    done = []
+    for index in range(5):
+        executor.post(lambda index=index: (time.sleep(0.02),
+                                           done.append(index)))
+    assert len(executor.threads) == 2 and executor.queued == 3
+    executor.stop()
+    assert sorted(done) == range(5)
+    assert executor.idle == 2 and executor.queued == 0
+    executor.post(done.append, 5)
+    assert not any(thread.is_alive() for thread in executor.threads)
@@ -0,0 +1,90 @@
+"""
+Unit tests for stk.video (needs NumPy)
+
+Uses a fake ALVideoDevice, registered on the session of the qiapp fixture.
+"""
+
+import time
+
+import pytest
+
+numpy = pytest.importorskip("numpy")
+
+import stk.video
+
+WIDTH, HEIGHT, LAYERS = 32, 24, 3
+
+class FakeVideoDevice(object):
+    "Returns images whose pixels are all the image's number."
+    def __init__(self):
+        self.subscribers = {}
+        self.count = 0
+
+    def subscribeCamera(self, name, camera, resolution, color_space, fps):
+        "Returns a handle."
+        handle = "%s_%d" % (name, len(self.subscribers))
+        self.subscribers[handle] = camera
+        return handle
+
+    def unsubscribe(self, handle):
+        "Forgets a handle."
+        del self.subscribers[handle]
+
+    def getImageRemote(self, handle):
+        "Returns the next image."
+        self.count += 1
+        now = time.time()
+        return [WIDTH, HEIGHT, LAYERS, stk.video.RGB_COLOR_SPACE, int(now),
+                int((now % 1) * 1000000),
+                chr(self.count % 256) * (WIDTH * HEIGHT * LAYERS),
+                self.subscribers[handle]]
+
+@pytest.fixture
+def video_device(qiapp):
+    device = FakeVideoDevice()
+    service_id = qiapp.session.registerService("ALVideoDevice", device)
+    yield device
+    qiapp.session.unregisterService(service_id)
+
+def test_get_frame(qiapp, video_device):
+    "Frames are copied into the arrays of the pool, which are reused."
+    with stk.video.CameraStream(qiapp.session, pool_size=2) as stream:
+        assert video_device.subscribers
+        frame = stream.get_frame()
+        assert frame.array.shape == (HEIGHT, WIDTH, LAYERS)
+        assert frame.array.dtype == numpy.uint8
+        assert (frame.array == 1).all()
+        assert frame.timestamp == pytest.approx(time.time(), abs=1)
+        first_array = frame.array
+        frame.release()
+        with stream.get_frame() as frame:
+            assert (frame.array == 2).all()
+            assert frame.array is first_array
+        # If frames are kept, arrays run out
+        frames = [stream.get_frame(), stream.get_frame()]
+        assert frames[0].array is first_array
+        assert frames[1].array is not first_array
+        with pytest.raises(RuntimeError):
+            stream.get_frame()
+        assert stream.stats()["dropped"] == 1
+    assert not video_device.subscribers
+
+def test_prefetch(qiapp, video_device):
+    "With prefetching, get_frame returns the latest image."
+    stream = stk.video.CameraStream(qiapp.session, fps=100, prefetch=True)
+    stream.on_start()
+    try:
+        with stream.get_frame(1.0) as frame:
+            assert frame.array.shape == (HEIGHT, WIDTH, LAYERS)
+        time.sleep(0.2)
+        with stream.get_frame(1.0) as frame:
+            assert frame.array[0, 0, 0] == video_device.count % 256 or \
+                frame.array[0, 0, 0] == (video_device.count - 1) % 256
+        stats = stream.stats()
+        assert stats["delivered"] == 2
+        assert stats["dropped"] > 5
+        assert stats["fetched"] == video_device.count
+    finally:
+        stream.on_stop()
+    assert stream.get_frame(0.01) is None
+    assert not video_device.subscribers